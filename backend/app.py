@@ -1,21 +1,58 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, create_access_token
+from sqlalchemy import DDL, and_, case, delete, event, false, func, insert, null, or_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+from pagination import TOTAL_MODES, keyset_page, paginate
+from streaming import (CSV_MIMETYPE, NDJSON_MIMETYPE, iter_uploaded_records, ndjson_response, sse_message,
+                       sse_response, wants_ndjson)
+from changefeed import ChangeFeed
+from conditional import not_modified, version_etag, with_etag
+from sinks import BatchWriter, RateLimiter, error_fingerprint
+from gateways import AccessTokenManager, GatewayClient, LatencyStats
+from workers import BoundedExecutor, PeriodicWorker
+from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, get_jwt, create_access_token
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone, date
+from datetime import datetime, timezone, date, timedelta
+from functools import wraps
 from flask_cors import CORS
 import os
 import logging
 import stripe
 import requests
+import csv
 import json
+import re
+import uuid
+import click
+import copy
+import threading
+import time
 
 # Initialize Stripe
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY', 'sk_test_your_test_key_here')
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
+
+# Outbound gateway clients: one keep-alive pool per gateway, with deadlines and retries
+def make_gateway_client(name):
+    return GatewayClient(
+        name,
+        connect_timeout=app.config['GATEWAY_CONNECT_TIMEOUT'],
+        read_timeout=app.config['GATEWAY_READ_TIMEOUT'],
+        retries=app.config['GATEWAY_MAX_RETRIES'],
+        backoff=app.config['GATEWAY_BACKOFF_SECONDS'],
+        pool_size=app.config['GATEWAY_POOL_SIZE'],
+    )
+
+mpesa_gateway = make_gateway_client('mpesa')
+stripe_gateway = make_gateway_client('stripe')
+# Stripe retries with idempotency keys itself; it only needs the pooled session and deadlines
+stripe.default_http_client = stripe.http_client.RequestsClient(timeout=stripe_gateway.timeout, session=stripe_gateway.session)
+stripe.max_network_retries = app.config['GATEWAY_MAX_RETRIES']
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 jwt = JWTManager(app)
@@ -64,12 +101,17 @@ class User(db.Model):
          password = db.Column(db.String(255), nullable=False)  # Renamed from password_hash
          created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
          email = db.Column(db.String(120), nullable=True)  # Added for /api/login
+         token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Bumped to invalidate issued claims
          roles = db.relationship('Role', secondary='user_role', backref=db.backref('users', lazy='dynamic'))
 
          @property
          def role(self):
              return self.roles[0].name if self.roles else None
 
+         @property
+         def role_names(self):
+             return frozenset(r.name for r in self.roles)
+
 class Role(db.Model):
          __tablename__ = 'role'
          id = db.Column(db.Integer, primary_key=True)
@@ -77,6 +119,9 @@ class Role(db.Model):
 
 class UserRole(db.Model):
          __tablename__ = 'user_role'
+         __table_args__ = (
+             db.Index('ix_user_role_user_id', 'user_id'),
+         )
          id = db.Column(db.Integer, primary_key=True)
          user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
          role_id = db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False)
@@ -90,12 +135,16 @@ class LoginActivity(db.Model):
 
 class Patient(db.Model):
     __tablename__ = 'patient'
+    __table_args__ = (
+        db.Index('ix_patient_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     dob = db.Column(db.Date, nullable=False)
     contact = db.Column(db.String(50))
     address = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped on every update, for ETags
 
 class EmergencyContact(db.Model):
     __tablename__ = 'emergency_contact'
@@ -107,6 +156,10 @@ class EmergencyContact(db.Model):
 
 class Appointment(db.Model):
     __tablename__ = 'appointment'
+    __table_args__ = (
+        db.Index('ix_appointment_patient_date', 'patient', 'date'),
+        db.Index('ix_appointment_date', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     date = db.Column(db.DateTime, nullable=False)
@@ -146,6 +199,10 @@ class Inpatient(db.Model):
 
 class MedicalRecord(db.Model):
     __tablename__ = 'medical_record'
+    __table_args__ = (
+        db.Index('ix_medical_record_patient_id_created_at', 'patient_id', 'created_at'),
+        db.Index('ix_medical_record_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -157,6 +214,7 @@ class MedicalRecord(db.Model):
     history = db.Column(db.Text)
     allergies = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped on every update, for ETags
 
     def to_dict(self):
         return {
@@ -234,6 +292,9 @@ class Attendance(db.Model):
 
 class Payroll(db.Model):
     __tablename__ = 'payroll'
+    __table_args__ = (
+        db.Index('ix_payroll_period_start', 'period_start'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     salary = db.Column(db.Numeric(10, 2), nullable=False)
@@ -252,6 +313,9 @@ class Notification(db.Model):
 
 class AuditLog(db.Model):
     __tablename__ = 'audit_log'
+    __table_args__ = (
+        db.Index('ix_audit_log_timestamp_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     action = db.Column(db.String(200), nullable=False)
     user = db.Column(db.String(80), nullable=False)
@@ -259,10 +323,16 @@ class AuditLog(db.Model):
 
 class ErrorLog(db.Model):
     __tablename__ = 'error_log'
+    __table_args__ = (
+        db.Index('ix_error_log_fingerprint_timestamp', 'fingerprint', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     error_message = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    fingerprint = db.Column(db.String(40))  # error_fingerprint() of error_message
+    count = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Occurrences folded into this row
+    last_seen = db.Column(db.DateTime)
 
 class ReportsGenerated(db.Model):
     __tablename__ = 'reports_generated'
@@ -286,6 +356,9 @@ class Bed(db.Model):
 
 class BedAllocation(db.Model):
     __tablename__ = 'bed_allocation'
+    __table_args__ = (
+        db.Index('ix_bed_allocation_bed_id_discharge_date', 'bed_id', 'discharge_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     bed_id = db.Column(db.Integer, db.ForeignKey('bed.id'), nullable=False)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
@@ -354,6 +427,10 @@ class AppointmentRequest(db.Model):
 
 class Bill(db.Model):
     __tablename__ = 'bill'
+    __table_args__ = (
+        db.Index('ix_bill_patient_id_created_at', 'patient_id', 'created_at'),
+        db.Index('ix_bill_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
@@ -373,6 +450,9 @@ class Bill(db.Model):
 
 class SecurityLog(db.Model):
     __tablename__ = 'security_log'
+    __table_args__ = (
+        db.Index('ix_security_log_timestamp_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     event = db.Column(db.String(200), nullable=False)
     user = db.Column(db.String(80), nullable=False)
@@ -398,11 +478,25 @@ class LabSample(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+BLOOD_PRESSURE = re.compile(r'^\s*(\d{2,3})\s*/\s*(\d{2,3})\s*$')
+
+
+def split_blood_pressure(value):
+    """``(systolic, diastolic)`` from a reading like "120/80", or ``(None, None)``."""
+    match = BLOOD_PRESSURE.match(str(value or ''))
+    return (int(match.group(1)), int(match.group(2))) if match else (None, None)
+
+
 class Vitals(db.Model):
     __tablename__ = 'vitals'
+    __table_args__ = (
+        db.Index('ix_vitals_patient_id_recorded_at', 'patient_id', 'recorded_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     blood_pressure = db.Column(db.String(20), nullable=False)
+    systolic = db.Column(db.Integer)  # Parsed from blood_pressure; NULL if it was not "NNN/NN"
+    diastolic = db.Column(db.Integer)
     temperature = db.Column(db.Numeric(4, 1), nullable=False)
     pulse = db.Column(db.Integer, nullable=False)
     respiration = db.Column(db.Integer, nullable=False)
@@ -414,6 +508,8 @@ class Vitals(db.Model):
             'id': self.id,
             'patient_id': self.patient_id,
             'blood_pressure': self.blood_pressure,
+            'systolic': self.systolic,
+            'diastolic': self.diastolic,
             'temperature': float(self.temperature),
             'pulse': self.pulse,
             'respiration': self.respiration,
@@ -421,6 +517,50 @@ class Vitals(db.Model):
             'recorded_at': self.recorded_at.isoformat()
         }
 
+VITALS_METRICS = ('systolic', 'diastolic', 'temperature', 'pulse', 'respiration')
+VITALS_RESOLUTIONS = ('hour', 'day')
+
+
+class VitalsRollup(db.Model):
+    """Per-patient hourly and daily vitals aggregates, kept current as readings are written."""
+    __tablename__ = 'vitals_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('patient_id', 'resolution', 'bucket_start', name='uq_vitals_rollup_bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    resolution = db.Column(db.String(4), nullable=False)  # hour, day
+    bucket_start = db.Column(db.DateTime, nullable=False)  # UTC
+    count = db.Column(db.Integer, nullable=False, default=0)
+    bp_count = db.Column(db.Integer, nullable=False, default=0)  # Readings with a parsed blood pressure
+    systolic_sum = db.Column(db.Integer)
+    systolic_min = db.Column(db.Integer)
+    systolic_max = db.Column(db.Integer)
+    diastolic_sum = db.Column(db.Integer)
+    diastolic_min = db.Column(db.Integer)
+    diastolic_max = db.Column(db.Integer)
+    temperature_sum = db.Column(db.Float)
+    temperature_min = db.Column(db.Float)
+    temperature_max = db.Column(db.Float)
+    pulse_sum = db.Column(db.Integer)
+    pulse_min = db.Column(db.Integer)
+    pulse_max = db.Column(db.Integer)
+    respiration_sum = db.Column(db.Integer)
+    respiration_min = db.Column(db.Integer)
+    respiration_max = db.Column(db.Integer)
+
+    def to_point(self):
+        point = {'t': self.bucket_start.replace(tzinfo=timezone.utc).isoformat(), 'count': self.count}
+        for metric in VITALS_METRICS:
+            n = self.bp_count if metric in ('systolic', 'diastolic') else self.count
+            total = getattr(self, f'{metric}_sum')
+            point[metric] = {
+                'min': getattr(self, f'{metric}_min'),
+                'max': getattr(self, f'{metric}_max'),
+                'mean': round(total / n, 1) if n and total is not None else None,
+            }
+        return point
+
 class Communication(db.Model):
     __tablename__ = 'communication_settings'
     id = db.Column(db.Integer, primary_key=True)
@@ -428,6 +568,7 @@ class Communication(db.Model):
     email = db.Column(db.Boolean, nullable=False, default=False)
     chat = db.Column(db.Boolean, nullable=False, default=False)
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped on every update, for ETags
 
     def to_dict(self):
         return {
@@ -440,6 +581,10 @@ class Communication(db.Model):
 
 class LabOrder(db.Model):
     __tablename__ = 'lab_order'
+    __table_args__ = (
+        db.Index('ix_lab_order_patient_id_created_at', 'patient_id', 'created_at'),
+        db.Index('ix_lab_order_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     test_type = db.Column(db.String(50), nullable=False)
@@ -480,20 +625,392 @@ class RadiologyOrder(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+class Principal:
+    """The authenticated caller, resolved once per request.
+
+    Role names are loaded together with the user (or read from the token's
+    claims), so role checks are set lookups instead of ``Role JOIN UserRole``
+    queries.
+    """
+    __slots__ = ('id', 'username', 'email', 'role', 'role_names', 'patient_id')
+
+    def __init__(self, id, username, role_names, role=None, email=None, patient_id=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.role = role
+        self.role_names = frozenset(role_names)
+        self.patient_id = patient_id
+
+    @classmethod
+    def from_user(cls, user):
+        names = [r.name for r in user.roles]
+        return cls(user.id, user.username, names, role=names[0] if names else None, email=user.email)
+
+    @classmethod
+    def from_claims(cls, identity, claims):
+        return cls(identity, claims.get('username'), claims['roles'], role=claims.get('role'),
+                   patient_id=claims.get('patient_id'))
+
+def lookup_patient_id(username):
+    """Find the patient linked to a Patient account, via PatientLogin or by name."""
+    patient_login = PatientLogin.query.filter_by(username=username).first()
+    if patient_login:
+        return patient_login.patient_id
+    # Fallback: try to find patient by name (username)
+    patient = Patient.query.filter_by(name=username).first()
+    return patient.id if patient else None
+
+def get_patient_id(user):
+    """Return the patient id for a Patient principal, preferring the token claim."""
+    if user.patient_id is not None:
+        return user.patient_id
+    return lookup_patient_id(user.username)
+
+def build_authz_claims(user):
+    """Claims signed into the access token so routes can authorize without the database."""
+    names = [r.name for r in user.roles]
+    claims = {
+        'username': user.username,
+        'role': names[0] if names else None,
+        'roles': names,
+        'ver': user.token_version or 0,
+    }
+    if 'Patient' in names:
+        claims['patient_id'] = lookup_patient_id(user.username)
+    return claims
+
+_token_versions = {}
+_token_versions_lock = threading.Lock()
+
+def current_token_version(user_id):
+    """Return the user's token version, cached in-process for TOKEN_VERSION_CACHE_SECONDS (0 disables the cache)."""
+    cache_seconds = app.config.get('TOKEN_VERSION_CACHE_SECONDS', 0)
+    if cache_seconds <= 0:
+        return db.session.query(User.token_version).filter(User.id == user_id).scalar()
+    now = time.monotonic()
+    with _token_versions_lock:
+        cached = _token_versions.get(user_id)
+    if cached and now - cached[1] < cache_seconds:
+        return cached[0]
+    version = db.session.query(User.token_version).filter(User.id == user_id).scalar()
+    with _token_versions_lock:
+        _token_versions[user_id] = (version, now)
+    return version
+
+def bump_token_version(user_id):
+    """Invalidate every token issued to a user whose claims may now be stale.
+
+    Only this worker's cached version is dropped; the others see the new one
+    once their TOKEN_VERSION_CACHE_SECONDS entry expires.
+    """
+    User.query.filter_by(id=user_id).update({User.token_version: User.token_version + 1})
+    with _token_versions_lock:
+        _token_versions.pop(user_id, None)
+
+@jwt.token_in_blocklist_loader
+def token_claims_are_stale(jwt_header, jwt_payload):
+    if 'ver' not in jwt_payload:
+        return False
+    return current_token_version(jwt_payload['sub']) != jwt_payload['ver']
+
+def get_current_principal():
+    """Return the Principal for the current JWT identity, loading it at most once per request."""
+    if 'principal' not in g:
+        claims = get_jwt()
+        if 'roles' in claims:
+            g.principal = Principal.from_claims(get_jwt_identity(), claims)
+        else:
+            user = db.session.get(User, get_jwt_identity(), options=[joinedload(User.roles)])
+            g.principal = Principal.from_user(user) if user else None
+    return g.principal
+
 # Helper function to check user role
 def has_role(user, role_name):
     if isinstance(role_name, list):
         # Handle multiple roles by checking if user has any of them
-        return Role.query.join(UserRole).filter(
-            UserRole.user_id == user.id, 
-            Role.name.in_(role_name)
-        ).first() is not None
+        return not user.role_names.isdisjoint(role_name)
+    return role_name in user.role_names
+
+
+def paginate_query(query, page, per_page):
+    """Paginate honouring ``?total=exact|estimate|none`` (default ``exact``)."""
+    total = request.args.get('total', 'exact')
+    if total not in TOTAL_MODES:
+        total = 'exact'
+    return paginate(query, page, per_page, total=total, cache_seconds=app.config.get('COUNT_CACHE_SECONDS', 60))
+
+
+# Transaction-scoped state
+# Work queued on session.info until commit (audit rows, rollup deltas, ...)
+# belongs to the transaction that queued it. Each feature lists its key in
+# TRANSACTION_STATE_KEYS: the keys are dropped when the outermost transaction
+# rolls back and put back as they were when a begin_nested() savepoint rolls
+# back, so the still-live outer transaction keeps what it queued earlier.
+# before_commit/after_commit also fire when a savepoint is released, so
+# handlers act only once session.in_nested_transaction() is false.
+TRANSACTION_STATE_KEYS = ['pending_audit']
+
+
+@event.listens_for(Session, 'after_transaction_create')
+def snapshot_transaction_state(session, transaction):
+    if transaction.nested:
+        session.info.setdefault('savepoint_state', {})[transaction] = {
+            key: copy.copy(session.info[key]) for key in TRANSACTION_STATE_KEYS if key in session.info
+        }
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_transaction_state(session, previous_transaction):
+    saved = session.info.get('savepoint_state', {}).pop(previous_transaction, None)
+    if previous_transaction.nested and saved is None:
+        return
+    for key in TRANSACTION_STATE_KEYS:
+        session.info.pop(key, None)
+    if previous_transaction.nested:
+        session.info.update(saved)
+    else:
+        session.info.pop('savepoint_state', None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def forget_savepoint_state(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('savepoint_state', None)
+
+
+# Audit trail
+# Entries are held on the session until the request's own transaction commits
+# and are then written by a background thread as one multi-row INSERT per
+# batch, so a mutating route pays for a single commit. AUDIT_STRICT=true adds
+# them to the session instead, making them part of the same transaction.
+def write_audit_rows(rows):
+    with app.app_context():
+        with db.engine.begin() as conn:
+            conn.execute(AuditLog.__table__.insert().values(rows))
+
+
+audit_sink = BatchWriter(
+    write_audit_rows,
+    max_queue=app.config.get('AUDIT_QUEUE_SIZE', 10000),
+    batch_size=app.config.get('AUDIT_BATCH_SIZE', 200),
+    flush_interval=app.config.get('AUDIT_FLUSH_INTERVAL', 1.0),
+    name='audit-sink',
+)
+
+
+def record_audit(action, user):
+    """Audit ``action`` by ``user``; it is written only if the current transaction commits."""
+    row = {'action': action, 'user': str(user), 'timestamp': datetime.now(timezone.utc)}
+    if app.config.get('AUDIT_STRICT'):
+        db.session.add(AuditLog(**row))
     else:
-        # Handle single role
-        return Role.query.join(UserRole).filter(
-            UserRole.user_id == user.id, 
-            Role.name == role_name
-        ).first() is not None
+        db.session.info.setdefault('pending_audit', []).append(row)
+
+
+@event.listens_for(Session, 'after_commit')
+def hand_audit_to_sink(session):
+    if session.in_nested_transaction():
+        return
+    for row in session.info.pop('pending_audit', ()):
+        audit_sink.submit(row)
+
+
+# Error log
+# Handlers report failures with record_error(), which never touches the
+# request's session: rows are queued (and dropped past ERROR_LOG_RATE, or when
+# the queue is full) and a background thread folds each batch into one row per
+# fingerprint, adding to the row already written for that fingerprint within
+# ERROR_LOG_DEDUP_WINDOW seconds instead of inserting a new one.
+def write_error_rows(rows):
+    grouped = {}
+    for row in rows:
+        seen = grouped.get(row['fingerprint'])
+        if seen:
+            seen['count'] += 1
+            seen['last_seen'] = row['last_seen']
+        else:
+            grouped[row['fingerprint']] = dict(row)
+    table = ErrorLog.__table__
+    window_start = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ERROR_LOG_DEDUP_WINDOW', 300))
+    with app.app_context():
+        with db.engine.begin() as conn:
+            inserts = []
+            for fingerprint, row in grouped.items():
+                latest = select(func.max(table.c.id)).where(
+                    table.c.fingerprint == fingerprint, table.c.timestamp >= window_start
+                ).scalar_subquery()
+                result = conn.execute(table.update().where(table.c.id == latest).values(
+                    count=table.c.count + row['count'], last_seen=row['last_seen']
+                ))
+                if result.rowcount == 0:
+                    inserts.append(row)
+            if inserts:
+                conn.execute(table.insert().values(inserts))
+
+
+error_sink = BatchWriter(
+    write_error_rows,
+    max_queue=app.config.get('ERROR_LOG_QUEUE_SIZE', 1000),
+    flush_interval=app.config.get('ERROR_LOG_FLUSH_INTERVAL', 2.0),
+    name='error-sink',
+    drop_when_full=True,
+)
+error_rate_limiter = RateLimiter(app.config.get('ERROR_LOG_RATE', 20), app.config.get('ERROR_LOG_BURST', 100))
+
+
+def record_error(message, user_id=None):
+    """Queue an ErrorLog entry without writing on the request thread."""
+    if not error_rate_limiter.allow():
+        logger.error(f"ErrorLog rate limit exceeded, not stored: {message}")
+        return
+    now = datetime.now(timezone.utc)
+    error_sink.submit({
+        'error_message': message,
+        'user_id': user_id,
+        'fingerprint': error_fingerprint(message),
+        'count': 1,
+        'timestamp': now,
+        'last_seen': now,
+    })
+
+
+# Unit of work
+def unit_of_work(view):
+    """Run ``view`` as one transaction with a single commit at the end.
+
+    The view stages its writes with ``db.session.add`` and returns. A 2xx/3xx
+    response is committed once; anything else, or an exception, rolls the
+    whole request back. Views that need a generated ID mid-request call
+    ``db.session.flush()``; ``db.session.begin_nested()`` gives a savepoint
+    for a step that may fail without abandoning the rest of the request.
+    Because the response is built before the commit, objects are serialized
+    without the reload ``expire_on_commit`` would otherwise force.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            raise
+        if response.status_code >= 400:
+            db.session.rollback()
+            return response
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            principal = g.get('principal')
+            record_error(str(e), principal.id if principal else None)
+            return jsonify({'message': 'Error saving changes'}), 500
+        return response
+    return wrapper
+
+
+def get_or_create_role(name):
+    """Return the Role called ``name``, inserting it in a savepoint if it does not exist yet.
+
+    A concurrent request creating the same role only rolls back the savepoint;
+    the caller's transaction carries on with the row that won.
+    """
+    role = Role.query.filter_by(name=name).first()
+    if role:
+        return role
+    try:
+        with db.session.begin_nested():
+            role = Role(name=name)
+            db.session.add(role)
+    except IntegrityError:
+        role = Role.query.filter_by(name=name).one()
+    return role
+
+
+# Patient search backends
+# SQLite keeps an external-content FTS5 index over patient(name, contact); the
+# triggers below update it whenever a patient row is inserted, updated or
+# deleted, so add_patient, update_patient and any other writer stay in sync.
+PATIENT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS patient_fts USING fts5("
+    "name, contact, content='patient', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ai AFTER INSERT ON patient BEGIN "
+    "INSERT INTO patient_fts(rowid, name, contact) VALUES (new.id, new.name, new.contact); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ad AFTER DELETE ON patient BEGIN "
+    "INSERT INTO patient_fts(patient_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_au AFTER UPDATE OF name, contact ON patient BEGIN "
+    "INSERT INTO patient_fts(patient_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact); "
+    "INSERT INTO patient_fts(rowid, name, contact) VALUES (new.id, new.name, new.contact); END",
+]
+# PostgreSQL serves ILIKE '%q%' from trigram GIN indexes, which it maintains itself.
+PATIENT_TRGM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patient_name_trgm ON patient USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patient_contact_trgm ON patient USING gin (contact gin_trgm_ops)",
+]
+
+for statement in PATIENT_FTS_DDL:
+    event.listen(Patient.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in PATIENT_TRGM_DDL:
+    event.listen(Patient.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+event.listen(Patient.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS patient_fts").execute_if(dialect='sqlite'))
+
+class PatientSearch:
+    """Unindexed substring search; used when no search index is available."""
+
+    def apply(self, query, q):
+        return query.filter(
+            (Patient.name.ilike(f'%{q}%')) |
+            (Patient.contact.ilike(f'%{q}%')) |
+            (Patient.id == q if q.isdigit() else False)
+        ).order_by(Patient.created_at.desc())
+
+class Fts5PatientSearch(PatientSearch):
+    """SQLite FTS5 prefix search over name and contact, ranked by bm25."""
+
+    def apply(self, query, q):
+        terms = re.findall(r'\w+', q)
+        if not terms:
+            return query.filter(false())
+        matches = text(
+            "SELECT patient_id, MIN(rank) AS rank FROM ("
+            "SELECT rowid AS patient_id, bm25(patient_fts) AS rank FROM patient_fts WHERE patient_fts MATCH :match "
+            "UNION ALL SELECT id, -1e9 FROM patient WHERE id = :exact_id"
+            ") GROUP BY patient_id"
+        ).bindparams(
+            match=' '.join('"%s"*' % term for term in terms),
+            exact_id=int(q) if q.isdigit() else None,
+        ).columns(patient_id=db.Integer, rank=db.Float).subquery('patient_match')
+        return query.join(matches, matches.c.patient_id == Patient.id).order_by(
+            matches.c.rank, Patient.created_at.desc()
+        )
+
+class TrigramPatientSearch(PatientSearch):
+    """PostgreSQL pg_trgm search: GIN-indexed ILIKE, ranked by similarity."""
+
+    def apply(self, query, q):
+        exact_id = Patient.id == q if q.isdigit() else False
+        similarity = func.greatest(
+            func.similarity(Patient.name, q),
+            func.similarity(func.coalesce(Patient.contact, ''), q),
+        )
+        return query.filter(
+            (Patient.name.ilike(f'%{q}%')) |
+            (Patient.contact.ilike(f'%{q}%')) |
+            exact_id
+        ).order_by(case((exact_id, 1), else_=0).desc(), similarity.desc(), Patient.created_at.desc())
+
+PATIENT_SEARCH_BACKENDS = {
+    'like': PatientSearch,
+    'fts5': Fts5PatientSearch,
+    'trgm': TrigramPatientSearch,
+}
+
+def get_patient_search():
+    """Pick the search backend from PATIENT_SEARCH_BACKEND, or by database dialect for ``auto``."""
+    name = app.config.get('PATIENT_SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+        name = {'sqlite': 'fts5', 'postgresql': 'trgm'}.get(db.engine.dialect.name, 'like')
+    return PATIENT_SEARCH_BACKENDS[name]()
 
 
 # Routes
@@ -524,6 +1041,7 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
 @app.route('/api/register', methods=['POST'])
+@unit_of_work
 def register():
     data = request.get_json()
     if not data or not data.get('username') or not data.get('password') or not data.get('role'):
@@ -536,12 +1054,8 @@ def register():
     try:
         user = User(username=username, password=generate_password_hash(password))
         db.session.add(user)
-        db.session.commit()
-        role_obj = Role.query.filter_by(name=role).first()
-        if not role_obj:
-            role_obj = Role(name=role)
-            db.session.add(role_obj)
-            db.session.commit()
+        db.session.flush()
+        role_obj = get_or_create_role(role)
         user_role = UserRole(user_id=user.id, role_id=role_obj.id)
         db.session.add(user_role)
         # If Patient, create Patient and PatientLogin
@@ -549,7 +1063,7 @@ def register():
             # Create Patient record
             patient = Patient(name=username, dob=datetime.now().date())
             db.session.add(patient)
-            db.session.commit()
+            db.session.flush()
             # Create PatientLogin
             patient_login = PatientLogin(
                 patient_id=patient.id,
@@ -557,16 +1071,11 @@ def register():
                 password=generate_password_hash(password)
             )
             db.session.add(patient_login)
-            db.session.commit()
-        audit_log = AuditLog(action='User registered', user=username)
-        db.session.add(audit_log)
-        db.session.commit()
+        record_audit('User registered', username)
         return jsonify({'message': 'User registered'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=None)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), None)
         return jsonify({'message': 'Error registering user'}), 500
 
 @app.route('/api/login', methods=['POST', 'OPTIONS'])
@@ -580,7 +1089,8 @@ def login():
     password = data.get('password')
     user = User.query.filter_by(username=username).first()
     if user and check_password_hash(user.password, password):
-        access_token = create_access_token(identity=user.id)
+        additional_claims = build_authz_claims(user) if app.config.get('JWT_AUTHZ_CLAIMS') else None
+        access_token = create_access_token(identity=user.id, additional_claims=additional_claims)
         return jsonify({
             'access_token': access_token,
             'user': {
@@ -596,39 +1106,60 @@ def login():
 @jwt_required()
 def get_audit_logs():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    def serialize(log):
+        return {'id': log.id, 'action': log.action, 'user': log.user, 'timestamp': log.timestamp.isoformat()}
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            logs, next_cursor = keyset_page(AuditLog.query, AuditLog.timestamp, AuditLog.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'message': 'Invalid cursor'}), 422
+        return jsonify({'logs': [serialize(log) for log in logs], 'next_cursor': next_cursor}), 200
+    logs = paginate_query(AuditLog.query.order_by(AuditLog.timestamp.desc()), page, per_page)
     return jsonify({
-        'logs': [{'id': log.id, 'action': log.action, 'user': log.user, 'timestamp': log.timestamp.isoformat()} for log in logs.items],
+        'logs': [serialize(log) for log in logs.items],
         'total': logs.total,
-        'pages': logs.pages
+        'pages': logs.pages,
+        'has_next': logs.has_next
     }), 200
 
 @app.route('/api/security-logs', methods=['GET'])
 @jwt_required()
 def get_security_logs():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'IT'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    logs = SecurityLog.query.order_by(SecurityLog.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    def serialize(log):
+        return {'id': log.id, 'event': log.event, 'user': log.user, 'status': log.status, 'timestamp': log.timestamp.isoformat()}
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            logs, next_cursor = keyset_page(SecurityLog.query, SecurityLog.timestamp, SecurityLog.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'message': 'Invalid cursor'}), 422
+        return jsonify({'logs': [serialize(log) for log in logs], 'next_cursor': next_cursor}), 200
+    logs = paginate_query(SecurityLog.query.order_by(SecurityLog.timestamp.desc()), page, per_page)
     return jsonify({
-        'logs': [{'id': log.id, 'event': log.event, 'user': log.user, 'status': log.status, 'timestamp': log.timestamp.isoformat()} for log in logs.items],
+        'logs': [serialize(log) for log in logs.items],
         'total': logs.total,
-        'pages': logs.pages
+        'pages': logs.pages,
+        'has_next': logs.has_next
     }), 200
 
 @app.route('/api/patients', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def add_patient():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Receptionist')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -643,7 +1174,7 @@ def add_patient():
             address=data.get('address')
         )
         db.session.add(patient)
-        db.session.commit()
+        db.session.flush()
         medical_record = MedicalRecord(
             patient_id=patient.id,
             doctor_id=user.id,
@@ -652,28 +1183,138 @@ def add_patient():
             allergies=data.get('allergies')
         )
         db.session.add(medical_record)
-        audit_log = AuditLog(action='Patient added', user=current_user)
-        db.session.add(audit_log)
-        db.session.commit()
+        record_audit('Patient added', current_user)
         return jsonify({'message': 'Patient added', 'id': patient.id}), 201
     except ValueError as ve:
         db.session.rollback()
-        error_log = ErrorLog(error_message=f'Invalid date format: {str(ve)}', user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(f'Invalid date format: {str(ve)}', user.id)
         return jsonify({'message': 'Invalid date format for dob'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error adding patient'}), 500
 
+def validate_patient_import(record):
+    """Check one imported row. Returns ``(patient, medical_record, errors)`` column dicts."""
+    if record is None:
+        return None, None, ['Not a JSON object']
+    errors = []
+
+    def field(name, max_length=None):
+        value = record.get(name)
+        value = str(value).strip() if value is not None else ''
+        if max_length and len(value) > max_length:
+            errors.append(f'{name} is longer than {max_length} characters')
+        return value or None
+
+    name = field('name', 100)
+    contact = field('contact', 50)
+    dob = field('dob')
+    if not name:
+        errors.append('name is required')
+    if not dob:
+        errors.append('dob is required')
+    else:
+        try:
+            dob = date.fromisoformat(dob)
+        except ValueError:
+            errors.append('dob must be YYYY-MM-DD')
+        else:
+            if dob > date.today():
+                errors.append('dob is in the future')
+    patient = {'name': name, 'dob': dob, 'contact': contact, 'address': field('address')}
+    medical_record = {'history': field('medical_history'), 'allergies': field('allergies')}
+    return patient, medical_record, errors
+
+
+def insert_patient_chunk(chunk, doctor_id):
+    """Insert validated ``(patient, medical_record)`` pairs with one multi-row INSERT per table."""
+    now = datetime.now(timezone.utc)
+    # render_nulls keeps rows with empty optional columns in the same statement
+    patient_ids = db.session.scalars(
+        insert(Patient).returning(Patient.id, sort_by_parameter_order=True).execution_options(render_nulls=True),
+        [dict(patient, created_at=now) for patient, _ in chunk],
+    ).all()
+    db.session.execute(insert(MedicalRecord).execution_options(render_nulls=True), [
+        dict(medical_record, patient_id=patient_id, doctor_id=doctor_id, diagnosis='Initial assessment', created_at=now)
+        for patient_id, (_, medical_record) in zip(patient_ids, chunk)
+    ])
+
+
+@app.route('/api/patients/bulk', methods=['POST'])
+@jwt_required()
+def import_patients():
+    """Import patients from a text/csv or application/x-ndjson body.
+
+    Rows are validated as they stream in and inserted PATIENT_IMPORT_CHUNK_SIZE
+    at a time, each chunk in its own transaction, so one bad row never
+    discards the rest. The response lists every rejected row.
+    """
+    user = get_current_principal()
+    if not user or not (has_role(user, 'Admin') or has_role(user, 'Receptionist')):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    if request.mimetype not in (CSV_MIMETYPE, NDJSON_MIMETYPE):
+        return jsonify({'message': f'Send {CSV_MIMETYPE} or {NDJSON_MIMETYPE}'}), 415
+
+    chunk_size = app.config.get('PATIENT_IMPORT_CHUNK_SIZE', 1000)
+    max_errors = app.config.get('PATIENT_IMPORT_MAX_ERRORS', 1000)
+    imported = 0
+    rejected = 0
+    errors = []
+    chunk = []
+    chunk_rows = []
+    row = 0
+
+    def reject(row, messages):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < max_errors:
+            errors.append({'row': row, 'errors': messages})
+
+    def flush():
+        nonlocal imported
+        try:
+            insert_patient_chunk(chunk, user.id)
+            db.session.commit()
+            imported += len(chunk)
+        except Exception as e:
+            db.session.rollback()
+            record_error(f'Patient import chunk failed: {str(e)}', user.id)
+            for row in chunk_rows:
+                reject(row, ['Could not be saved'])
+        chunk.clear()
+        chunk_rows.clear()
+
+    try:
+        for row, record in iter_uploaded_records():
+            patient, medical_record, messages = validate_patient_import(record)
+            if messages:
+                reject(row, messages)
+                continue
+            chunk.append((patient, medical_record))
+            chunk_rows.append(row)
+            if len(chunk) >= chunk_size:
+                flush()
+    except (csv.Error, UnicodeDecodeError) as e:
+        reject(row + 1, [f'Unreadable input, import stopped: {str(e)}'])
+    if chunk:
+        flush()
+
+    record_audit(f'Imported {imported} patients ({rejected} rows rejected)', user.username)
+    db.session.commit()
+    return jsonify({
+        'imported': imported,
+        'rejected': rejected,
+        'errors': errors,
+        'errors_truncated': rejected > len(errors),
+    }), 200
+
+
 @app.route('/api/patients', methods=['GET'])
 @jwt_required()
 def get_patients():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     # Allow Admin, Doctor, Nurse, Receptionist full access
@@ -684,38 +1325,54 @@ def get_patients():
         allowed_fields = ['id', 'name', 'dob', 'contact', 'address', 'created_at']
     else:
         return jsonify({'message': 'Unauthorized access'}), 403
+    etag = version_etag(request.full_path, allowed_fields, *collection_versions('patient'))
+    cached = not_modified(etag)
+    if cached:
+        return cached
     page = request.args.get('page', 1, type=int)
     per_page = 10
     q = request.args.get('q', '').strip()
     query = Patient.query
     if q:
-        query = query.filter(
-            (Patient.name.ilike(f'%{q}%')) |
-            (Patient.contact.ilike(f'%{q}%')) |
-            (Patient.id == q if q.isdigit() else False)
-        )
-    patients = query.order_by(Patient.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    return jsonify({
+        query = get_patient_search().apply(query, q)
+    else:
+        query = query.order_by(Patient.created_at.desc())
+    patients = paginate_query(query, page, per_page)
+    return with_etag(jsonify({
         'patients': [
             {k: getattr(p, k) if k != 'dob' and k != 'created_at' else (getattr(p, k).isoformat() if getattr(p, k) else None) for k in allowed_fields}
             for p in patients.items
         ],
         'total': patients.total,
-        'pages': patients.pages
-    }), 200
+        'pages': patients.pages,
+        'has_next': patients.has_next
+    }), etag), 200
 
 @app.route('/api/patients/<int:id>', methods=['GET'])
 @jwt_required()
 def get_patient(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin') and not has_role(user, 'Doctor'):
         return jsonify({'message': 'Unauthorized access'}), 403
+    # The patient's version and that of the medical record shown with it
+    first_record = select(func.min(MedicalRecord.id)).where(MedicalRecord.patient_id == id).scalar_subquery()
+    stamp = db.session.execute(
+        select(Patient.version, MedicalRecord.id, MedicalRecord.version)
+        .outerjoin(MedicalRecord, MedicalRecord.id == first_record)
+        .where(Patient.id == id)
+    ).first()
+    if not stamp:
+        return jsonify({'message': 'Patient not found'}), 404
+    etag = version_etag(request.path, *stamp)
+    cached = not_modified(etag)
+    if cached:
+        return cached
     patient = db.session.get(Patient, id)
     if not patient:
         return jsonify({'message': 'Patient not found'}), 404
-    medical_record = MedicalRecord.query.filter_by(patient_id=id).first()
-    return jsonify({
+    medical_record = MedicalRecord.query.filter_by(patient_id=id).order_by(MedicalRecord.id).first()
+    return with_etag(jsonify({
         'id': patient.id,
         'name': patient.name,
         'dob': patient.dob.isoformat(),
@@ -723,13 +1380,13 @@ def get_patient(id):
         'address': patient.address,
         'medical_history': medical_record.history if medical_record else None,
         'allergies': medical_record.allergies if medical_record else None
-    }), 200
+    }), etag), 200
 
 @app.route('/api/patients/<int:id>', methods=['PUT'])
 @jwt_required()
 def update_patient(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     patient = db.session.get(Patient, id)
@@ -742,23 +1399,19 @@ def update_patient(id):
         patient.name = data.get('name', patient.name)
         patient.contact = data.get('contact', patient.contact)
         patient.address = data.get('address', patient.address)
-        db.session.commit()
-        audit_log = AuditLog(action='Patient updated', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Patient updated', current_user)
         db.session.commit()
         return jsonify({'message': 'Patient updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating patient'}), 500
 
 @app.route('/api/appointments', methods=['POST'])
 @jwt_required()
 def schedule_appointment():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Receptionist')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -780,28 +1433,23 @@ def schedule_appointment():
             created_by=user.id
         )
         db.session.add(appointment)
-        audit_log = AuditLog(action='Appointment scheduled', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Appointment scheduled', current_user)
         db.session.commit()
         return jsonify({'message': 'Appointment scheduled'}), 201
     except ValueError as ve:
         db.session.rollback()
-        error_log = ErrorLog(error_message=f'Invalid date format: {str(ve)}', user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(f'Invalid date format: {str(ve)}', user.id)
         return jsonify({'message': 'Invalid date format for appointment_time'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error scheduling appointment'}), 500
 
 @app.route('/api/appointments', methods=['GET'])
 @jwt_required()
 def get_appointments():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     # Allow Admin, Doctor, Nurse, Receptionist full access
@@ -813,31 +1461,13 @@ def get_appointments():
     # Patient: only their own appointments (paginated)
     elif has_role(user, 'Patient'):
         allowed_fields = ['id', 'patient', 'date', 'doctor_id', 'reason', 'status', 'created_at']
-        # Try to find patient through PatientLogin first
-        patient_login = PatientLogin.query.filter_by(username=user.username).first()
-        patient_id = None
-        
-        if patient_login:
-            patient_id = patient_login.patient_id
-        else:
-            # Fallback: try to find patient by name (username)
-            patient = Patient.query.filter_by(name=user.username).first()
-            if patient:
-                patient_id = patient.id
-            else:
-                # If no patient found, return empty results instead of 403
-                return jsonify({
-                    'appointments': [],
-                    'total': 0,
-                    'pages': 0,
-                    'page': 1
-                }), 200
-        
+        patient_id = get_patient_id(user)
+        # If no patient found, return empty results instead of 403
         if patient_id:
             page = request.args.get('page', 1, type=int)
             per_page = 10
             query = Appointment.query.filter_by(patient=patient_id)
-            appointments = query.order_by(Appointment.date.desc()).paginate(page=page, per_page=per_page, error_out=False)
+            appointments = paginate_query(query.order_by(Appointment.date.desc()), page, per_page)
             return jsonify({
                 'appointments': [
                     {k: getattr(a, k) if k not in ['date', 'created_at'] else (getattr(a, k).isoformat() if getattr(a, k) else None) for k in allowed_fields}
@@ -845,6 +1475,7 @@ def get_appointments():
                 ],
                 'total': appointments.total,
                 'pages': appointments.pages,
+                'has_next': appointments.has_next,
                 'page': page
             }), 200
         else:
@@ -860,19 +1491,20 @@ def get_appointments():
     query = Appointment.query
     if patient_id:
         query = query.filter_by(patient=patient_id)
-    appointments = query.order_by(Appointment.date.desc()).all()
+    query = query.order_by(Appointment.date.desc())
+    def serialize(a):
+        return {k: getattr(a, k) if k not in ['date', 'created_at'] else (getattr(a, k).isoformat() if getattr(a, k) else None) for k in allowed_fields}
+    if wants_ndjson():
+        return ndjson_response(query, serialize)
     return jsonify({
-        'appointments': [
-            {k: getattr(a, k) if k not in ['date', 'created_at'] else (getattr(a, k).isoformat() if getattr(a, k) else None) for k in allowed_fields}
-            for a in appointments
-        ]
+        'appointments': [serialize(a) for a in query.all()]
     }), 200
 
 @app.route('/api/records', methods=['POST'])
 @jwt_required()
 def add_record():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Doctor'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -890,22 +1522,19 @@ def add_record():
             vital_signs=data.get('vital_signs')
         )
         db.session.add(record)
-        audit_log = AuditLog(action='Medical record added', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Medical record added', current_user)
         db.session.commit()
         return jsonify({'message': 'Record added'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error adding record'}), 500
 
 @app.route('/api/records', methods=['GET'])
 @jwt_required()
 def get_records():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     # Allow Admin, Doctor, Nurse, Lab Tech, Receptionist, Pharmacist full access/filtered
@@ -918,41 +1547,24 @@ def get_records():
         query = MedicalRecord.query
         if patient_id:
             query = query.filter_by(patient_id=patient_id)
-        records = query.order_by(MedicalRecord.created_at.desc()).all()
+        query = query.order_by(MedicalRecord.created_at.desc())
+        def serialize(r):
+            return {k: getattr(r, k) if k != 'created_at' else (getattr(r, k).isoformat() if getattr(r, k) else None) for k in allowed_fields}
+        if wants_ndjson():
+            return ndjson_response(query, serialize)
         return jsonify({
-            'records': [
-                {k: getattr(r, k) if k != 'created_at' else (getattr(r, k).isoformat() if getattr(r, k) else None) for k in allowed_fields}
-                for r in records
-            ]
+            'records': [serialize(r) for r in query.all()]
         }), 200
     # Patient: only their own records (paginated)
     elif has_role(user, 'Patient'):
         allowed_fields = ['id', 'patient_id', 'diagnosis', 'prescription', 'created_at']
-        # Try to find patient through PatientLogin first
-        patient_login = PatientLogin.query.filter_by(username=user.username).first()
-        patient_id = None
-        
-        if patient_login:
-            patient_id = patient_login.patient_id
-        else:
-            # Fallback: try to find patient by name (username)
-            patient = Patient.query.filter_by(name=user.username).first()
-            if patient:
-                patient_id = patient.id
-            else:
-                # If no patient found, return empty results instead of 403
-                return jsonify({
-                    'records': [],
-                    'total': 0,
-                    'pages': 0,
-                    'page': 1
-                }), 200
-        
+        patient_id = get_patient_id(user)
+        # If no patient found, return empty results instead of 403
         if patient_id:
             page = request.args.get('page', 1, type=int)
             per_page = 10
             query = MedicalRecord.query.filter_by(patient_id=patient_id)
-            records = query.order_by(MedicalRecord.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+            records = paginate_query(query.order_by(MedicalRecord.created_at.desc()), page, per_page)
             return jsonify({
                 'records': [
                     {k: getattr(r, k) if k != 'created_at' else (getattr(r, k).isoformat() if getattr(r, k) else None) for k in allowed_fields}
@@ -960,6 +1572,7 @@ def get_records():
                 ],
                 'total': records.total,
                 'pages': records.pages,
+                'has_next': records.has_next,
                 'page': page
             }), 200
         else:
@@ -978,7 +1591,7 @@ def get_records():
     query = MedicalRecord.query
     if patient_id:
         query = query.filter_by(patient_id=patient_id)
-    records = query.order_by(MedicalRecord.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    records = paginate_query(query.order_by(MedicalRecord.created_at.desc()), page, per_page)
     def filter_record(record):
         data = record.to_dict()
         if has_role(user, 'Nurse'):
@@ -998,6 +1611,7 @@ def get_records():
         'records': [filter_record(r) for r in records.items],
         'total': records.total,
         'pages': records.pages,
+        'has_next': records.has_next,
         'page': page
     }), 200
 
@@ -1005,7 +1619,7 @@ def get_records():
 @jwt_required()
 def create_bill():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Billing') or has_role(user, 'Accountant')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1021,22 +1635,19 @@ def create_bill():
             description=data.get('description')
         )
         db.session.add(bill)
-        audit_log = AuditLog(action='Bill created', user=user.username)
-        db.session.add(audit_log)
+        record_audit('Bill created', user.username)
         db.session.commit()
         return jsonify({'message': 'Bill created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating bill'}), 500
 
 @app.route('/api/bills/<int:id>', methods=['PUT'])
 @jwt_required()
 def update_bill(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     bill = db.session.get(Bill, id)
@@ -1047,54 +1658,32 @@ def update_bill(id):
         return jsonify({'message': 'Missing required field: payment_status'}), 422
     try:
         bill.payment_status = data.get('payment_status')
-        db.session.commit()
-        audit_log = AuditLog(action='Bill updated', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Bill updated', current_user)
         db.session.commit()
         return jsonify({'message': 'Bill updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating bill'}), 500
 
 @app.route('/api/bills', methods=['GET'])
 @jwt_required()
 def get_bills():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
     # Admin, Billing/Accountant: all bills
     if has_role(user, 'Admin') or has_role(user, 'Billing') or has_role(user, 'Accountant'):
-        bills = Bill.query.order_by(Bill.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+        bills = paginate_query(Bill.query.order_by(Bill.created_at.desc()), page, per_page)
     # Patient: only their own bills (paginated)
     elif has_role(user, 'Patient'):
-        # Try to find patient through PatientLogin first
-        patient_login = PatientLogin.query.filter_by(username=user.username).first()
-        patient_id = None
-        
-        if patient_login:
-            patient_id = patient_login.patient_id
-        else:
-            # Fallback: try to find patient by name (username)
-            patient = Patient.query.filter_by(name=user.username).first()
-            if patient:
-                patient_id = patient.id
-            else:
-                # If no patient found, return empty results instead of 403
-                return jsonify({
-                    'bills': [],
-                    'total': 0,
-                    'pages': 0,
-                    'page': page
-                }), 200
-        
+        patient_id = get_patient_id(user)
+        # If no patient found, return empty results instead of 403
         if patient_id:
-            bills = Bill.query.filter_by(patient_id=patient_id).order_by(Bill.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+            bills = paginate_query(Bill.query.filter_by(patient_id=patient_id).order_by(Bill.created_at.desc()), page, per_page)
         else:
             return jsonify({
                 'bills': [],
@@ -1108,6 +1697,7 @@ def get_bills():
         'bills': [b.to_dict() for b in bills.items],
         'total': bills.total,
         'pages': bills.pages,
+        'has_next': bills.has_next,
         'page': page
     }), 200
 
@@ -1115,7 +1705,7 @@ def get_bills():
 @jwt_required()
 def create_lab_order():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Doctor') or has_role(user, 'Lab Tech')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1129,25 +1719,24 @@ def create_lab_order():
             patient_id=patient.id,
             test_type=data.get('test_type'),
             status='Pending',
-            created_by=user.id
+            created_by=user.id,
+            created_at=datetime.now(timezone.utc)
         )
         db.session.add(lab_order)
-        audit_log = AuditLog(action='Lab order created', user=current_user)
-        db.session.add(audit_log)
+        bump_daily_rollup('lab_orders', lab_order.status, lab_order.created_at)
+        record_audit('Lab order created', current_user)
         db.session.commit()
         return jsonify({'message': 'Lab order created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating lab order'}), 500
 
 @app.route('/api/radiology-orders', methods=['POST'])
 @jwt_required()
 def create_radiology_order():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Doctor'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1164,42 +1753,46 @@ def create_radiology_order():
             created_by=user.id
         )
         db.session.add(radiology_order)
-        audit_log = AuditLog(action='Radiology order created', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Radiology order created', current_user)
         db.session.commit()
         return jsonify({'message': 'Radiology order created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating radiology order'}), 500
 
 @app.route('/api/employees', methods=['GET'])
 @jwt_required()
 def get_employees():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Receptionist')):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    employees = User.query.join(UserRole).join(Role).filter(Role.name.in_(['Doctor', 'Nurse', 'Admin', 'Lab Tech', 'IT'])).paginate(page=page, per_page=per_page, error_out=False)
+    # Roles for the whole page arrive in one SELECT ... IN, not one query per employee
+    query = User.query.options(selectinload(User.roles)).filter(
+        User.roles.any(Role.name.in_(['Doctor', 'Nurse', 'Admin', 'Lab Tech', 'IT']))
+    ).order_by(User.id)
+    employees = paginate_query(query, page, per_page)
     return jsonify({
         'employees': [{
             'id': emp.id,
             'username': emp.username,
-            'role': Role.query.join(UserRole).filter(UserRole.user_id == emp.id).first().name
+            'role': emp.role,
+            'roles': [r.name for r in emp.roles]
         } for emp in employees.items],
         'total': employees.total,
-        'pages': employees.pages
+        'pages': employees.pages,
+        'has_next': employees.has_next
     }), 200
 
 @app.route('/api/employees', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def create_employee():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1231,30 +1824,23 @@ def create_employee():
             password=generate_password_hash(data.get('password'))
         )
         db.session.add(employee)
-        db.session.commit()
-        role = Role.query.filter_by(name=data.get('role')).first()
-        if not role:
-            role = Role(name=data.get('role'))
-            db.session.add(role)
-            db.session.commit()
+        db.session.flush()
+        role = get_or_create_role(data.get('role'))
         user_role = UserRole(user_id=employee.id, role_id=role.id)
         db.session.add(user_role)
-        audit_log = AuditLog(action='Employee created', user=current_user)
-        db.session.add(audit_log)
-        db.session.commit()
+        record_audit('Employee created', current_user)
         return jsonify({'message': 'Employee created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating employee'}), 500
 
 @app.route('/api/employees/<int:id>', methods=['PUT'])
 @jwt_required()
+@unit_of_work
 def update_employee(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     employee = db.session.get(User, id)
@@ -1267,40 +1853,32 @@ def update_employee(id):
         employee.username = data.get('username', employee.username)
         if data.get('password'):
             employee.password = generate_password_hash(data.get('password'))
-        db.session.commit()
         if data.get('role'):
-            role = Role.query.filter_by(name=data.get('role')).first()
-            if not role:
-                role = Role(name=data.get('role'))
-                db.session.add(role)
-                db.session.commit()
+            role = get_or_create_role(data.get('role'))
             user_role = UserRole.query.filter_by(user_id=id).first()
             if user_role:
                 user_role.role_id = role.id
             else:
                 user_role = UserRole(user_id=id, role_id=role.id)
                 db.session.add(user_role)
-        audit_log = AuditLog(action='Employee updated', user=current_user)
-        db.session.add(audit_log)
-        db.session.commit()
+        bump_token_version(employee.id)
+        record_audit('Employee updated', current_user)
         return jsonify({'message': 'Employee updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating employee'}), 500
 
 @app.route('/api/finance/expenses', methods=['GET'])
 @jwt_required()
 def get_finance_expenses():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    expenses = Payroll.query.filter(Payroll.deductions > 0).paginate(page=page, per_page=per_page, error_out=False)
+    expenses = paginate_query(Payroll.query.filter(Payroll.deductions > 0), page, per_page)
     return jsonify({
         'expenses': [{
             'id': exp.id,
@@ -1309,19 +1887,20 @@ def get_finance_expenses():
             'description': 'Payroll deduction'
         } for exp in expenses.items],
         'total': expenses.total,
-        'pages': expenses.pages
+        'pages': expenses.pages,
+        'has_next': expenses.has_next
     }), 200
 
 @app.route('/api/finance/reimbursements', methods=['GET'])
 @jwt_required()
 def get_finance_reimbursements():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    reimbursements = Payroll.query.filter(Payroll.bonus > 0).paginate(page=page, per_page=per_page, error_out=False)
+    reimbursements = paginate_query(Payroll.query.filter(Payroll.bonus > 0), page, per_page)
     return jsonify({
         'reimbursements': [{
             'id': r.id,
@@ -1330,19 +1909,20 @@ def get_finance_reimbursements():
             'description': 'Payroll bonus'
         } for r in reimbursements.items],
         'total': reimbursements.total,
-        'pages': reimbursements.pages
+        'pages': reimbursements.pages,
+        'has_next': reimbursements.has_next
     }), 200
 
 @app.route('/api/finance/payroll', methods=['GET'])
 @jwt_required()
 def get_finance_payroll():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    payroll = Payroll.query.paginate(page=page, per_page=per_page, error_out=False)
+    payroll = paginate_query(Payroll.query, page, per_page)
     return jsonify({
         'payroll': [{
             'id': p.id,
@@ -1354,14 +1934,163 @@ def get_finance_payroll():
             'period_end': p.period_end.isoformat()
         } for p in payroll.items],
         'total': payroll.total,
-        'pages': payroll.pages
+        'pages': payroll.pages,
+        'has_next': payroll.has_next
+    }), 200
+
+
+# Finance summary
+# Payroll is summed in SQL per month or year of period_start (and per
+# employee when asked for). A period's sums are kept in-process once it is
+# closed, i.e. FINANCE_CLOSE_AFTER_DAYS past its end, so only the open
+# periods are read from the database again.
+FINANCE_INTERVALS = ('month', 'year')
+FINANCE_GROUPS = ('period', 'employee', 'type')
+FINANCE_TYPES = ('salary', 'bonus', 'deductions')
+FINANCE_MAX_PERIODS = 240
+
+_finance_totals = {}
+_finance_totals_lock = threading.Lock()
+
+
+def finance_period_start(day, interval):
+    return day.replace(month=1, day=1) if interval == 'year' else day.replace(day=1)
+
+
+def next_finance_period(start, interval):
+    if interval == 'year':
+        return start.replace(year=start.year + 1)
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def finance_period_label(start, interval):
+    return start.strftime('%Y' if interval == 'year' else '%Y-%m')
+
+
+def query_finance_totals(start, end, interval, by_employee):
+    """Sum payroll with ``start <= period_start < end`` per period (and employee) with one GROUP BY."""
+    keys = [func.extract('year', Payroll.period_start)]
+    if interval == 'month':
+        keys.append(func.extract('month', Payroll.period_start))
+    if by_employee:
+        keys += [Payroll.user_id, User.username]
+    query = select(
+        *keys,
+        func.count(),
+        func.sum(Payroll.salary),
+        func.sum(func.coalesce(Payroll.bonus, 0)),
+        func.sum(func.coalesce(Payroll.deductions, 0)),
+    ).where(Payroll.period_start >= start, Payroll.period_start < end).group_by(*keys)
+    if by_employee:
+        query = query.join(User, User.id == Payroll.user_id)
+    totals = {}
+    for row in db.session.execute(query):
+        row = list(row)
+        year = int(row.pop(0))
+        month = int(row.pop(0)) if interval == 'month' else 1
+        user_id, username = (row.pop(0), row.pop(0)) if by_employee else (None, None)
+        entries, salary, bonus, deductions = row
+        totals.setdefault(date(year, month, 1), []).append({
+            'user_id': user_id,
+            'username': username,
+            'entries': entries,
+            'salary': salary or 0,
+            'bonus': bonus or 0,
+            'deductions': deductions or 0,
+        })
+    return totals
+
+
+def finance_totals(first, last, interval, by_employee):
+    """Payroll sums for each period from ``first`` to ``last``, reading closed periods from the cache."""
+    periods = [first]
+    while periods[-1] < last:
+        periods.append(next_finance_period(periods[-1], interval))
+    # Keyed by database too, so a worker pointed at another database never sees these
+    scope = (str(db.engine.url), interval, by_employee)
+    with _finance_totals_lock:
+        totals = {start: _finance_totals[scope + (start,)] for start in periods if scope + (start,) in _finance_totals}
+    missing = [start for start in periods if start not in totals]
+    if missing:
+        fetched = query_finance_totals(missing[0], next_finance_period(missing[-1], interval), interval, by_employee)
+        closed_before = datetime.now(timezone.utc).date() - timedelta(days=app.config.get('FINANCE_CLOSE_AFTER_DAYS', 7))
+        with _finance_totals_lock:
+            for start in missing:
+                totals[start] = fetched.get(start, [])
+                if next_finance_period(start, interval) <= closed_before:
+                    _finance_totals[scope + (start,)] = totals[start]
+    return totals
+
+
+@app.route('/api/finance/summary', methods=['GET'])
+@jwt_required()
+def get_finance_summary():
+    """Payroll salary, bonus and deduction totals grouped by period, employee and/or type"""
+    user = get_current_principal()
+    if not user or not has_role(user, 'Admin'):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    interval = request.args.get('interval', 'month')
+    if interval not in FINANCE_INTERVALS:
+        return jsonify({'message': 'interval must be month or year'}), 422
+    group_by = [group for group in request.args.get('group_by', 'period').split(',') if group]
+    if not group_by or any(group not in FINANCE_GROUPS for group in group_by):
+        return jsonify({'message': 'group_by must list period, employee and/or type'}), 422
+    period_format = '%Y' if interval == 'year' else '%Y-%m'
+    try:
+        if request.args.get('to'):
+            last = datetime.strptime(request.args['to'], period_format).date()
+        else:
+            last = finance_period_start(datetime.now(timezone.utc).date(), interval)
+        # Default to the year to date, or to the current year alone for interval=year
+        first = datetime.strptime(request.args['from'], period_format).date() if request.args.get('from') else last.replace(month=1)
+    except ValueError:
+        return jsonify({'message': f"from and to must be {'YYYY' if interval == 'year' else 'YYYY-MM'}"}), 422
+    if first > last:
+        return jsonify({'message': 'from must not be after to'}), 422
+    span = last.year - first.year + 1 if interval == 'year' else (last.year - first.year) * 12 + last.month - first.month + 1
+    if span > FINANCE_MAX_PERIODS:
+        return jsonify({'message': f'At most {FINANCE_MAX_PERIODS} periods per request'}), 422
+
+    groups = {}
+    for start, rows in finance_totals(first, last, interval, 'employee' in group_by).items():
+        for row in rows:
+            key = ()
+            if 'period' in group_by:
+                key += (('period', finance_period_label(start, interval)),)
+            if 'employee' in group_by:
+                key += (('user_id', row['user_id']), ('username', row['username']))
+            group = groups.setdefault(key, {'entries': 0, 'salary': 0, 'bonus': 0, 'deductions': 0})
+            for field in ('entries',) + FINANCE_TYPES:
+                group[field] += row[field]
+
+    def amounts(sums):
+        values = {kind: round(float(sums[kind]), 2) for kind in FINANCE_TYPES}
+        values['net'] = round(float(sums['salary'] + sums['bonus'] - sums['deductions']), 2)
+        return values
+
+    overall = {'entries': 0, 'salary': 0, 'bonus': 0, 'deductions': 0}
+    results = []
+    for key, sums in sorted(groups.items()):
+        for field in overall:
+            overall[field] += sums[field]
+        if 'type' in group_by:
+            results.extend({**dict(key), 'type': kind, 'amount': round(float(sums[kind]), 2)} for kind in FINANCE_TYPES)
+        else:
+            results.append({**dict(key), 'entries': sums['entries'], **amounts(sums)})
+    return jsonify({
+        'interval': interval,
+        'from': finance_period_label(first, interval),
+        'to': finance_period_label(last, interval),
+        'group_by': group_by,
+        'totals': {'entries': overall['entries'], **amounts(overall)},
+        'groups': results,
     }), 200
 
 @app.route('/api/finance/expenses', methods=['POST'])
 @jwt_required()
 def create_expense():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1376,28 +2105,25 @@ def create_expense():
             period_end=datetime.now(timezone.utc).date()
         )
         db.session.add(payroll)
-        audit_log = AuditLog(action='Expense created', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Expense created', current_user)
         db.session.commit()
         return jsonify({'message': 'Expense created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating expense'}), 500
 
 @app.route('/api/inventory', methods=['GET'])
 @jwt_required()
 def get_inventory():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, ['Admin', 'Pharmacist']):
         return jsonify({'message': 'Unauthorized access'}), 403
     try:
         page = request.args.get('page', 1, type=int)
         per_page = 10
-        inventory = SuppliesInventory.query.paginate(page=page, per_page=per_page, error_out=False)
+        inventory = paginate_query(SuppliesInventory.query, page, per_page)
         return jsonify({
             'items': [{
                 'id': item.id,
@@ -1406,19 +2132,18 @@ def get_inventory():
                 'last_updated': item.last_updated.isoformat()
             } for item in inventory.items],
             'total': inventory.total,
-            'pages': inventory.pages
+            'pages': inventory.pages,
+            'has_next': inventory.has_next
         }), 200
     except Exception as e:
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error fetching inventory'}), 500
 
 @app.route('/api/inventory', methods=['POST'])
 @jwt_required()
 def create_inventory():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1430,22 +2155,19 @@ def create_inventory():
             quantity=data.get('quantity')
         )
         db.session.add(item)
-        audit_log = AuditLog(action='Inventory item created', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Inventory item created', current_user)
         db.session.commit()
         return jsonify({'message': 'Inventory item created'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating inventory item'}), 500
 
 @app.route('/api/inventory/<int:id>', methods=['PUT'])
 @jwt_required()
 def update_inventory(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     item = db.session.get(SuppliesInventory, id)
@@ -1458,23 +2180,20 @@ def update_inventory(id):
         item.item_name = data.get('item_name', item.item_name)
         item.quantity = data.get('quantity', item.quantity)
         item.last_updated = datetime.now(timezone.utc)
-        db.session.commit()
-        audit_log = AuditLog(action='Inventory item updated', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Inventory item updated', current_user)
         db.session.commit()
         return jsonify({'message': 'Inventory item updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating inventory item'}), 500
 
 @app.route('/api/inventory/dispense', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def dispense_medication():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Pharmacist')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1517,23 +2236,18 @@ def dispense_medication():
         
         item.quantity -= quantity
         item.last_updated = datetime.now(timezone.utc)
-        db.session.commit()
-        audit_log = AuditLog(action='Medication dispensed', user=user.username)
-        db.session.add(audit_log)
-        db.session.commit()
+        record_audit('Medication dispensed', user.username)
         return jsonify({'message': 'Medication dispensed'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error dispensing medication'}), 500
 
 @app.route('/api/medications', methods=['POST'])
 @jwt_required()
 def create_medication():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, ['Admin', 'Doctor', 'Nurse', 'Pharmacist']):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1553,22 +2267,19 @@ def create_medication():
             description=description
         )
         db.session.add(medication)
-        audit_log = AuditLog(action=f'Medication created: {name}', user=user.username)
-        db.session.add(audit_log)
+        record_audit(f'Medication created: {name}', user.username)
         db.session.commit()
         return jsonify({'message': 'Medication created successfully'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating medication'}), 500
 
 @app.route('/api/lab-samples', methods=['POST'])
 @jwt_required()
 def create_sample():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Lab Tech'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1586,33 +2297,28 @@ def create_sample():
             collected_by=user.id
         )
         db.session.add(sample)
-        audit_log = AuditLog(action='Lab sample created', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Lab sample created', current_user)
         db.session.commit()
         return jsonify({'message': 'Lab sample created'}), 201
     except ValueError as ve:
         db.session.rollback()
-        error_log = ErrorLog(error_message=f'Invalid date format: {str(ve)}', user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(f'Invalid date format: {str(ve)}', user.id)
         return jsonify({'message': 'Invalid date format for collection_time'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating lab sample'}), 500
 
 @app.route('/api/shifts', methods=['GET'])
 @jwt_required()
 def get_shifts():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    shifts = Schedule.query.paginate(page=page, per_page=per_page, error_out=False)
+    shifts = paginate_query(Schedule.query, page, per_page)
     return jsonify({
         'shifts': [{
             'id': shift.id,
@@ -1622,14 +2328,15 @@ def get_shifts():
             'shift_type': shift.shift_type
         } for shift in shifts.items],
         'total': shifts.total,
-        'pages': shifts.pages
+        'pages': shifts.pages,
+        'has_next': shifts.has_next
     }), 200
 
 @app.route('/api/shifts', methods=['POST'])
 @jwt_required()
 def create_shift():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1648,38 +2355,39 @@ def create_shift():
             shift_type=data.get('shift_type')
         )
         db.session.add(shift)
-        audit_log = AuditLog(action='Shift created', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Shift created', current_user)
         db.session.commit()
         return jsonify({'message': 'Shift created'}), 201
     except ValueError as ve:
         db.session.rollback()
-        error_log = ErrorLog(error_message=f'Invalid date format: {str(ve)}', user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(f'Invalid date format: {str(ve)}', user.id)
         return jsonify({'message': 'Invalid date format for start_time or end_time'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error creating shift'}), 500
 
 @app.route('/api/settings', methods=['GET'])
 @jwt_required()
 def get_settings():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
-    settings = Communication.query.first() or Communication()
-    return jsonify(settings.to_dict()), 200
+    etag = version_etag(request.path, *(db.session.execute(
+        select(Communication.id, Communication.version).order_by(Communication.id).limit(1)
+    ).first() or ()))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    settings = Communication.query.order_by(Communication.id).first() or Communication()
+    return with_etag(jsonify(settings.to_dict()), etag), 200
 
 @app.route('/api/settings', methods=['PUT'])
 @jwt_required()
 def update_settings():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1692,42 +2400,44 @@ def update_settings():
         settings.chat = data.get('chat', settings.chat)
         settings.updated_at = datetime.now(timezone.utc)
         db.session.add(settings)
-        audit_log = AuditLog(action='Settings updated', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Settings updated', current_user)
         db.session.commit()
         return jsonify({'message': 'Settings updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating settings'}), 500
 
 @app.route('/api/users/roles', methods=['GET'])
 @jwt_required()
 def get_user_roles():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    roles = UserRole.query.paginate(page=page, per_page=per_page, error_out=False)
+    query = db.session.query(UserRole.id, UserRole.user_id, Role.name).join(
+        Role, Role.id == UserRole.role_id
+    ).order_by(UserRole.id)
+    roles = paginate_query(query, page, per_page)
     return jsonify({
         'roles': [{
             'id': role.id,
             'user_id': role.user_id,
-            'role': Role.query.get(role.role_id).name
+            'role': role.name
         } for role in roles.items],
         'total': roles.total,
-        'pages': roles.pages
+        'pages': roles.pages,
+        'has_next': roles.has_next
     }), 200
 
 @app.route('/api/users/roles', methods=['PUT'])
 @jwt_required()
+@unit_of_work
 def update_user_role():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1737,39 +2447,37 @@ def update_user_role():
         user_role = UserRole.query.filter_by(user_id=data.get('user_id')).first()
         if not user_role:
             return jsonify({'message': 'User role not found'}), 404
-        role = Role.query.filter_by(name=data.get('role')).first()
-        if not role:
-            role = Role(name=data.get('role'))
-            db.session.add(role)
-            db.session.commit()
+        role = get_or_create_role(data.get('role'))
         user_role.role_id = role.id
-        db.session.commit()
-        audit_log = AuditLog(action='User role updated', user=current_user)
-        db.session.add(audit_log)
-        db.session.commit()
+        bump_token_version(user_role.user_id)
+        record_audit('User role updated', current_user)
         return jsonify({'message': 'User role updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating user role'}), 500
 
+def read_vitals_fields(data):
+    """``(patient_id, blood_pressure, temperature, pulse, respiration)``, accepting the field name variations clients send."""
+    return (
+        data.get('patient_id') or data.get('patientId'),
+        data.get('blood_pressure') or data.get('bloodPressure') or data.get('bp'),
+        data.get('temperature') or data.get('temp'),
+        data.get('pulse') or data.get('heart_rate') or data.get('heartRate'),
+        data.get('respiration') or data.get('respiratory_rate') or data.get('respiratoryRate'),
+    )
+
+
 @app.route('/api/vitals', methods=['POST'])
 @jwt_required()
 def create_vitals():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, ['Nurse', 'Doctor', 'Admin']):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
     
-    # Handle different field name variations
-    patient_id = data.get('patient_id') or data.get('patientId')
-    blood_pressure = data.get('blood_pressure') or data.get('bloodPressure') or data.get('bp')
-    temperature = data.get('temperature') or data.get('temp')
-    pulse = data.get('pulse') or data.get('heart_rate') or data.get('heartRate')
-    respiration = data.get('respiration') or data.get('respiratory_rate') or data.get('respiratoryRate')
+    patient_id, blood_pressure, temperature, pulse, respiration = read_vitals_fields(data or {})
     
     if not data or not patient_id:
         return jsonify({'message': 'Missing required field: patient_id'}), 422
@@ -1779,49 +2487,284 @@ def create_vitals():
         if not patient:
             return jsonify({'message': 'Patient not found'}), 404
             
+        blood_pressure = blood_pressure or '120/80'
+        systolic, diastolic = split_blood_pressure(blood_pressure)
         vitals = Vitals(
             patient_id=patient.id,
-            blood_pressure=blood_pressure or '120/80',
-            temperature=float(temperature) if temperature else 98.6,
+            blood_pressure=blood_pressure,
+            systolic=systolic,
+            diastolic=diastolic,
+            temperature=float(temperature) if temperature else 37.0,
             pulse=int(pulse) if pulse else 70,
             respiration=int(respiration) if respiration else 16,
-            recorded_by=user.id
+            recorded_by=user.id,
+            recorded_at=datetime.now(timezone.utc)
         )
         db.session.add(vitals)
-        audit_log = AuditLog(action=f'Vitals recorded for Patient #{patient_id}', user=user.username)
-        db.session.add(audit_log)
+        apply_vitals_rollups([{
+            'patient_id': vitals.patient_id, 'recorded_at': vitals.recorded_at, 'systolic': systolic,
+            'diastolic': diastolic, 'temperature': vitals.temperature, 'pulse': vitals.pulse,
+            'respiration': vitals.respiration,
+        }])
+        record_audit(f'Vitals recorded for Patient #{patient_id}', user.username)
         db.session.commit()
         return jsonify({'message': 'Vitals recorded successfully'}), 201
     except ValueError:
         return jsonify({'message': 'Invalid data format for vital signs'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error recording vitals'}), 500
 
+# Temperature is in °C, as the triage and vitals screens send it
+VITALS_LIMITS = {'temperature': (25, 45), 'pulse': (1, 300), 'respiration': (1, 100)}
+
+
+def validate_vitals_batch(readings, recorded_by):
+    """Check every reading in one pass. Returns ``(rows, errors)``.
+
+    Patient ids are checked with a single IN query for the whole batch
+    rather than a lookup per reading.
+    """
+    now = datetime.now(timezone.utc)
+    latest_allowed = now + timedelta(minutes=5)
+    candidates = []
+    errors = []
+    for index, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            errors.append({'index': index, 'errors': ['Not a JSON object']})
+            continue
+        patient_id, blood_pressure, temperature, pulse, respiration = read_vitals_fields(reading)
+        problems = []
+        row = {'recorded_by': recorded_by, 'recorded_at': now}
+        try:
+            row['patient_id'] = int(patient_id)
+        except (TypeError, ValueError):
+            problems.append('patient_id is required')
+        # Like POST /api/vitals: missing means 120/80, and free text is kept without systolic/diastolic
+        blood_pressure = blood_pressure or '120/80'
+        row['systolic'], row['diastolic'] = split_blood_pressure(blood_pressure)
+        if row['systolic'] is not None:
+            row['blood_pressure'] = f"{row['systolic']}/{row['diastolic']}"
+        else:
+            row['blood_pressure'] = str(blood_pressure)
+        for name, value, cast in (('temperature', temperature, float), ('pulse', pulse, int), ('respiration', respiration, int)):
+            low, high = VITALS_LIMITS[name]
+            try:
+                row[name] = cast(value)
+            except (TypeError, ValueError):
+                problems.append(f'{name} is required and must be a number')
+                continue
+            if not low <= row[name] <= high:
+                problems.append(f'{name} must be between {low} and {high}')
+        if reading.get('recorded_at'):
+            try:
+                recorded_at = datetime.fromisoformat(str(reading['recorded_at']).replace('Z', '+00:00'))
+            except ValueError:
+                problems.append('recorded_at must be an ISO 8601 timestamp')
+            else:
+                recorded_at = as_utc(recorded_at).astimezone(timezone.utc)
+                if recorded_at > latest_allowed:
+                    problems.append('recorded_at is in the future')
+                row['recorded_at'] = recorded_at
+        if problems:
+            errors.append({'index': index, 'errors': problems})
+        else:
+            candidates.append((index, row))
+
+    patient_ids = {row['patient_id'] for _, row in candidates}
+    known = set(db.session.scalars(select(Patient.id).where(Patient.id.in_(patient_ids)))) if patient_ids else set()
+    rows = []
+    for index, row in candidates:
+        if row['patient_id'] in known:
+            rows.append(row)
+        else:
+            errors.append({'index': index, 'errors': ['Patient not found']})
+    errors.sort(key=lambda error: error['index'])
+    return rows, errors
+
+
+@app.route('/api/vitals/batch', methods=['POST'])
+@jwt_required()
+@unit_of_work
+def create_vitals_batch():
+    """Record many readings at once from a JSON array ({"readings": [...]} also works) or NDJSON.
+
+    Valid readings are stored with one multi-row INSERT and one audit entry;
+    the rest are reported by their position in the batch.
+    """
+    user = get_current_principal()
+    if not user or not has_role(user, ['Nurse', 'Doctor', 'Admin']):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    limit = app.config.get('VITALS_BATCH_MAX_READINGS', 10000)
+    if request.mimetype == NDJSON_MIMETYPE:
+        readings = []
+        for _, reading in iter_uploaded_records():
+            if len(readings) >= limit:
+                return jsonify({'message': f'A batch may hold at most {limit} readings'}), 413
+            readings.append(reading)
+    else:
+        data = request.get_json(silent=True)
+        readings = data.get('readings') if isinstance(data, dict) else data
+        if not isinstance(readings, list):
+            return jsonify({'message': 'Send a JSON array of readings or application/x-ndjson'}), 422
+        if len(readings) > limit:
+            return jsonify({'message': f'A batch may hold at most {limit} readings'}), 413
+
+    rows, errors = validate_vitals_batch(readings, user.id)
+    if rows:
+        db.session.execute(insert(Vitals), rows)
+        apply_vitals_rollups(rows)
+        patients = len({row['patient_id'] for row in rows})
+        record_audit(f'Vitals batch recorded: {len(rows)} readings for {patients} patients', user.username)
+    return jsonify({
+        'accepted': len(rows),
+        'rejected': len(errors),
+        'errors': errors,
+    }), 201 if rows else 422
+
+
+def vitals_rollup_deltas(readings):
+    """Aggregate ``readings`` (dicts with patient_id, recorded_at and the metrics) per hourly and daily bucket."""
+    buckets = {}
+    for reading in readings:
+        recorded_at = as_utc(reading['recorded_at']).astimezone(timezone.utc).replace(tzinfo=None)
+        starts = {
+            'hour': recorded_at.replace(minute=0, second=0, microsecond=0),
+            'day': recorded_at.replace(hour=0, minute=0, second=0, microsecond=0),
+        }
+        for resolution, bucket_start in starts.items():
+            key = (reading['patient_id'], resolution, bucket_start)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {'patient_id': key[0], 'resolution': resolution, 'bucket_start': bucket_start,
+                                         'count': 0, 'bp_count': 0}
+                for metric in VITALS_METRICS:
+                    bucket.update({f'{metric}_sum': None, f'{metric}_min': None, f'{metric}_max': None})
+            bucket['count'] += 1
+            if reading.get('systolic') is not None:
+                bucket['bp_count'] += 1
+            for metric in VITALS_METRICS:
+                value = reading.get(metric)
+                if value is None:
+                    continue
+                value = float(value) if metric == 'temperature' else int(value)
+                bucket[f'{metric}_sum'] = (bucket[f'{metric}_sum'] or 0) + value
+                if bucket[f'{metric}_min'] is None or value < bucket[f'{metric}_min']:
+                    bucket[f'{metric}_min'] = value
+                if bucket[f'{metric}_max'] is None or value > bucket[f'{metric}_max']:
+                    bucket[f'{metric}_max'] = value
+    return list(buckets.values())
+
+
+def apply_vitals_rollups(readings):
+    """Fold new readings into vitals_rollup in the current transaction, one upsert per touched bucket."""
+    deltas = vitals_rollup_deltas(readings)
+    if not deltas:
+        return
+    table = VitalsRollup.__table__
+    upsert = (postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert)(table)
+    new, old = upsert.excluded, table.c
+    changes = {'count': old.count + new.count, 'bp_count': old.bp_count + new.bp_count}
+    for metric in VITALS_METRICS:
+        total, low, high = f'{metric}_sum', f'{metric}_min', f'{metric}_max'
+        changes[total] = case((new[total].is_(None), old[total]), else_=func.coalesce(old[total], 0) + new[total])
+        changes[low] = case((or_(old[low].is_(None), new[low] < old[low]), new[low]), else_=old[low])
+        changes[high] = case((or_(old[high].is_(None), new[high] > old[high]), new[high]), else_=old[high])
+    db.session.execute(
+        upsert.on_conflict_do_update(index_elements=['patient_id', 'resolution', 'bucket_start'], set_=changes),
+        deltas,
+    )
+
+
+@app.cli.command('rebuild-vitals-rollups')
+@click.option('--batch-size', default=5000, show_default=True, help='Readings folded in per upsert.')
+def rebuild_vitals_rollups(batch_size):
+    """Recompute vitals_rollup from the vitals table, e.g. after importing readings directly."""
+    db.session.execute(delete(VitalsRollup))
+    columns = (Vitals.patient_id, Vitals.recorded_at) + tuple(getattr(Vitals, metric) for metric in VITALS_METRICS)
+    result = db.session.execute(select(*columns).execution_options(yield_per=batch_size))
+    total = 0
+    for partition in result.mappings().partitions():
+        apply_vitals_rollups(partition)
+        total += len(partition)
+    db.session.commit()
+    click.echo(f'Rolled up {total} vitals readings')
+
+
+@app.route('/api/patients/<int:id>/vitals', methods=['GET'])
+@jwt_required()
+def get_patient_vitals(id):
+    """Vitals trend for one patient: raw readings, or hourly/daily min/max/mean from the rollups"""
+    user = get_current_principal()
+    if not user or not has_role(user, ['Nurse', 'Doctor', 'Admin']):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in ('raw',) + VITALS_RESOLUTIONS:
+        return jsonify({'message': 'resolution must be raw, hour or day'}), 422
+    try:
+        end = as_utc(datetime.fromisoformat(request.args['to'].replace('Z', '+00:00'))) if request.args.get('to') else datetime.now(timezone.utc)
+        start = as_utc(datetime.fromisoformat(request.args['from'].replace('Z', '+00:00'))) if request.args.get('from') else end - timedelta(days=7)
+    except ValueError:
+        return jsonify({'message': 'from and to must be ISO 8601 dates or timestamps'}), 422
+    # Columns hold naive UTC
+    start, end = start.astimezone(timezone.utc).replace(tzinfo=None), end.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if resolution == 'raw':
+        limit = app.config.get('VITALS_RAW_MAX_POINTS', 5000)
+        rows = db.session.execute(
+            select(Vitals.recorded_at, *(getattr(Vitals, metric) for metric in VITALS_METRICS))
+            .where(Vitals.patient_id == id, Vitals.recorded_at >= start, Vitals.recorded_at < end)
+            .order_by(Vitals.recorded_at).limit(limit)
+        ).all()
+        points = [{
+            't': row.recorded_at.replace(tzinfo=timezone.utc).isoformat(),
+            **{metric: float(getattr(row, metric)) if metric == 'temperature' else getattr(row, metric)
+               for metric in VITALS_METRICS},
+        } for row in rows]
+    else:
+        # Include the bucket that contains ``from``
+        start = start.replace(minute=0, second=0, microsecond=0)
+        if resolution == 'day':
+            start = start.replace(hour=0)
+        rollups = VitalsRollup.query.filter(
+            VitalsRollup.patient_id == id,
+            VitalsRollup.resolution == resolution,
+            VitalsRollup.bucket_start >= start,
+            VitalsRollup.bucket_start < end,
+        ).order_by(VitalsRollup.bucket_start)
+        points = [rollup.to_point() for rollup in rollups]
+    return jsonify({
+        'patient_id': id,
+        'resolution': resolution,
+        'from': start.replace(tzinfo=timezone.utc).isoformat(),
+        'to': end.replace(tzinfo=timezone.utc).isoformat(),
+        'points': points,
+    }), 200
+
+
 @app.route('/api/assets', methods=['GET'])
 @jwt_required()
 def get_assets():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    assets = Equipment.query.paginate(page=page, per_page=per_page, error_out=False)
+    assets = paginate_query(Equipment.query, page, per_page)
     return jsonify({
         'assets': [asset.to_dict() for asset in assets.items],
         'total': assets.total,
-        'pages': assets.pages
+        'pages': assets.pages,
+        'has_next': assets.has_next
     }), 200
 
 @app.route('/api/assets/maintenance', methods=['POST'])
 @jwt_required()
 def schedule_maintenance():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1847,56 +2790,62 @@ def schedule_maintenance():
             maintenance_date = datetime.now(timezone.utc)
         asset.maintenance_date = maintenance_date
         asset.status = 'Maintenance'
-        db.session.commit()
-        audit_log = AuditLog(action='Asset maintenance scheduled', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Asset maintenance scheduled', current_user)
         db.session.commit()
         return jsonify(asset.to_dict()), 200
     except ValueError as ve:
         db.session.rollback()
-        error_log = ErrorLog(error_message=f'Invalid date format: {str(ve)}', user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(f'Invalid date format: {str(ve)}', user.id)
         return jsonify({'message': 'Invalid date format for maintenance_date'}), 422
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error scheduling maintenance'}), 500
 
 @app.route('/api/beds', methods=['GET'])
 @jwt_required()
 def get_beds():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, ['Admin', 'Nurse']):
         return jsonify({'message': 'Unauthorized access'}), 403
     try:
-        beds = Bed.query.all()
-        beds_data = []
-        for bed in beds:
-            # Get current allocation if any
-            allocation = BedAllocation.query.filter_by(bed_id=bed.id, discharge_date=None).first()
-            beds_data.append({
-                'id': bed.id,
-                'ward': bed.ward_id,
-                'bed_number': bed.bed_number,
-                'status': bed.status,
-                'patient_id': allocation.patient_id if allocation else None
-            })
+        # Bed board: ward, bed, status and current occupant in a single round trip
+        current_allocation = db.session.query(
+            BedAllocation.bed_id, func.max(BedAllocation.id).label('allocation_id')
+        ).filter(BedAllocation.discharge_date.is_(None)).group_by(BedAllocation.bed_id).subquery()
+        query = db.session.query(
+            Bed.id, Bed.ward_id, Ward.name.label('ward_name'), Bed.bed_number, Bed.status, BedAllocation.patient_id
+        ).outerjoin(Ward, Ward.id == Bed.ward_id).outerjoin(
+            current_allocation, current_allocation.c.bed_id == Bed.id
+        ).outerjoin(BedAllocation, BedAllocation.id == current_allocation.c.allocation_id)
+        ward_id = request.args.get('ward_id', type=int)
+        if ward_id:
+            query = query.filter(Bed.ward_id == ward_id)
+        ward = request.args.get('ward')
+        if ward:
+            query = query.filter(Ward.name == ward)
+        status = request.args.get('status')
+        if status:
+            query = query.filter(Bed.status == status)
+        beds_data = [{
+            'id': row.id,
+            'ward': row.ward_id,
+            'ward_name': row.ward_name,
+            'bed_number': row.bed_number,
+            'status': row.status,
+            'patient_id': row.patient_id
+        } for row in query.order_by(Bed.ward_id, Bed.bed_number)]
         return jsonify({'beds': beds_data}), 200
     except Exception as e:
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error fetching beds'}), 500
 
 @app.route('/api/beds/reserve', methods=['POST'])
 @jwt_required()
 def reserve_bed():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1948,22 +2897,19 @@ def reserve_bed():
             patient_id=patient.id
         )
         db.session.add(bed_allocation)
-        audit_log = AuditLog(action='Bed reserved', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Bed reserved', current_user)
         db.session.commit()
         return jsonify({'message': 'Bed reserved'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error reserving bed'}), 500
 
 @app.route('/api/bills/refund', methods=['POST'])
 @jwt_required()
 def process_refund():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Billing')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -1974,23 +2920,19 @@ def process_refund():
         if not bill:
             return jsonify({'message': 'Bill not found'}), 404
         bill.payment_status = 'Refunded'
-        db.session.commit()
-        audit_log = AuditLog(action='Bill refunded', user=user.username)
-        db.session.add(audit_log)
+        record_audit('Bill refunded', user.username)
         db.session.commit()
         return jsonify({'message': 'Refund processed'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error processing refund'}), 500
 
 @app.route('/api/bills/claim', methods=['POST'])
 @jwt_required()
 def process_claim():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Billing')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -2001,33 +2943,35 @@ def process_claim():
         if not bill:
             return jsonify({'message': 'Bill not found'}), 404
         bill.payment_status = 'Claimed'
-        db.session.commit()
-        audit_log = AuditLog(action='Bill claim submitted', user=user.username)
-        db.session.add(audit_log)
+        record_audit('Bill claim submitted', user.username)
         db.session.commit()
         return jsonify({'message': 'Claim submitted'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error submitting claim'}), 500
 
 @app.route('/api/communication-settings', methods=['GET'])
 @jwt_required()
 def get_communication_settings():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
-    settings = Communication.query.first() or Communication(sms=False, email=False, chat=False)
-    return jsonify(settings.to_dict()), 200
+    etag = version_etag(request.path, *(db.session.execute(
+        select(Communication.id, Communication.version).order_by(Communication.id).limit(1)
+    ).first() or ()))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    settings = Communication.query.order_by(Communication.id).first() or Communication(sms=False, email=False, chat=False)
+    return with_etag(jsonify(settings.to_dict()), etag), 200
 
 @app.route('/api/communication-settings', methods=['PUT'])
 @jwt_required()
 def toggle_communication_setting():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -2041,22 +2985,19 @@ def toggle_communication_setting():
         setattr(settings, setting, not getattr(settings, setting))
         settings.updated_at = datetime.now(timezone.utc)
         db.session.add(settings)
-        audit_log = AuditLog(action=f'Communication setting {setting} toggled', user=current_user)
-        db.session.add(audit_log)
+        record_audit(f'Communication setting {setting} toggled', current_user)
         db.session.commit()
         return jsonify(settings.to_dict()), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error toggling communication setting'}), 500
 
 @app.route('/api/communications', methods=['POST'])
 @jwt_required()
 def add_communication():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not has_role(user, 'Admin'):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -2069,26 +3010,59 @@ def add_communication():
             status='Pending'
         )
         db.session.add(notification)
-        audit_log = AuditLog(action='Communication sent', user=current_user)
-        db.session.add(audit_log)
+        record_audit('Communication sent', current_user)
         db.session.commit()
         return jsonify({'message': 'Communication sent'}), 201
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error sending communication'}), 500
 
-queue = []  # In-memory queue for demonstration
+class QueueEntry(db.Model):
+    __tablename__ = 'queue_entry'
+    __table_args__ = (
+        db.Index('ix_queue_entry_queue_key', 'queue_key', unique=True),
+        db.Index('ix_queue_entry_checked_in_id', 'checked_in', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)  # Arrival order
+    queue_key = db.Column(db.String(50), nullable=False)  # str(patient_id), or temp_<hex> for walk-ins without a record
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
+    name = db.Column(db.String(100), nullable=False)
+    checked_in = db.Column(db.Boolean, nullable=False, default=False)
+    enqueued_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self, position=None):
+        data = {
+            'id': self.patient_id if self.patient_id is not None else self.queue_key,
+            'name': self.name,
+            'checked_in': self.checked_in,
+            'enqueued_at': self.enqueued_at.isoformat() if self.enqueued_at else None,
+        }
+        if position is not None:
+            data['position'] = position
+            data['eta_minutes'] = (position - 1) * app.config.get('QUEUE_MINUTES_PER_PATIENT', 10)
+        return data
+
+
+def queue_position(entry):
+    """1-based place in line: entries that arrived before ``entry``, plus one.
+
+    For single-entry routes only; the count is a primary key range scan. Listings
+    number every entry in one pass with row_number() instead.
+    """
+    return QueueEntry.query.filter(QueueEntry.id <= entry.id).count()
+
 
 @app.route('/api/queue', methods=['GET'])
 @jwt_required()
 def get_queue():
-    return jsonify({'queue': queue}), 200
+    position = func.row_number().over(order_by=QueueEntry.id)
+    rows = db.session.execute(select(QueueEntry, position).order_by(QueueEntry.id)).all()
+    return jsonify({'queue': [entry.to_dict(place) for entry, place in rows]}), 200
 
 @app.route('/api/queue', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def add_to_queue():
     data = request.get_json()
     patient_id = data.get('patient_id')
@@ -2096,38 +3070,86 @@ def add_to_queue():
     if not name:
         return jsonify({'message': 'Missing name'}), 422
     # If patient_id is not provided, use a temporary ID for queue
-    if not patient_id:
-        patient_id = f"temp_{len(queue) + 1}"
-    queue.append({'id': patient_id, 'name': name})
-    return jsonify({'message': 'Added to queue'}), 201
+    queue_key = str(patient_id) if patient_id else f"temp_{uuid.uuid4().hex[:8]}"
+    existing = QueueEntry.query.filter_by(queue_key=queue_key).first()
+    if existing:
+        return jsonify({'message': 'Already in queue', **existing.to_dict(queue_position(existing))}), 200
+    registered_id = int(patient_id) if str(patient_id).isdigit() else None
+    if registered_id is not None and db.session.get(Patient, registered_id) is None:
+        return jsonify({'message': 'Patient not found'}), 404
+    try:
+        # The unique key settles a race with another worker adding the same patient
+        with db.session.begin_nested():
+            entry = QueueEntry(queue_key=queue_key, patient_id=registered_id, name=name)
+            db.session.add(entry)
+    except IntegrityError:
+        existing = QueueEntry.query.filter_by(queue_key=queue_key).first()
+        if not existing:
+            # Not a duplicate, e.g. the patient was deleted in the meantime
+            return jsonify({'message': 'Could not add patient to queue'}), 409
+        return jsonify({'message': 'Already in queue', **existing.to_dict(queue_position(existing))}), 200
+    return jsonify({'message': 'Added to queue', **entry.to_dict(queue_position(entry))}), 201
+
+@app.route('/api/queue/<queue_id>', methods=['GET'])
+@jwt_required()
+def get_queue_position(queue_id):
+    entry = QueueEntry.query.filter_by(queue_key=queue_id).first()
+    if not entry:
+        return jsonify({'message': 'Patient not found in queue'}), 404
+    return jsonify(entry.to_dict(queue_position(entry))), 200
+
+@app.route('/api/queue/next', methods=['POST'])
+@jwt_required()
+@unit_of_work
+def dequeue_next():
+    # Oldest entry (optionally the oldest checked-in one) is removed and returned in one
+    # DELETE ... RETURNING; a worker that loses the race for the same row simply retries.
+    waiting = select(func.min(QueueEntry.id))
+    if request.args.get('checked_in', '').lower() == 'true':
+        waiting = waiting.where(QueueEntry.checked_in.is_(True))
+    for _ in range(3):
+        row = db.session.execute(
+            delete(QueueEntry)
+            .where(QueueEntry.id == waiting.scalar_subquery())
+            .returning(QueueEntry.queue_key, QueueEntry.patient_id, QueueEntry.name, QueueEntry.checked_in)
+        ).first()
+        if row:
+            return jsonify({
+                'id': row.patient_id if row.patient_id is not None else row.queue_key,
+                'name': row.name,
+                'checked_in': row.checked_in,
+            }), 200
+        if db.session.execute(waiting).scalar() is None:
+            break
+    return jsonify({'message': 'Queue is empty'}), 404
 
 @app.route('/api/checkin', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def check_in():
     data = request.get_json()
     patient_id = data.get('patient_id')
-    for patient in queue:
-        if patient['id'] == patient_id:
-            patient['checked_in'] = True
-            return jsonify({'message': 'Checked in'}), 200
-    return jsonify({'message': 'Patient not found in queue'}), 404
+    updated = QueueEntry.query.filter_by(queue_key=str(patient_id)).update({QueueEntry.checked_in: True})
+    if not updated:
+        return jsonify({'message': 'Patient not found in queue'}), 404
+    return jsonify({'message': 'Checked in'}), 200
 
 @app.route('/api/checkout', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def check_out():
     data = request.get_json()
     patient_id = data.get('patient_id')
-    for patient in queue:
-        if patient['id'] == patient_id:
-            patient['checked_in'] = False
-            return jsonify({'message': 'Checked out'}), 200
-    return jsonify({'message': 'Patient not found in queue'}), 404
+    updated = QueueEntry.query.filter_by(queue_key=str(patient_id)).update({QueueEntry.checked_in: False})
+    if not updated:
+        return jsonify({'message': 'Patient not found in queue'}), 404
+    return jsonify({'message': 'Checked out'}), 200
 
 @app.route('/api/lab-orders', methods=['GET'])
 @jwt_required()
 def get_lab_orders():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     # Allow Admin, Doctor, Nurse, Lab Tech full access
@@ -2142,40 +3164,42 @@ def get_lab_orders():
     query = LabOrder.query
     if patient_id:
         query = query.filter_by(patient_id=patient_id)
-    lab_orders = query.order_by(LabOrder.created_at.desc()).all()
+    query = query.order_by(LabOrder.created_at.desc())
+    def serialize(l):
+        return {k: getattr(l, k) if k != 'created_at' else (getattr(l, k).isoformat() if getattr(l, k) else None) for k in allowed_fields}
+    if wants_ndjson():
+        return ndjson_response(query, serialize)
     return jsonify({
-        'lab_orders': [
-            {k: getattr(l, k) if k != 'created_at' else (getattr(l, k).isoformat() if getattr(l, k) else None) for k in allowed_fields}
-            for l in lab_orders
-        ]
+        'lab_orders': [serialize(l) for l in query.all()]
     }), 200
 
 @app.route('/api/bills/patient/<int:patient_id>', methods=['GET'])
 @jwt_required()
 def get_bills_by_patient(patient_id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     # Allow Admin, Billing, Accountant to access patient bills
     if not (has_role(user, 'Admin') or has_role(user, 'Billing') or has_role(user, 'Accountant')):
         return jsonify({'message': 'Unauthorized access'}), 403
     try:
-        bills = Bill.query.filter_by(patient_id=patient_id).order_by(Bill.created_at.desc()).all()
+        query = Bill.query.filter_by(patient_id=patient_id).order_by(Bill.created_at.desc())
+        if wants_ndjson():
+            return ndjson_response(query, Bill.to_dict)
+        bills = query.all()
         return jsonify({
             'bills': [bill.to_dict() for bill in bills]
         }), 200
     except Exception as e:
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error fetching patient bills'}), 500
 
 @app.route('/api/bills/<int:id>/status', methods=['PUT'])
 @jwt_required()
 def update_bill_status(id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user or not (has_role(user, 'Admin') or has_role(user, 'Billing')):
         return jsonify({'message': 'Unauthorized access'}), 403
     data = request.get_json()
@@ -2186,20 +3210,20 @@ def update_bill_status(id):
         if not bill:
             return jsonify({'message': 'Bill not found'}), 404
         bill.payment_status = data.get('payment_status')
-        db.session.commit()
-        audit_log = AuditLog(action=f'Bill status updated to {data.get("payment_status")}', user=user.username)
-        db.session.add(audit_log)
+        record_audit(f'Bill status updated to {data.get("payment_status")}', user.username)
         db.session.commit()
         return jsonify({'message': 'Bill status updated'}), 200
     except Exception as e:
         db.session.rollback()
-        error_log = ErrorLog(error_message=str(e), user_id=user.id)
-        db.session.add(error_log)
-        db.session.commit()
+        record_error(str(e), user.id)
         return jsonify({'message': 'Error updating bill status'}), 500
 
 class PatientVisit(db.Model):
     __tablename__ = 'patient_visit'
+    __table_args__ = (
+        db.Index('ix_patient_visit_current_stage_created_at', 'current_stage', 'created_at'),
+        db.Index('ix_patient_visit_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     current_stage = db.Column(db.String(20), nullable=False, default='reception')
@@ -2210,6 +3234,7 @@ class PatientVisit(db.Model):
     billing_status = db.Column(db.String(20), default='unpaid')
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped on every update, for ETags
 
     def to_dict(self):
         return {
@@ -2225,8 +3250,109 @@ class PatientVisit(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
         }
 
+# Stage each role works; Receptionist sees every visit
+ROLE_STAGES = {
+    'Nurse': 'triage',
+    'Doctor': 'doctor',
+    'Lab Tech': 'lab',
+    'Pharmacist': 'pharmacy',
+    'Billing': 'billing',
+}
+
+class VisitEvent(db.Model):
+    __tablename__ = 'visit_event'
+    __table_args__ = (
+        db.Index('ix_visit_event_created_at', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    visit_id = db.Column(db.Integer, db.ForeignKey('patient_visit.id'), nullable=False)
+    stage = db.Column(db.String(20), nullable=False)  # Stage after the change
+    previous_stage = db.Column(db.String(20))  # None when the visit was just created
+    payload = db.Column(db.JSON, nullable=False)  # PatientVisit.to_dict() after the change
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# Visit change feed
+# create_patient_visit and update_patient_visit append a VisitEvent in their
+# own transaction. Each worker tails the table with one ChangeFeed thread and
+# fans new rows out to its /api/patient-visits/stream clients, so workers see
+# each other's changes within VISIT_FEED_POLL_INTERVAL and local ones at once.
+def record_visit_event(visit, previous_stage):
+    db.session.add(VisitEvent(
+        visit_id=visit.id,
+        stage=visit.current_stage,
+        previous_stage=previous_stage,
+        payload=visit.to_dict(),
+    ))
+    db.session.info['visit_events'] = True
+
+
+def serialize_visit_event(e):
+    return {
+        'id': e.id,
+        'visit_id': e.visit_id,
+        'stage': e.stage,
+        'previous_stage': e.previous_stage,
+        'visit': e.payload,
+    }
+
+
+def fetch_visit_events(after_id, limit):
+    with app.app_context():
+        events = VisitEvent.query.filter(VisitEvent.id > after_id).order_by(VisitEvent.id).limit(limit).all()
+        return [serialize_visit_event(e) for e in events]
+
+
+def fetch_visit_events_by_id(ids):
+    """Events among ``ids`` that have been committed since they were skipped over."""
+    with app.app_context():
+        events = VisitEvent.query.filter(VisitEvent.id.in_(ids)).order_by(VisitEvent.id).all()
+        return [serialize_visit_event(e) for e in events]
+
+
+def latest_visit_event_id():
+    with app.app_context():
+        return db.session.query(func.max(VisitEvent.id)).scalar()
+
+
+# Open /api/patient-visits/stream connections allowed per worker process
+stream_slots = threading.BoundedSemaphore(app.config.get('SSE_MAX_STREAMS', 4))
+
+visit_feed = ChangeFeed(
+    fetch_visit_events,
+    latest_visit_event_id,
+    fetch_ids=fetch_visit_events_by_id,
+    poll_interval=app.config.get('VISIT_FEED_POLL_INTERVAL', 0.5),
+    gap_timeout=app.config.get('VISIT_FEED_GAP_TIMEOUT', 30),
+    name='visit-feed',
+)
+
+
+TRANSACTION_STATE_KEYS.append('visit_events')
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_visit_feed(session):
+    if not session.in_nested_transaction() and session.info.pop('visit_events', False):
+        visit_feed.notify()
+
+
+@app.cli.command('prune-visit-events')
+@click.option('--hours', default=24, show_default=True, help='Keep events newer than this.')
+def prune_visit_events(hours):
+    """Delete VisitEvent rows older than --hours; streams only need recent ones."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+    deleted = VisitEvent.query.filter(VisitEvent.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f'Deleted {deleted} visit events')
+
+
 class Invoice(db.Model):
     __tablename__ = 'invoice'
+    __table_args__ = (
+        db.Index('ix_invoice_patient_id_generated_at', 'patient_id', 'generated_at'),
+        db.Index('ix_invoice_generated_at', 'generated_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     invoice_number = db.Column(db.String(50), unique=True, nullable=False)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
@@ -2238,6 +3364,7 @@ class Invoice(db.Model):
     generated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     paid_at = db.Column(db.DateTime)
     payment_method = db.Column(db.String(20))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped on every update, for ETags
 
     def to_dict(self):
         return {
@@ -2254,11 +3381,240 @@ class Invoice(db.Model):
             'payment_method': self.payment_method,
         }
 
+
+# Daily operational rollups
+# Dashboard figures are read from daily_rollup: a count and an amount per
+# facility, UTC day, metric and dimension. Write paths call
+# bump_daily_rollup() and the changes are folded in with one upsert per
+# touched row just before their transaction commits, so a busy row such as
+# today's M-Pesa revenue is locked only for the commit itself; a rolled back
+# transaction leaves no trace.
+#   revenue     invoices paid on the day, by payment method (count and amount)
+#   visits      visits opened on the day, by the stage each is in now
+#   lab_orders  lab orders placed on the day, by status
+class DailyRollup(db.Model):
+    """Daily counters and sums per facility, metric and dimension, kept current by the write paths."""
+    __tablename__ = 'daily_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('facility', 'day', 'metric', 'dimension', name='uq_daily_rollup_bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    facility = db.Column(db.String(50), nullable=False)
+    day = db.Column(db.Date, nullable=False)  # UTC
+    metric = db.Column(db.String(20), nullable=False)  # revenue, visits, lab_orders
+    dimension = db.Column(db.String(50), nullable=False)  # Payment method, stage or status
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+
+def bump_daily_rollup(metric, dimension, when, count=1, amount=0):
+    """Add ``count`` and ``amount`` to the rollup for ``when``'s UTC day once the current transaction commits."""
+    key = (app.config.get('FACILITY_ID', 'main'), as_utc(when).astimezone(timezone.utc).date(), metric, dimension or 'Unknown')
+    pending = db.session.info.setdefault('pending_rollups', {})
+    counted, total = pending.get(key, (0, 0))
+    pending[key] = (counted + count, total + amount)
+
+
+def upsert_daily_rollups(session, deltas):
+    """Add ``{(facility, day, metric, dimension): (count, amount)}`` to daily_rollup, one upsert per row."""
+    rows = [
+        {'facility': facility, 'day': day, 'metric': metric, 'dimension': dimension, 'count': count, 'amount': amount}
+        # Sorted so concurrent transactions lock shared rows in the same order
+        for (facility, day, metric, dimension), (count, amount) in sorted(deltas.items())
+        if count or amount
+    ]
+    if not rows:
+        return
+    table = DailyRollup.__table__
+    upsert = (postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert)(table)
+    session.execute(
+        upsert.on_conflict_do_update(
+            index_elements=['facility', 'day', 'metric', 'dimension'],
+            set_={'count': table.c.count + upsert.excluded.count, 'amount': table.c.amount + upsert.excluded.amount},
+        ),
+        rows,
+    )
+
+
+TRANSACTION_STATE_KEYS.append('pending_rollups')
+
+
+@event.listens_for(Session, 'before_commit')
+def apply_pending_rollups(session):
+    if session.in_nested_transaction():
+        return
+    deltas = session.info.pop('pending_rollups', None)
+    if deltas:
+        upsert_daily_rollups(session, deltas)
+
+
+def mark_invoice_paid(invoice, payment_method, paid_at=None):
+    """Mark ``invoice`` paid and count it in the revenue rollup for its payment day and method."""
+    paid_at = paid_at or datetime.now(timezone.utc)
+    if invoice.status == 'Paid' and invoice.paid_at:
+        # Paying again re-dates the payment, so take it out of the day it was counted in
+        bump_daily_rollup('revenue', invoice.payment_method, invoice.paid_at, -1, -(invoice.total_amount or 0))
+    invoice.status = 'Paid'
+    invoice.paid_at = paid_at
+    invoice.payment_method = payment_method
+    bump_daily_rollup('revenue', payment_method, paid_at, 1, invoice.total_amount or 0)
+
+
+@app.cli.command('rebuild-daily-rollups')
+def rebuild_daily_rollups():
+    """Recompute this facility's daily_rollup from invoice, patient_visit and lab_order.
+
+    Run it while nothing else is writing, e.g. after upgrading or restoring,
+    since payments made during the rebuild may be counted twice or not at all.
+    """
+    facility = app.config.get('FACILITY_ID', 'main')
+    db.session.execute(delete(DailyRollup).where(DailyRollup.facility == facility))
+    sources = [
+        ('revenue', Invoice.paid_at, Invoice.payment_method, Invoice.total_amount, Invoice.status == 'Paid'),
+        ('visits', PatientVisit.created_at, PatientVisit.current_stage, None, None),
+        ('lab_orders', LabOrder.created_at, LabOrder.status, None, None),
+    ]
+    deltas = {}
+    for metric, timestamp, dimension, amount, criterion in sources:
+        day = func.date(timestamp)
+        query = select(day, dimension, func.count(), func.sum(amount) if amount is not None else null())
+        query = query.where(timestamp.isnot(None)).group_by(day, dimension)
+        if criterion is not None:
+            query = query.where(criterion)
+        for bucket, key, count, total in db.session.execute(query):
+            # SQLite's date() returns text
+            bucket = bucket if isinstance(bucket, date) else date.fromisoformat(bucket)
+            key = (facility, bucket, metric, key or 'Unknown')
+            counted, summed = deltas.get(key, (0, 0))
+            deltas[key] = (counted + count, summed + (total or 0))
+    upsert_daily_rollups(db.session, deltas)
+    db.session.commit()
+    click.echo(f'Rebuilt {len(deltas)} daily rollup rows for facility {facility}')
+
+
+@app.route('/api/dashboard/summary', methods=['GET'])
+@jwt_required()
+def dashboard_summary():
+    """Revenue, visits by stage and lab orders for a day or range of days, read from daily_rollup only"""
+    user = get_current_principal()
+    if not user or not has_role(user, 'Admin'):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else datetime.now(timezone.utc).date()
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else end
+    except ValueError:
+        return jsonify({'message': 'from and to must be ISO 8601 dates'}), 422
+    if start > end:
+        return jsonify({'message': 'from must not be after to'}), 422
+    facility = request.args.get('facility', app.config.get('FACILITY_ID', 'main'))
+
+    rows = db.session.execute(
+        select(DailyRollup.metric, DailyRollup.dimension, func.sum(DailyRollup.count), func.sum(DailyRollup.amount))
+        .where(DailyRollup.facility == facility, DailyRollup.day >= start, DailyRollup.day <= end)
+        .group_by(DailyRollup.metric, DailyRollup.dimension)
+    ).all()
+    revenue = {'payments': 0, 'amount': 0.0, 'by_payment_method': {}}
+    visits = {'total': 0, 'by_stage': {}}
+    lab_orders = {'total': 0, 'by_status': {}}
+    for metric, dimension, count, amount in rows:
+        if not count:
+            continue
+        if metric == 'revenue':
+            revenue['payments'] += count
+            revenue['amount'] += float(amount or 0)
+            revenue['by_payment_method'][dimension] = {'payments': count, 'amount': float(amount or 0)}
+        elif metric == 'visits':
+            visits['total'] += count
+            visits['by_stage'][dimension] = count
+        elif metric == 'lab_orders':
+            lab_orders['total'] += count
+            lab_orders['by_status'][dimension] = count
+    revenue['amount'] = round(revenue['amount'], 2)
+    lab_orders['pending'] = lab_orders['by_status'].get('Pending', 0)
+    return jsonify({
+        'facility': facility,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'revenue': revenue,
+        'visits': visits,
+        'lab_orders': lab_orders,
+    }), 200
+
+
+# Version stamps
+# The models below carry a version that every ORM update bumps in SQL
+# (version = version + 1, so concurrent updates never share a number), and
+# collection_version counts the committed transactions that wrote to each
+# of their tables. Read endpoints build strong ETags from these and answer
+# If-None-Match with a 304 after one narrow query. Bulk UPDATE statements
+# against these tables must bump version themselves.
+VERSIONED_MODELS = (Patient, MedicalRecord, PatientVisit, Invoice, Communication)
+
+
+class CollectionVersion(db.Model):
+    """Per-table write counter that list endpoints' ETags are built from."""
+    __tablename__ = 'collection_version'
+    name = db.Column(db.String(50), primary_key=True)  # Table name
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def touch_collection(session, table_name):
+    session.info.setdefault('touched_collections', set()).add(table_name)
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_row_versions(session, flush_context, instances):
+    for obj in session.new | session.deleted:
+        if isinstance(obj, VERSIONED_MODELS):
+            touch_collection(session, obj.__tablename__)
+    for obj in session.dirty:
+        if isinstance(obj, VERSIONED_MODELS) and session.is_modified(obj, include_collections=False):
+            obj.version = type(obj).version + 1
+            touch_collection(session, obj.__tablename__)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def touch_bulk_writes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and issubclass(mapper.class_, VERSIONED_MODELS):
+            touch_collection(orm_execute_state.session, mapper.local_table.name)
+
+
+TRANSACTION_STATE_KEYS.append('touched_collections')
+
+
+@event.listens_for(Session, 'before_commit')
+def bump_collection_versions(session):
+    if session.in_nested_transaction():
+        return
+    # Flush first so changes still pending at commit are counted
+    session.flush()
+    touched = session.info.pop('touched_collections', None)
+    if not touched:
+        return
+    table = CollectionVersion.__table__
+    upsert = (postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert)(table)
+    session.execute(
+        upsert.on_conflict_do_update(index_elements=['name'], set_={'version': table.c.version + 1}),
+        [{'name': name, 'version': 1} for name in sorted(touched)],
+    )
+
+
+def collection_versions(*table_names):
+    """Current collection_version of each table, 0 for one never written through the ORM."""
+    versions = dict(db.session.execute(
+        select(CollectionVersion.name, CollectionVersion.version).where(CollectionVersion.name.in_(table_names))
+    ).all())
+    return [versions.get(name, 0) for name in table_names]
+
+
 @app.route('/api/patient-visits', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def create_patient_visit():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     logger.info(f"PatientVisit creation request from user {current_user} with role {user.role if user else 'None'}")
     
     if not user or not (has_role(user, 'Receptionist') or has_role(user, 'Admin')):
@@ -2276,13 +3632,12 @@ def create_patient_visit():
     try:
         visit = PatientVisit(patient_id=patient_id, current_stage='triage')
         db.session.add(visit)
-        db.session.commit()
+        record_audit('PatientVisit created', user.username)
+        db.session.flush()
+        record_visit_event(visit, None)
+        bump_daily_rollup('visits', visit.current_stage, visit.created_at)
         logger.info(f"PatientVisit {visit.id} created successfully for patient {patient_id}")
         
-        audit_log = AuditLog(action='PatientVisit created', user=user.username)
-        db.session.add(audit_log)
-        db.session.commit()
-        
         return jsonify(visit.to_dict()), 201
     except Exception as e:
         logger.error(f"Error creating PatientVisit: {str(e)}")
@@ -2293,26 +3648,28 @@ def create_patient_visit():
 @jwt_required()
 def get_patient_visits():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     role = user.role
     
     logger.info(f"PatientVisits request from user {current_user} with role {role}")
+    etag = version_etag(request.full_path, role, *collection_versions('patient_visit'))
+    if not wants_ndjson():
+        cached = not_modified(etag)
+        if cached:
+            return cached
     
     # Receptionist can see all visits, others see only their stage
     if role == 'Receptionist':
-        visits = PatientVisit.query.order_by(PatientVisit.created_at.desc()).all()
+        query = PatientVisit.query.order_by(PatientVisit.created_at.desc())
+        if wants_ndjson():
+            logger.info("Receptionist streams all visits")
+            return ndjson_response(query, PatientVisit.to_dict)
+        visits = query.all()
         logger.info(f"Receptionist sees all {len(visits)} visits")
     else:
-        role_stage_map = {
-            'Nurse': 'triage',
-            'Doctor': 'doctor',
-            'Lab Tech': 'lab',
-            'Pharmacist': 'pharmacy',
-            'Billing': 'billing',
-        }
-        stage = role_stage_map.get(role)
+        stage = ROLE_STAGES.get(role)
         if not stage:
             logger.warning(f"No workflow stage mapped for role {role}")
             return jsonify({'message': 'No workflow stage for this role'}), 403
@@ -2321,21 +3678,83 @@ def get_patient_visits():
         logger.info(f"User {current_user} (role: {role}) sees {len(visits)} visits in stage '{stage}'")
         logger.info(f"Visit IDs in stage '{stage}': {[v.id for v in visits]}")
     
-    return jsonify({'visits': [v.to_dict() for v in visits]}), 200
+    return with_etag(jsonify({'visits': [v.to_dict() for v in visits]}), etag), 200
+
+@app.route('/api/patient-visits/stream', methods=['GET'])
+@jwt_required()
+def stream_patient_visits():
+    current_user = get_jwt_identity()
+    user = get_current_principal()
+    if not user:
+        return jsonify({'message': 'Unauthorized access'}), 403
+    role = user.role
+    stage = None if role == 'Receptionist' else ROLE_STAGES.get(role)
+    if role != 'Receptionist' and not stage:
+        return jsonify({'message': 'No workflow stage for this role'}), 403
+    # Each open stream holds one of the worker's threads; beyond the cap, send clients elsewhere
+    if not stream_slots.acquire(blocking=False):
+        response = jsonify({'message': 'Too many open visit streams; retry shortly or poll GET /api/patient-visits'})
+        response.headers['Retry-After'] = str(app.config.get('SSE_RETRY_AFTER_SECONDS', 30))
+        return response, 503
+    try:
+        # Subscribe before the snapshot so nothing committed in between is missed
+        subscription = visit_feed.subscribe()
+    except Exception:
+        stream_slots.release()
+        raise
+
+    def close():
+        visit_feed.unsubscribe(subscription)
+        stream_slots.release()
+
+    try:
+        query = PatientVisit.query.order_by(PatientVisit.created_at.desc())
+        if stage:
+            query = query.filter_by(current_stage=stage)
+        snapshot = [v.to_dict() for v in query]
+    except Exception:
+        close()
+        raise
+    # Hand the connection back to the pool for the life of the stream
+    db.session.close()
+    keepalive = app.config.get('SSE_KEEPALIVE_SECONDS', 15)
+    logger.info(f"User {current_user} (role: {role}) streaming visits for stage '{stage or 'all'}'")
+
+    def generate():
+        yield sse_message({'stage': stage, 'visits': snapshot}, event='snapshot')
+        while not subscription.closed:
+            change = subscription.get(timeout=keepalive)
+            if change is None:
+                yield ': keepalive\n\n'
+            elif stage is None or change['stage'] == stage:
+                yield sse_message(change['visit'], event='visit', event_id=change['id'])
+            elif change['previous_stage'] == stage:
+                yield sse_message({'id': change['visit_id']}, event='remove', event_id=change['id'])
+
+    response = sse_response(generate())
+    response.call_on_close(close)
+    return response
 
 @app.route('/api/patient-visits/<int:visit_id>', methods=['GET'])
 @jwt_required()
 def get_patient_visit(visit_id):
+    version = db.session.execute(select(PatientVisit.version).where(PatientVisit.id == visit_id)).scalar()
+    if version is None:
+        return jsonify({'message': 'Visit not found'}), 404
+    etag = version_etag(request.path, version)
+    cached = not_modified(etag)
+    if cached:
+        return cached
     visit = PatientVisit.query.get(visit_id)
     if not visit:
         return jsonify({'message': 'Visit not found'}), 404
-    return jsonify(visit.to_dict()), 200
+    return with_etag(jsonify(visit.to_dict()), etag), 200
 
 @app.route('/api/patient-visits/<int:visit_id>', methods=['PUT'])
 @jwt_required()
 def update_patient_visit(visit_id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     visit = PatientVisit.query.get(visit_id)
     
     logger.info(f"PatientVisit update request from user {current_user} (role: {user.role if user else 'None'}) for visit {visit_id}")
@@ -2346,6 +3765,7 @@ def update_patient_visit(visit_id):
     
     data = request.get_json()
     role = user.role
+    previous_stage = visit.current_stage
     logger.info(f"Updating visit {visit_id} (current stage: {visit.current_stage}) with role {role}")
     logger.info(f"Request data: {data}")
     
@@ -2389,13 +3809,14 @@ def update_patient_visit(visit_id):
     
     visit.updated_at = datetime.now(timezone.utc)
     try:
+        record_audit(f'PatientVisit updated by {role}', user.username)
+        record_visit_event(visit, previous_stage)
+        if visit.current_stage != previous_stage and visit.created_at:
+            bump_daily_rollup('visits', previous_stage, visit.created_at, -1)
+            bump_daily_rollup('visits', visit.current_stage, visit.created_at)
         db.session.commit()
         logger.info(f"Successfully updated visit {visit_id} to stage {visit.current_stage}")
         
-        audit_log = AuditLog(action=f'PatientVisit updated by {role}', user=user.username)
-        db.session.add(audit_log)
-        db.session.commit()
-        
         return jsonify(visit.to_dict()), 200
     except Exception as e:
         logger.error(f"Error updating visit {visit_id}: {str(e)}")
@@ -2404,9 +3825,10 @@ def update_patient_visit(visit_id):
 
 @app.route('/api/invoices', methods=['POST'])
 @jwt_required()
+@unit_of_work
 def create_invoice():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     logger.info(f"Invoice creation request from user {current_user} with role {user.role if user else 'None'}")
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
@@ -2438,13 +3860,10 @@ def create_invoice():
             generated_by=current_user
         )
         db.session.add(invoice)
-        db.session.commit()
+        record_audit('Invoice created', user.username)
+        db.session.flush()
         logger.info(f"Invoice {invoice.id} created successfully")
         
-        audit_log = AuditLog(action='Invoice created', user=user.username)
-        db.session.add(audit_log)
-        db.session.commit()
-        
         return jsonify(invoice.to_dict()), 201
     except Exception as e:
         logger.error(f"Error creating invoice: {str(e)}")
@@ -2455,10 +3874,15 @@ def create_invoice():
 @jwt_required()
 def get_invoices():
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     
+    etag = version_etag(request.full_path, *collection_versions('invoice'))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
     try:
         page = request.args.get('page', 1, type=int)
         per_page = 10
@@ -2468,16 +3892,15 @@ def get_invoices():
         if patient_id:
             query = query.filter_by(patient_id=patient_id)
         
-        invoices = query.order_by(Invoice.generated_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        invoices = paginate_query(query.order_by(Invoice.generated_at.desc()), page, per_page)
         
-        return jsonify({
+        return with_etag(jsonify({
             'invoices': [invoice.to_dict() for invoice in invoices.items],
             'total': invoices.total,
             'pages': invoices.pages,
+            'has_next': invoices.has_next,
             'page': page
-        }), 200
+        }), etag), 200
     except Exception as e:
         logger.error(f"Error fetching invoices: {str(e)}")
         return jsonify({'message': f'Error fetching invoices: {str(e)}'}), 500
@@ -2486,25 +3909,34 @@ def get_invoices():
 @jwt_required()
 def get_invoice(invoice_id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     if not user:
         return jsonify({'message': 'Unauthorized access'}), 403
     
     try:
+        version = db.session.execute(select(Invoice.version).where(Invoice.id == invoice_id)).scalar()
+        if version is None:
+            return jsonify({'message': 'Invoice not found'}), 404
+        etag = version_etag(request.path, version)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
         invoice = Invoice.query.get(invoice_id)
         if not invoice:
             return jsonify({'message': 'Invoice not found'}), 404
         
-        return jsonify(invoice.to_dict()), 200
+        return with_etag(jsonify(invoice.to_dict()), etag), 200
     except Exception as e:
         logger.error(f"Error fetching invoice {invoice_id}: {str(e)}")
         return jsonify({'message': f'Error fetching invoice: {str(e)}'}), 500
 
 @app.route('/api/invoices/<int:invoice_id>/pay', methods=['PUT'])
 @jwt_required()
+@unit_of_work
 def pay_invoice(invoice_id):
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     logger.info(f"Invoice payment request from user {current_user} for invoice {invoice_id}")
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
@@ -2519,17 +3951,11 @@ def pay_invoice(invoice_id):
         if not invoice:
             return jsonify({'message': 'Invoice not found'}), 404
         
-        invoice.status = 'Paid'
-        invoice.paid_at = datetime.now(timezone.utc)
-        invoice.payment_method = payment_method
+        mark_invoice_paid(invoice, payment_method)
         
-        db.session.commit()
+        record_audit(f'Invoice {invoice_id} paid via {payment_method}', user.username)
         logger.info(f"Invoice {invoice_id} marked as paid")
         
-        audit_log = AuditLog(action=f'Invoice {invoice_id} paid via {payment_method}', user=user.username)
-        db.session.add(audit_log)
-        db.session.commit()
-        
         return jsonify(invoice.to_dict()), 200
     except Exception as e:
         logger.error(f"Error paying invoice {invoice_id}: {str(e)}")
@@ -2538,6 +3964,12 @@ def pay_invoice(invoice_id):
 
 class PaymentTransaction(db.Model):
     __tablename__ = 'payment_transaction'
+    __table_args__ = (
+        db.Index('ix_payment_transaction_gateway_reference', 'gateway_reference'),
+        db.Index('ix_payment_transaction_patient_id_status_created_at', 'patient_id', 'status', 'created_at'),
+        db.Index('ix_payment_transaction_created_at_id', 'created_at', 'id'),
+        db.Index('ix_payment_transaction_status_created_at', 'status', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
@@ -2550,6 +3982,7 @@ class PaymentTransaction(db.Model):
     processed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     completed_at = db.Column(db.DateTime)
+    last_checked_at = db.Column(db.DateTime)  # Last gateway call made for it in the background (M-Pesa reconciler, Stripe jobs)
 
     def to_dict(self):
         return {
@@ -2567,13 +4000,19 @@ class PaymentTransaction(db.Model):
             'completed_at': self.completed_at.isoformat() if self.completed_at else None,
         }
 
+def as_utc(value):
+    """Treat a naive datetime read back from the database as UTC."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
 # Payment API Endpoints
 @app.route('/api/payments/create-intent', methods=['POST'])
 @jwt_required()
 def create_payment_intent():
     """Create a Stripe payment intent for card payments"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -2590,6 +4029,16 @@ def create_payment_intent():
         if not invoice:
             return jsonify({'message': 'Invoice not found'}), 404
         
+        if wants_async():
+            return queue_stripe_job(PaymentTransaction(
+                invoice_id=invoice_id,
+                patient_id=invoice.patient_id,
+                amount=amount,
+                payment_method='stripe',
+                status='queued',
+                processed_by=current_user
+            ), user.username)
+        
         # Create Stripe payment intent
         intent = stripe.PaymentIntent.create(
             amount=int(float(amount) * 100),  # Convert to cents
@@ -2623,12 +4072,217 @@ def create_payment_intent():
         logger.error(f"Error creating payment intent: {str(e)}")
         return jsonify({'message': f'Error creating payment intent: {str(e)}'}), 500
 
+# With ?async=true the Stripe routes commit a 'queued' PaymentTransaction,
+# hand its id to a bounded thread pool and answer 202 straight away, so a
+# worker is not held for the Stripe round trip. The transaction id is the
+# job id; GET /api/payments/jobs/<id> reports the outcome. A run claims the
+# row by stamping last_checked_at; a 'processing' row whose stamp is older
+# than STRIPE_JOB_STALE_SECONDS lost its worker and may be claimed again.
+# Each call carries an idempotency key derived from the row, so a job that
+# is re-run after a worker restart cannot charge or refund twice.
+stripe_jobs = BoundedExecutor(
+    max_workers=app.config.get('STRIPE_JOB_WORKERS', 4),
+    max_pending=app.config.get('STRIPE_JOB_QUEUE_SIZE', 100),
+    name='stripe-job',
+)
+
+
+def wants_async():
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def stripe_idempotency_key(transaction):
+    return f'hmis-{transaction.payment_method}-{transaction.id}-{int(as_utc(transaction.created_at).timestamp())}'
+
+
+def run_stripe_job(transaction_id, username):
+    """Make the Stripe call for a queued transaction and record the result on it."""
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        stale_before = now - timedelta(seconds=app.config.get('STRIPE_JOB_STALE_SECONDS', 120))
+        # A run still in progress elsewhere keeps its row until its claim goes stale
+        claimed = db.session.execute(
+            update(PaymentTransaction)
+            .where(
+                PaymentTransaction.id == transaction_id,
+                or_(
+                    PaymentTransaction.status == 'queued',
+                    and_(PaymentTransaction.status == 'processing', PaymentTransaction.last_checked_at < stale_before),
+                ),
+            )
+            .values(status='processing', last_checked_at=now)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+        transaction = db.session.get(PaymentTransaction, transaction_id)
+        details = dict(transaction.gateway_response or {})
+        try:
+            if transaction.payment_method == 'stripe':
+                intent = stripe.PaymentIntent.create(
+                    amount=int(float(transaction.amount) * 100),  # Convert to cents
+                    currency='kes',
+                    metadata={
+                        'invoice_id': transaction.invoice_id,
+                        'patient_id': transaction.patient_id,
+                        'hospital': 'HMIS'
+                    },
+                    idempotency_key=stripe_idempotency_key(transaction),
+                )
+                transaction.gateway_reference = intent.id
+                transaction.gateway_response = {**details, 'client_secret': intent.client_secret}
+                transaction.status = 'pending'
+            else:
+                original = db.session.get(PaymentTransaction, details['original_transaction'])
+                refund = stripe.Refund.create(
+                    payment_intent=original.gateway_reference,
+                    amount=int(float(transaction.amount) * 100),
+                    idempotency_key=stripe_idempotency_key(transaction),
+                )
+                transaction.gateway_reference = refund.id
+                transaction.status = 'completed'
+                transaction.completed_at = datetime.now(timezone.utc)
+                record_audit(f'Payment refund processed for transaction {original.id}', username)
+        except Exception as e:
+            logger.error(f"Stripe job {transaction_id} failed: {str(e)}")
+            transaction.status = 'failed'
+            transaction.gateway_response = {**details, 'error': getattr(e, 'user_message', None) or str(e)}
+        db.session.commit()
+
+
+def queue_stripe_job(transaction, username):
+    """Commit ``transaction`` as a queued job and start it, or answer 503 if the pool is full."""
+    db.session.add(transaction)
+    db.session.commit()
+    if not stripe_jobs.submit(run_stripe_job, transaction.id, username):
+        transaction.status = 'failed'
+        transaction.gateway_response = {**(transaction.gateway_response or {}), 'error': 'Payment gateway busy'}
+        db.session.commit()
+        return jsonify({'message': 'Payment gateway is busy, please try again shortly'}), 503
+    return jsonify({
+        'job_id': transaction.id,
+        'transaction_id': transaction.id,
+        'status': 'queued',
+        'status_url': f'/api/payments/jobs/{transaction.id}',
+    }), 202
+
+
+@app.route('/api/payments/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_payment_job(job_id):
+    """Outcome of a Stripe call started with ?async=true"""
+    user = get_current_principal()
+    if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    
+    transaction = db.session.get(PaymentTransaction, job_id)
+    if not transaction or transaction.payment_method not in ('stripe', 'stripe_refund'):
+        return jsonify({'message': 'Job not found'}), 404
+    
+    if transaction.status == 'processing' and transaction.last_checked_at:
+        last_attempt = as_utc(transaction.last_checked_at)
+        if (datetime.now(timezone.utc) - last_attempt).total_seconds() > app.config.get('STRIPE_JOB_STALE_SECONDS', 120):
+            # The worker running it may have restarted; the idempotency key makes a re-run safe
+            stripe_jobs.submit(run_stripe_job, transaction.id, user.username)
+    if transaction.status in ('queued', 'processing'):
+        state = 'queued' if transaction.status == 'queued' else 'running'
+    else:
+        state = 'failed' if transaction.status == 'failed' else 'succeeded'
+    
+    body = {'job_id': transaction.id, 'state': state, 'transaction': transaction.to_dict()}
+    details = transaction.gateway_response or {}
+    if state == 'succeeded' and 'client_secret' in details:
+        body['client_secret'] = details['client_secret']
+    if state == 'failed':
+        body['error'] = details.get('error', 'Unknown error')
+    return jsonify(body), 200
+
+
+class GatewayToken(db.Model):
+    """The current OAuth access token for a gateway, shared by every worker."""
+    __tablename__ = 'gateway_token'
+    name = db.Column(db.String(50), primary_key=True)
+    access_token = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)  # UTC
+
+
+def load_gateway_token(name):
+    with app.app_context():
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(GatewayToken.access_token, GatewayToken.expires_at).where(GatewayToken.name == name)
+            ).first()
+    if row is None:
+        return None
+    return row.access_token, row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def save_gateway_token(name, access_token, expires_at):
+    values = {
+        'access_token': access_token,
+        'expires_at': datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None),
+    }
+    with app.app_context():
+        with db.engine.begin() as conn:
+            updated = conn.execute(
+                update(GatewayToken).where(GatewayToken.name == name).values(**values)
+            ).rowcount
+            if not updated:
+                conn.execute(GatewayToken.__table__.insert().values(name=name, **values))
+
+
+def fetch_mpesa_token():
+    """Client-credentials grant against Daraja's OAuth endpoint."""
+    response = mpesa_gateway.get(
+        os.environ.get('MPESA_AUTH_URL', 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'),
+        auth=(os.environ.get('MPESA_CONSUMER_KEY'), os.environ.get('MPESA_CONSUMER_SECRET')),
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data['access_token'], int(data.get('expires_in', 3599))
+
+
+mpesa_tokens = AccessTokenManager(
+    fetch_mpesa_token,
+    load=lambda: load_gateway_token('mpesa'),
+    save=lambda token, expires_at: save_gateway_token('mpesa', token, expires_at),
+    refresh_margin=app.config.get('MPESA_TOKEN_REFRESH_MARGIN', 300),
+    name='mpesa-token',
+)
+
+
+def mpesa_uses_oauth():
+    return bool(os.environ.get('MPESA_CONSUMER_KEY') and os.environ.get('MPESA_CONSUMER_SECRET'))
+
+
+def mpesa_access_token():
+    """Bearer token for Daraja: the cached OAuth token, or a static MPESA_ACCESS_TOKEN if no consumer key is set."""
+    if mpesa_uses_oauth():
+        return mpesa_tokens.get()
+    token = os.environ.get('MPESA_ACCESS_TOKEN', 'your_token_here')
+    return None if token == 'your_token_here' else token
+
+
+def mpesa_post(url, payload, idempotent=False):
+    """POST ``payload`` to Daraja with the current token, renewing it once if Daraja rejects it."""
+    token = mpesa_access_token()
+    response = mpesa_gateway.post(url, json=payload, idempotent=idempotent,
+                                  headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'})
+    if response.status_code == 401 and mpesa_uses_oauth():
+        # Nothing was processed, so even a payment prompt is safe to resend
+        mpesa_tokens.invalidate(token)
+        token = mpesa_access_token()
+        response = mpesa_gateway.post(url, json=payload, idempotent=idempotent,
+                                      headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'})
+    return response
+
+
 @app.route('/api/payments/mpesa/initiate', methods=['POST'])
 @jwt_required()
 def initiate_mpesa_payment():
     """Initiate M-Pesa STK Push payment with customer PIN prompt"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -2773,17 +4427,10 @@ def initiate_mpesa_payment():
         
         logger.info(f"M-Pesa API request data: {mpesa_data}")
         
-        # Make M-Pesa API call to Daraja
-        headers = {
-            'Authorization': f'Bearer {os.environ.get("MPESA_ACCESS_TOKEN", "your_token_here")}',
-            'Content-Type': 'application/json'
-        }
-        
         logger.info(f"Making M-Pesa API call to: {mpesa_api_url}")
         
         # Check if we're in test mode (no real credentials)
-        if (os.environ.get('MPESA_PASSKEY', 'your_passkey_here') == 'your_passkey_here' or 
-            os.environ.get('MPESA_ACCESS_TOKEN', 'your_token_here') == 'your_token_here'):
+        if not mpesa_credentials_configured():
             
             logger.warning("M-Pesa credentials not configured, using test mode")
             
@@ -2808,15 +4455,9 @@ def initiate_mpesa_payment():
                 processed_by=current_user
             )
             db.session.add(transaction)
+            record_audit(f'M-Pesa payment initiated for invoice {invoice_id}', user.username)
             db.session.commit()
-            
-            # Log the payment initiation
-            audit_log = AuditLog(
-                action=f'M-Pesa payment initiated for invoice {invoice_id}',
-                user=user.username
-            )
-            db.session.add(audit_log)
-            db.session.commit()
+            ensure_mpesa_reconciler()
             
             return jsonify({
                 'message': 'M-Pesa payment initiated successfully (TEST MODE)',
@@ -2826,7 +4467,7 @@ def initiate_mpesa_payment():
                 'transaction_id': transaction.id
             }), 200
         
-        response = requests.post(mpesa_api_url, json=mpesa_data, headers=headers)
+        response = mpesa_post(mpesa_api_url, mpesa_data)
         response_data = response.json()
         
         logger.info(f"M-Pesa API response status: {response.status_code}, data: {response_data}")
@@ -2844,15 +4485,9 @@ def initiate_mpesa_payment():
                 gateway_response=response_data
             )
             db.session.add(transaction)
+            record_audit(f'M-Pesa payment initiated for invoice {invoice_id} - Customer prompted to enter PIN', user.username)
             db.session.commit()
-            
-            # Log the payment initiation
-            audit_log = AuditLog(
-                action=f'M-Pesa payment initiated for invoice {invoice_id} - Customer prompted to enter PIN',
-                user=user.username
-            )
-            db.session.add(audit_log)
-            db.session.commit()
+            ensure_mpesa_reconciler()
             
             logger.info(f"M-Pesa payment initiated successfully for invoice {invoice_id}")
             
@@ -2871,63 +4506,315 @@ def initiate_mpesa_payment():
                 'error': response_data
             }), 400
             
+    except requests.Timeout as e:
+        logger.error(f"M-Pesa did not respond in time: {str(e)}")
+        return jsonify({'message': 'M-Pesa did not respond in time. Please try again.'}), 504
     except Exception as e:
         logger.error(f"Error initiating M-Pesa payment: {str(e)}")
         return jsonify({'message': f'Error initiating M-Pesa payment: {str(e)}'}), 500
 
+# M-Pesa results arrive by callback, but callbacks get lost. Rather than
+# every open payment screen querying Daraja, a reconciler in each worker
+# queries transactions still pending after MPESA_RECONCILE_AFTER_SECONDS,
+# a rate-limited batch at a time, and the status endpoint only reads the row.
+TEST_MODE_SETTLE_SECONDS = 5
+# Set once this worker has logged that real payments cannot be reconciled
+mpesa_reconcile_disabled_logged = threading.Event()
+
+
+def mpesa_credentials_configured():
+    return (os.environ.get('MPESA_PASSKEY', 'your_passkey_here') != 'your_passkey_here' and
+            (mpesa_uses_oauth() or os.environ.get('MPESA_ACCESS_TOKEN', 'your_token_here') != 'your_token_here'))
+
+
+def query_mpesa_status(checkout_request_id):
+    """Ask Daraja for the result of an STK push. Returns the ``requests`` response."""
+    mpesa_status_url = os.environ.get('MPESA_STATUS_URL', 'https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/query')
+    business_shortcode = os.environ.get('MPESA_BUSINESS_SHORTCODE', '174379')
+    passkey = os.environ.get('MPESA_PASSKEY', 'your_passkey_here')
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    status_data = {
+        "BusinessShortCode": business_shortcode,
+        "Password": f"{business_shortcode}{passkey}{timestamp}",
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id
+    }
+    # A status query changes nothing, so timeouts and 5xx answers may be retried
+    return mpesa_post(mpesa_status_url, status_data, idempotent=True)
+
+
+def settle_mpesa_transaction(transaction, succeeded, gateway_response, actor):
+    """Record the final result of a pending M-Pesa transaction and, on success, pay its invoice.
+
+    The status change is a conditional UPDATE on ``status = 'pending'``, so
+    when callbacks and the reconciler in several workers settle the same
+    transaction at once only one of them pays the invoice and writes the
+    audit row. The others get False and change nothing.
+    """
+    if transaction.status != 'pending':
+        return False
+    now = datetime.now(timezone.utc)
+    values = {'status': 'completed', 'completed_at': now} if succeeded else {'status': 'failed'}
+    settled = db.session.execute(
+        update(PaymentTransaction)
+        .where(PaymentTransaction.id == transaction.id, PaymentTransaction.status == 'pending')
+        .values(gateway_response=gateway_response, **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    # Reload either way: our values on success, the winner's on a lost race
+    db.session.expire(transaction)
+    if not settled:
+        return False
+    if succeeded:
+        invoice = db.session.get(Invoice, transaction.invoice_id, with_for_update=True)
+        if invoice:
+            mark_invoice_paid(invoice, 'M-Pesa', now)
+        record_audit(f'M-Pesa payment completed for invoice {transaction.invoice_id}', actor)
+    return True
+
+
+def reconcile_transaction(transaction):
+    """Query one pending transaction and settle it if Daraja has a final answer."""
+    if transaction.gateway_reference.startswith('test_checkout_'):
+        settle_mpesa_transaction(transaction, True, {
+            'ResultCode': '0',
+            'ResultDesc': 'TEST MODE: simulated completion',
+        }, 'mpesa-reconciler')
+        return
+    response = query_mpesa_status(transaction.gateway_reference)
+    status_response = response.json()
+    result_code = status_response.get('ResultCode')
+    # Non-200 answers mean "still processing" or a Daraja error; ResultCode 1 means no PIN yet
+    if response.status_code != 200 or result_code in (None, '1'):
+        return
+    settle_mpesa_transaction(transaction, result_code == '0', status_response, 'mpesa-reconciler')
+
+
+def reconcile_mpesa_payments():
+    """Query a batch of M-Pesa transactions whose callback is overdue.
+
+    Each row is claimed by stamping ``last_checked_at`` with a conditional
+    UPDATE, so workers running this concurrently never query the same
+    transaction twice within MPESA_RECONCILE_RECHECK_SECONDS. Returns True
+    if the batch was full and more rows may be due.
+    """
+    with app.app_context():
+        config = app.config
+        batch_size = config.get('MPESA_RECONCILE_BATCH_SIZE', 20)
+        now = datetime.now(timezone.utc)
+        is_test = PaymentTransaction.gateway_reference.startswith('test_checkout_')
+        overdue = PaymentTransaction.created_at < now - timedelta(seconds=config.get('MPESA_RECONCILE_AFTER_SECONDS', 30))
+        if not mpesa_credentials_configured():
+            # Without credentials only simulated (test mode) payments can be settled
+            if not mpesa_reconcile_disabled_logged.is_set():
+                stranded = db.session.scalar(
+                    select(func.count()).select_from(PaymentTransaction).where(
+                        PaymentTransaction.payment_method == 'mpesa',
+                        PaymentTransaction.status == 'pending',
+                        PaymentTransaction.gateway_reference.isnot(None),
+                        ~is_test,
+                        overdue,
+                    )
+                )
+                if stranded:
+                    mpesa_reconcile_disabled_logged.set()
+                    logger.warning(f"M-Pesa credentials not configured; {stranded} overdue payment(s) "
+                                   f"will only settle if their callback arrives")
+            overdue = false()
+        due = (
+            (PaymentTransaction.payment_method == 'mpesa')
+            & (PaymentTransaction.status == 'pending')
+            & PaymentTransaction.gateway_reference.isnot(None)
+            & or_(
+                ~is_test & overdue,
+                is_test & (PaymentTransaction.created_at < now - timedelta(seconds=TEST_MODE_SETTLE_SECONDS)),
+            )
+            & or_(
+                PaymentTransaction.last_checked_at.is_(None),
+                PaymentTransaction.last_checked_at < now - timedelta(seconds=config.get('MPESA_RECONCILE_RECHECK_SECONDS', 60)),
+            )
+        )
+        ids = db.session.scalars(
+            select(PaymentTransaction.id).where(due).order_by(PaymentTransaction.created_at).limit(batch_size)
+        ).all()
+        for transaction_id in ids:
+            claimed = db.session.execute(
+                update(PaymentTransaction)
+                .where(PaymentTransaction.id == transaction_id, due)
+                .values(last_checked_at=now)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                continue
+            transaction = db.session.get(PaymentTransaction, transaction_id)
+            if not transaction.gateway_reference.startswith('test_checkout_'):
+                while not mpesa_query_limiter.allow():
+                    time.sleep(1 / mpesa_query_limiter.rate)
+            try:
+                reconcile_transaction(transaction)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not reconcile M-Pesa transaction {transaction_id}: {str(e)}")
+        return len(ids) >= batch_size
+
+
+# Daraja status queries per second across one worker's reconciler
+mpesa_query_limiter = RateLimiter(app.config.get('MPESA_RECONCILE_RATE', 2), 1)
+mpesa_reconciler = PeriodicWorker(
+    reconcile_mpesa_payments,
+    interval=app.config.get('MPESA_RECONCILE_INTERVAL', 10),
+    name='mpesa-reconciler',
+)
+
+
+def ensure_mpesa_reconciler():
+    if app.config.get('MPESA_RECONCILER_ENABLED', True):
+        mpesa_reconciler.start()
+
+
+@app.cli.command('reconcile-mpesa')
+@click.option('--once', is_flag=True, help='Check one batch and exit instead of running until stopped.')
+def reconcile_mpesa(once):
+    """Settle overdue pending M-Pesa payments, for deployments that run this outside the web workers."""
+    if once:
+        more = mpesa_reconciler.run_once()
+        click.echo('More transactions are due' if more else 'Done')
+        return
+    mpesa_reconciler.start()
+    while True:
+        time.sleep(3600)
+
+
+class MpesaCallback(db.Model):
+    """A raw M-Pesa callback, stored before it is acted on."""
+    __tablename__ = 'mpesa_callback_inbox'
+    __table_args__ = (
+        db.Index('ix_mpesa_callback_inbox_processed_at_id', 'processed_at', 'id'),
+        db.Index('ix_mpesa_callback_inbox_checkout_request_id', 'checkout_request_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_request_id = db.Column(db.String(100))
+    payload = db.Column(db.JSON, nullable=False)
+    received_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    processed_at = db.Column(db.DateTime)
+    outcome = db.Column(db.String(20))  # completed, failed, duplicate, unknown, error
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+
+
+MPESA_INBOX_MAX_ATTEMPTS = 5
+mpesa_settlement_lag = LatencyStats()
+
+
+def process_mpesa_callback(callback):
+    """Apply one stored callback. Returns its outcome."""
+    transaction = PaymentTransaction.query.filter_by(gateway_reference=callback.checkout_request_id).first()
+    if not transaction:
+        logger.error(f"Transaction not found for checkout_request_id: {callback.checkout_request_id}")
+        return 'unknown'
+    succeeded = str(callback.payload.get('ResultCode')) == '0'
+    if not settle_mpesa_transaction(transaction, succeeded, callback.payload, 'mpesa-callback'):
+        logger.info(f"Transaction {transaction.id} was already {transaction.status}; callback {callback.id} ignored")
+        return 'duplicate'
+    logger.info(f"Payment {transaction.status} for transaction {transaction.id}")
+    return transaction.status
+
+
+def process_mpesa_inbox():
+    """Settle a batch of stored callbacks, oldest first.
+
+    A row is claimed by the conditional UPDATE of ``processed_at`` in the
+    same transaction that settles its payment, so a callback is applied at
+    most once however many workers are draining the inbox. Retries of one
+    CheckoutRequestID are separate rows; settle_mpesa_transaction lets only
+    one of them settle the payment and the rest end as ``duplicate``.
+    Returns True if the batch was full.
+    """
+    with app.app_context():
+        batch_size = app.config.get('MPESA_INBOX_BATCH_SIZE', 100)
+        ids = db.session.scalars(
+            select(MpesaCallback.id).where(MpesaCallback.processed_at.is_(None))
+            .order_by(MpesaCallback.id).limit(batch_size)
+        ).all()
+        for callback_id in ids:
+            now = datetime.now(timezone.utc)
+            try:
+                claimed = db.session.execute(
+                    update(MpesaCallback)
+                    .where(MpesaCallback.id == callback_id, MpesaCallback.processed_at.is_(None))
+                    .values(processed_at=now)
+                ).rowcount
+                if not claimed:
+                    db.session.rollback()
+                    continue
+                callback = db.session.get(MpesaCallback, callback_id)
+                callback.outcome = process_mpesa_callback(callback)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error processing M-Pesa callback {callback_id}: {str(e)}")
+                # Leave it for the next pass unless it keeps failing
+                attempts = MpesaCallback.attempts + 1
+                db.session.execute(
+                    update(MpesaCallback).where(MpesaCallback.id == callback_id).values(
+                        attempts=attempts,
+                        last_error=str(e),
+                        processed_at=case((attempts >= MPESA_INBOX_MAX_ATTEMPTS, now), else_=None),
+                        outcome=case((attempts >= MPESA_INBOX_MAX_ATTEMPTS, 'error'), else_=None),
+                    )
+                )
+                db.session.commit()
+                continue
+            mpesa_settlement_lag.observe((now - as_utc(callback.received_at)).total_seconds(), failed=callback.outcome == 'unknown')
+        return len(ids) >= batch_size
+
+
+mpesa_inbox_worker = PeriodicWorker(
+    process_mpesa_inbox,
+    interval=app.config.get('MPESA_INBOX_POLL_INTERVAL', 2),
+    name='mpesa-inbox',
+)
+
+
+@app.cli.command('process-mpesa-inbox')
+@click.option('--once', is_flag=True, help='Process one batch and exit instead of running until stopped.')
+def process_mpesa_inbox_command(once):
+    """Settle stored M-Pesa callbacks, for deployments that run this outside the web workers."""
+    if once:
+        more = mpesa_inbox_worker.run_once()
+        click.echo('More callbacks are waiting' if more else 'Done')
+        return
+    mpesa_inbox_worker.start()
+    while True:
+        time.sleep(3600)
+
+
 @app.route('/api/payments/mpesa/callback', methods=['POST'])
 def mpesa_callback():
-    """Handle M-Pesa payment callback"""
+    """Store an M-Pesa payment callback and acknowledge it; the inbox worker settles it"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'message': 'Invalid callback payload'}), 400
+    logger.info(f"M-Pesa callback received: {data}")
     try:
-        data = request.get_json()
-        logger.info(f"M-Pesa callback received: {data}")
-        
-        # Extract payment details
-        result_code = data.get('ResultCode')
-        checkout_request_id = data.get('CheckoutRequestID')
-        amount = data.get('Amount')
-        
-        # Find the transaction
-        transaction = PaymentTransaction.query.filter_by(
-            gateway_reference=checkout_request_id
-        ).first()
-        
-        if not transaction:
-            logger.error(f"Transaction not found for checkout_request_id: {checkout_request_id}")
-            return jsonify({'message': 'Transaction not found'}), 404
-        
-        if result_code == '0':  # Success
-            transaction.status = 'completed'
-            transaction.completed_at = datetime.now(timezone.utc)
-            transaction.gateway_response = data
-            
-            # Update invoice status
-            invoice = Invoice.query.get(transaction.invoice_id)
-            if invoice:
-                invoice.status = 'Paid'
-                invoice.paid_at = datetime.now(timezone.utc)
-                invoice.payment_method = 'M-Pesa'
-            
-            db.session.commit()
-            logger.info(f"Payment completed for transaction {transaction.id}")
-        else:
-            transaction.status = 'failed'
-            transaction.gateway_response = data
-            db.session.commit()
-            logger.error(f"Payment failed for transaction {transaction.id}")
-        
-        return jsonify({'message': 'Callback processed successfully'}), 200
-        
+        db.session.add(MpesaCallback(checkout_request_id=data.get('CheckoutRequestID'), payload=data))
+        db.session.commit()
     except Exception as e:
-        logger.error(f"Error processing M-Pesa callback: {str(e)}")
+        db.session.rollback()
+        logger.error(f"Error storing M-Pesa callback: {str(e)}")
         return jsonify({'message': f'Error processing callback: {str(e)}'}), 500
+    if app.config.get('MPESA_INBOX_WORKER_ENABLED', True):
+        mpesa_inbox_worker.start()
+        mpesa_inbox_worker.wake()
+    return jsonify({'message': 'Callback received'}), 200
 
 @app.route('/api/payments/confirm', methods=['POST'])
 @jwt_required()
 def confirm_payment():
     """Confirm a payment (for manual confirmations)"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -2948,14 +4835,9 @@ def confirm_payment():
         # Update invoice status
         invoice = Invoice.query.get(transaction.invoice_id)
         if invoice:
-            invoice.status = 'Paid'
-            invoice.paid_at = datetime.now(timezone.utc)
-            invoice.payment_method = payment_method
+            mark_invoice_paid(invoice, payment_method)
         
-        db.session.commit()
-        
-        audit_log = AuditLog(action=f'Payment confirmed for transaction {transaction_id}', user=user.username)
-        db.session.add(audit_log)
+        record_audit(f'Payment confirmed for transaction {transaction_id}', user.username)
         db.session.commit()
         
         return jsonify({
@@ -2973,7 +4855,7 @@ def confirm_payment():
 def get_payment_transactions():
     """Get payment transactions with filtering"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -2994,14 +4876,26 @@ def get_payment_transactions():
         if payment_method:
             query = query.filter_by(payment_method=payment_method)
         
-        transactions = query.order_by(PaymentTransaction.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            try:
+                transactions, next_cursor = keyset_page(
+                    query, PaymentTransaction.created_at, PaymentTransaction.id, cursor, per_page
+                )
+            except ValueError:
+                return jsonify({'message': 'Invalid cursor'}), 422
+            return jsonify({
+                'transactions': [t.to_dict() for t in transactions],
+                'next_cursor': next_cursor
+            }), 200
+        
+        transactions = paginate_query(query.order_by(PaymentTransaction.created_at.desc()), page, per_page)
         
         return jsonify({
             'transactions': [t.to_dict() for t in transactions.items],
             'total': transactions.total,
             'pages': transactions.pages,
+            'has_next': transactions.has_next,
             'page': page
         }), 200
         
@@ -3014,7 +4908,7 @@ def get_payment_transactions():
 def refund_payment():
     """Process payment refund"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -3032,6 +4926,17 @@ def refund_payment():
         if transaction.status != 'completed':
             return jsonify({'message': 'Can only refund completed transactions'}), 400
         
+        if transaction.payment_method == 'stripe' and wants_async():
+            return queue_stripe_job(PaymentTransaction(
+                invoice_id=transaction.invoice_id,
+                patient_id=transaction.patient_id,
+                amount=refund_amount,
+                payment_method='stripe_refund',
+                status='queued',
+                processed_by=current_user,
+                gateway_response={'reason': reason, 'original_transaction': transaction.id}
+            ), user.username)
+        
         # Process refund based on payment method
         if transaction.payment_method == 'stripe':
             # Stripe refund
@@ -3060,10 +4965,7 @@ def refund_payment():
         )
         
         db.session.add(refund_transaction)
-        db.session.commit()
-        
-        audit_log = AuditLog(action=f'Payment refund processed for transaction {transaction_id}', user=user.username)
-        db.session.add(audit_log)
+        record_audit(f'Payment refund processed for transaction {transaction_id}', user.username)
         db.session.commit()
         
         return jsonify({
@@ -3079,163 +4981,58 @@ def refund_payment():
 @app.route('/api/payments/mpesa/status/<checkout_request_id>', methods=['GET'])
 @jwt_required()
 def check_mpesa_payment_status(checkout_request_id):
-    """Check M-Pesa payment status after customer enters PIN"""
-    current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    """Report the M-Pesa payment status recorded by the callback or the reconciler"""
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
     
-    try:
-        # Find the transaction
-        transaction = PaymentTransaction.query.filter_by(
-            gateway_reference=checkout_request_id
-        ).first()
-        
-        if not transaction:
-            return jsonify({'message': 'Transaction not found'}), 404
-        
-        # Check if this is a test mode transaction
-        if checkout_request_id.startswith('test_checkout_'):
-            logger.info(f"Test mode transaction detected: {checkout_request_id}")
-            
-            # For test mode, simulate payment completion after a delay
-            # Ensure both datetimes are timezone-aware
-            current_time = datetime.now(timezone.utc)
-            created_time = transaction.created_at
-            if created_time.tzinfo is None:
-                created_time = created_time.replace(tzinfo=timezone.utc)
-            time_since_creation = (current_time - created_time).total_seconds()
-            
-            if time_since_creation > 5:  # Simulate completion after 5 seconds
-                # Mark as completed
-                transaction.status = 'completed'
-                transaction.completed_at = datetime.now(timezone.utc)
-                
-                # Update invoice status
-                invoice = Invoice.query.get(transaction.invoice_id)
-                if invoice:
-                    invoice.status = 'Paid'
-                    invoice.paid_at = datetime.now(timezone.utc)
-                    invoice.payment_method = 'M-Pesa'
-                
-                db.session.commit()
-                
-                audit_log = AuditLog(
-                    action=f'TEST MODE: M-Pesa payment completed for invoice {transaction.invoice_id}',
-                    user=user.username
-                )
-                db.session.add(audit_log)
-                db.session.commit()
-                
-                return jsonify({
-                    'status': 'completed',
-                    'message': 'TEST MODE: Payment completed successfully',
-                    'transaction': transaction.to_dict(),
-                    'test_mode': True
-                }), 200
-            else:
-                return jsonify({
-                    'status': 'pending',
-                    'message': 'TEST MODE: Simulating payment processing...',
-                    'test_mode': True
-                }), 200
-        
-        # For real transactions, check payment status from Daraja API
-        mpesa_status_url = os.environ.get('MPESA_STATUS_URL', 'https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/query')
-        business_shortcode = os.environ.get('MPESA_BUSINESS_SHORTCODE', '174379')
-        passkey = os.environ.get('MPESA_PASSKEY', 'your_passkey_here')
-        
-        # Check if we have real credentials
-        if (passkey == 'your_passkey_here' or 
-            os.environ.get('MPESA_ACCESS_TOKEN', 'your_token_here') == 'your_token_here'):
-            
-            logger.warning("M-Pesa credentials not configured, cannot check real payment status")
-            return jsonify({
-                'status': 'error',
-                'message': 'M-Pesa credentials not configured. Cannot check payment status.',
-                'error': 'Missing credentials'
-            }), 400
-        
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password = f"{business_shortcode}{passkey}{timestamp}"
-        
-        status_data = {
-            "BusinessShortCode": business_shortcode,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
+    transaction = PaymentTransaction.query.filter_by(
+        gateway_reference=checkout_request_id
+    ).first()
+    
+    if not transaction:
+        return jsonify({'message': 'Transaction not found'}), 404
+    
+    test_mode = checkout_request_id.startswith('test_checkout_')
+    if transaction.status == 'pending' and not test_mode and not mpesa_credentials_configured():
+        # Only a callback can settle it; the reconciler cannot query Daraja
+        body = {
+            'status': 'pending',
+            'message': 'M-Pesa credentials not configured. Cannot check payment status.',
+            'error': 'Missing credentials',
+            'reconcile_disabled': True,
         }
-        
-        headers = {
-            'Authorization': f'Bearer {os.environ.get("MPESA_ACCESS_TOKEN", "your_token_here")}',
-            'Content-Type': 'application/json'
+    elif transaction.status == 'pending':
+        ensure_mpesa_reconciler()
+        body = {
+            'status': 'pending',
+            'message': ('TEST MODE: Simulating payment processing...' if test_mode
+                        else 'Customer has not entered PIN yet. Please wait...'),
         }
-        
-        response = requests.post(mpesa_status_url, json=status_data, headers=headers)
-        status_response = response.json()
-        
-        if response.status_code == 200:
-            result_code = status_response.get('ResultCode')
-            if result_code == '0':
-                # Payment successful
-                transaction.status = 'completed'
-                transaction.completed_at = datetime.now(timezone.utc)
-                transaction.gateway_response = status_response
-                
-                # Update invoice status
-                invoice = Invoice.query.get(transaction.invoice_id)
-                if invoice:
-                    invoice.status = 'Paid'
-                    invoice.paid_at = datetime.now(timezone.utc)
-                    invoice.payment_method = 'M-Pesa'
-                
-                db.session.commit()
-                
-                audit_log = AuditLog(
-                    action=f'M-Pesa payment completed for invoice {transaction.invoice_id}',
-                    user=user.username
-                )
-                db.session.add(audit_log)
-                db.session.commit()
-                
-                return jsonify({
-                    'status': 'completed',
-                    'message': 'Payment completed successfully',
-                    'transaction': transaction.to_dict()
-                }), 200
-            elif result_code == '1':
-                return jsonify({
-                    'status': 'pending',
-                    'message': 'Customer has not entered PIN yet. Please wait...'
-                }), 200
-            else:
-                transaction.status = 'failed'
-                transaction.gateway_response = status_response
-                db.session.commit()
-                
-                return jsonify({
-                    'status': 'failed',
-                    'message': 'Payment failed or was cancelled',
-                    'error': status_response.get('ResultDesc', 'Unknown error')
-                }), 200
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to check payment status',
-                'error': status_response
-            }), 400
-            
-    except Exception as e:
-        logger.error(f"Error checking M-Pesa payment status: {str(e)}")
-        return jsonify({'message': f'Error checking payment status: {str(e)}'}), 500
+    elif transaction.status == 'failed':
+        body = {
+            'status': 'failed',
+            'message': 'Payment failed or was cancelled',
+            'error': (transaction.gateway_response or {}).get('ResultDesc', 'Unknown error'),
+        }
+    else:
+        body = {
+            'status': transaction.status,
+            'message': ('TEST MODE: Payment completed successfully' if test_mode
+                        else 'Payment completed successfully'),
+            'transaction': transaction.to_dict(),
+        }
+    if test_mode:
+        body['test_mode'] = True
+    return jsonify(body), 200
 
 @app.route('/api/payments/mpesa/test', methods=['GET'])
 @jwt_required()
 def test_mpesa_config():
     """Test M-Pesa configuration without making actual API calls"""
     current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = get_current_principal()
     
     if not user or not (has_role(user, 'Billing') or has_role(user, 'Admin')):
         return jsonify({'message': 'Unauthorized access'}), 403
@@ -3255,7 +5052,8 @@ def test_mpesa_config():
             'mpesa_api_url': mpesa_api_url,
             'business_shortcode': business_shortcode,
             'passkey_configured': passkey != 'your_passkey_here',
-            'access_token_configured': access_token != 'your_token_here',
+            'access_token_configured': mpesa_uses_oauth() or access_token != 'your_token_here',
+            'oauth_configured': mpesa_uses_oauth(),
             'timestamp': timestamp,
             'password_length': len(password),
             'callback_url': f"{request.host_url}api/payments/mpesa/callback"
@@ -3271,6 +5069,29 @@ def test_mpesa_config():
         logger.error(f"Error testing M-Pesa config: {str(e)}")
         return jsonify({'message': f'Error testing M-Pesa config: {str(e)}'}), 500
 
+@app.route('/api/payments/gateway-metrics', methods=['GET'])
+@jwt_required()
+def get_gateway_metrics():
+    """Per-endpoint call counts, failures and latency for outbound gateway calls"""
+    user = get_current_principal()
+    if not user or not (has_role(user, 'Admin') or has_role(user, 'IT')):
+        return jsonify({'message': 'Unauthorized access'}), 403
+    pending = db.session.execute(
+        select(func.count(MpesaCallback.id), func.min(MpesaCallback.received_at))
+        .where(MpesaCallback.processed_at.is_(None))
+    ).one()
+    oldest = as_utc(pending[1])
+    return jsonify({
+        'mpesa': mpesa_gateway.metrics(),
+        'stripe': stripe_gateway.metrics(),
+        'mpesa_callbacks': {
+            'pending': pending[0],
+            'oldest_pending_seconds': round((datetime.now(timezone.utc) - oldest).total_seconds(), 1) if oldest else None,
+            # Time from a callback being stored to its payment being settled, in this worker
+            'settlement_lag': mpesa_settlement_lag.snapshot(),
+        },
+    }), 200
+
 @app.route('/api/test', methods=['GET', 'POST'])
 def test_endpoint():
     """Simple test endpoint without authentication"""
@@ -0,0 +1,143 @@
+"""Fan-out of rows appended to an event table to in-process subscribers."""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One listener's view of a ChangeFeed. ``closed`` is set if it fell too far behind."""
+
+    def __init__(self, max_pending):
+        self.events = queue.Queue(maxsize=max_pending)
+        self.closed = False
+
+    def get(self, timeout):
+        """Return the next event, or None if nothing arrived within ``timeout`` seconds."""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeFeed:
+    """Tail an append-only event table once per process and hand new rows to every subscriber.
+
+    ``fetch(after_id, limit)`` returns up to ``limit`` events with an ``id``
+    greater than ``after_id`` in id order; ``latest()`` returns the current
+    highest id. A single daemon thread polls every ``poll_interval`` seconds, and only
+    while someone is subscribed, so the table is read once per worker rather
+    than once per connected client and not at all when nobody is listening.
+    Writers in the same process call :meth:`notify` after committing to
+    skip the wait.
+
+    Ids are handed out before commit, so on PostgreSQL an event can become
+    visible after a higher id has already been read. Ids skipped over are
+    remembered and, if ``fetch_ids(ids)`` is given, looked up again on each
+    poll for ``gap_timeout`` seconds. The guarantee is: every event is
+    delivered at most once, normally in id order, and an event that commits
+    late is still delivered (out of order) if it becomes visible within
+    ``gap_timeout`` seconds of a later one. Gaps left by rolled-back
+    transactions simply expire.
+    """
+
+    def __init__(self, fetch, latest, fetch_ids=None, poll_interval=0.5, batch_size=500, max_pending=1000,
+                 gap_timeout=30.0, max_gaps=1000, name='change-feed'):
+        self._fetch = fetch
+        self._latest = latest
+        self._fetch_ids = fetch_ids
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.gap_timeout = gap_timeout
+        self.max_gaps = max_gaps
+        self.name = name
+        self._subscribers = set()
+        self._last_id = None
+        self._gaps = {}  # Skipped id -> monotonic time it was first skipped
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self):
+        subscription = Subscription(self.max_pending)
+        # Read outside the lock so a slow query does not hold up the poller or other subscribers
+        latest = self._latest() if self._last_id is None else None
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = latest or 0
+            self._subscribers.add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+            if not self._subscribers:
+                self._last_id = None
+                self._gaps.clear()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    continue
+                last_id = self._last_id
+                now = time.monotonic()
+                for gap, since in list(self._gaps.items()):
+                    if now - since > self.gap_timeout:
+                        del self._gaps[gap]
+                gaps = sorted(self._gaps)
+            try:
+                events = self._fetch(last_id, self.batch_size)
+                late = self._fetch_ids(gaps) if gaps and self._fetch_ids is not None else []
+            except Exception:
+                logger.exception('%s failed to read new events', self.name)
+                continue
+            if not events and not late:
+                continue
+            with self._lock:
+                # A concurrent unsubscribe-all/subscribe may have moved the baseline.
+                if self._last_id != last_id:
+                    continue
+                late = [event for event in late if self._gaps.pop(event['id'], None) is not None]
+                if events:
+                    self._track_gaps(last_id, [event['id'] for event in events])
+                    self._last_id = events[-1]['id']
+                subscribers = list(self._subscribers)
+            events = late + events
+            for subscription in subscribers:
+                for event in events:
+                    try:
+                        subscription.events.put_nowait(event)
+                    except queue.Full:
+                        subscription.closed = True
+                        self.unsubscribe(subscription)
+                        break
+            if len(events) - len(late) >= self.batch_size:
+                # More may be waiting behind a full page; read again right away.
+                self._wake.set()
+
+    def _track_gaps(self, last_id, ids):
+        if self._fetch_ids is None:
+            return
+        now = time.monotonic()
+        previous = last_id
+        for event_id in ids:
+            for missing in range(max(previous + 1, event_id - self.max_gaps), event_id):
+                self._gaps.setdefault(missing, now)
+            previous = event_id
+        if len(self._gaps) > self.max_gaps:
+            # Keep the newest; the rest are most likely rolled back
+            for gap in sorted(self._gaps)[:len(self._gaps) - self.max_gaps]:
+                del self._gaps[gap]
@@ -0,0 +1,27 @@
+"""Conditional GET: strong ETags built from version stamps, answered with 304 Not Modified."""
+import hashlib
+
+from flask import Response, request
+
+
+def version_etag(*parts):
+    """A strong ETag for a response fully determined by ``parts`` (version stamps, URL, caller's roles)."""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Return a 304 response if the request's If-None-Match already names ``etag``, else None.
+
+    Call it after checking only the version stamps, so a client polling an
+    unchanged resource never makes the view load or serialize it.
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag)
+
+
+def with_etag(response, etag):
+    """Tag ``response`` with ``etag`` and ask clients to revalidate before reusing it."""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
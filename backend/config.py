@@ -9,4 +9,80 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'your-secret-key'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
+    # Sign role names (and a Patient's patient_id) into access tokens so routes authorize without a DB round trip
+    JWT_AUTHZ_CLAIMS = os.environ.get('JWT_AUTHZ_CLAIMS', 'true').lower() == 'true'
+    # Seconds a worker may reuse a user's token version. A role change only clears the cache in the worker that made it,
+    # so other workers keep honouring the old roles for up to this long; 0 re-reads it on every request
+    TOKEN_VERSION_CACHE_SECONDS = int(os.environ.get('TOKEN_VERSION_CACHE_SECONDS', 0))
+    # How long ?total=estimate may reuse a cached row count on databases without planner estimates
+    COUNT_CACHE_SECONDS = int(os.environ.get('COUNT_CACHE_SECONDS', 60))
+    # auto picks FTS5 on SQLite and pg_trgm on PostgreSQL; like/fts5/trgm force a backend
+    PATIENT_SEARCH_BACKEND = os.environ.get('PATIENT_SEARCH_BACKEND', 'auto')
+    # Patients inserted per multi-row INSERT (and transaction) by POST /api/patients/bulk, and rejected rows listed in its report
+    PATIENT_IMPORT_CHUNK_SIZE = int(os.environ.get('PATIENT_IMPORT_CHUNK_SIZE', 1000))
+    PATIENT_IMPORT_MAX_ERRORS = int(os.environ.get('PATIENT_IMPORT_MAX_ERRORS', 1000))
+    # Most readings POST /api/vitals/batch accepts in one request
+    VITALS_BATCH_MAX_READINGS = int(os.environ.get('VITALS_BATCH_MAX_READINGS', 10000))
+    # Most readings GET /api/patients/<id>/vitals?resolution=raw returns
+    VITALS_RAW_MAX_POINTS = int(os.environ.get('VITALS_RAW_MAX_POINTS', 5000))
+    # Facility this deployment records daily_rollup figures under (and GET /api/dashboard/summary reports by default)
+    FACILITY_ID = os.environ.get('FACILITY_ID', 'main')
+    # Days after a month or year ends before GET /api/finance/summary treats it as closed and caches its totals
+    FINANCE_CLOSE_AFTER_DAYS = int(os.environ.get('FINANCE_CLOSE_AFTER_DAYS', 7))
+    # Rows fetched per round trip when a list endpoint streams application/x-ndjson
+    NDJSON_YIELD_PER = int(os.environ.get('NDJSON_YIELD_PER', 500))
+    # Write audit entries in the request's own transaction instead of the batched background sink
+    AUDIT_STRICT = os.environ.get('AUDIT_STRICT', 'false').lower() == 'true'
+    # Background audit sink: queue bound, rows per INSERT and the longest an entry waits before it is flushed
+    AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+    AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))
+    # Identical errors (same fingerprint) within this many seconds are counted on one ErrorLog row
+    ERROR_LOG_DEDUP_WINDOW = int(os.environ.get('ERROR_LOG_DEDUP_WINDOW', 300))
+    # ErrorLog entries accepted per second (token bucket refill) and the burst allowed on top
+    ERROR_LOG_RATE = float(os.environ.get('ERROR_LOG_RATE', 20))
+    ERROR_LOG_BURST = int(os.environ.get('ERROR_LOG_BURST', 100))
+    ERROR_LOG_QUEUE_SIZE = int(os.environ.get('ERROR_LOG_QUEUE_SIZE', 1000))
+    ERROR_LOG_FLUSH_INTERVAL = float(os.environ.get('ERROR_LOG_FLUSH_INTERVAL', 2.0))
+    # How often each worker checks visit_event for changes made by other workers while clients are streaming
+    VISIT_FEED_POLL_INTERVAL = float(os.environ.get('VISIT_FEED_POLL_INTERVAL', 0.5))
+    # Seconds the feed keeps looking for a visit event whose id was skipped because its transaction committed late
+    VISIT_FEED_GAP_TIMEOUT = float(os.environ.get('VISIT_FEED_GAP_TIMEOUT', 30))
+    # Idle seconds between keepalive comments on server-sent event streams
+    SSE_KEEPALIVE_SECONDS = int(os.environ.get('SSE_KEEPALIVE_SECONDS', 15))
+    # Event streams each worker serves at once (each holds a thread); more get 503 with Retry-After SSE_RETRY_AFTER_SECONDS.
+    # Keep it well below the gunicorn --threads count so ordinary requests still have threads to run on
+    SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))
+    SSE_RETRY_AFTER_SECONDS = int(os.environ.get('SSE_RETRY_AFTER_SECONDS', 30))
+    # Average minutes spent with each patient, used for queue ETAs
+    QUEUE_MINUTES_PER_PATIENT = int(os.environ.get('QUEUE_MINUTES_PER_PATIENT', 10))
+    # Outbound payment gateway calls: seconds to connect and to wait for a response
+    GATEWAY_CONNECT_TIMEOUT = float(os.environ.get('GATEWAY_CONNECT_TIMEOUT', 3.05))
+    GATEWAY_READ_TIMEOUT = float(os.environ.get('GATEWAY_READ_TIMEOUT', 15))
+    # Retries for calls that are safe to resend, with jittered exponential backoff starting at GATEWAY_BACKOFF_SECONDS
+    GATEWAY_MAX_RETRIES = int(os.environ.get('GATEWAY_MAX_RETRIES', 2))
+    GATEWAY_BACKOFF_SECONDS = float(os.environ.get('GATEWAY_BACKOFF_SECONDS', 0.5))
+    # Keep-alive connections held per gateway in each worker
+    GATEWAY_POOL_SIZE = int(os.environ.get('GATEWAY_POOL_SIZE', 10))
+    # Run the M-Pesa reconciler inside each web worker; set false when `flask reconcile-mpesa` runs separately
+    MPESA_RECONCILER_ENABLED = os.environ.get('MPESA_RECONCILER_ENABLED', 'true').lower() == 'true'
+    # Query Daraja for pending M-Pesa payments whose callback is this many seconds overdue, re-asking at most every RECHECK seconds
+    MPESA_RECONCILE_AFTER_SECONDS = int(os.environ.get('MPESA_RECONCILE_AFTER_SECONDS', 30))
+    MPESA_RECONCILE_RECHECK_SECONDS = int(os.environ.get('MPESA_RECONCILE_RECHECK_SECONDS', 60))
+    # Seconds between reconciler passes, transactions per pass and status queries per second
+    MPESA_RECONCILE_INTERVAL = float(os.environ.get('MPESA_RECONCILE_INTERVAL', 10))
+    MPESA_RECONCILE_BATCH_SIZE = int(os.environ.get('MPESA_RECONCILE_BATCH_SIZE', 20))
+    MPESA_RECONCILE_RATE = float(os.environ.get('MPESA_RECONCILE_RATE', 2))
+    # Settle stored M-Pesa callbacks on a thread in each web worker; set false when `flask process-mpesa-inbox` runs separately
+    MPESA_INBOX_WORKER_ENABLED = os.environ.get('MPESA_INBOX_WORKER_ENABLED', 'true').lower() == 'true'
+    # Callbacks settled per pass, and seconds between passes when no callback has woken the worker
+    MPESA_INBOX_BATCH_SIZE = int(os.environ.get('MPESA_INBOX_BATCH_SIZE', 100))
+    MPESA_INBOX_POLL_INTERVAL = float(os.environ.get('MPESA_INBOX_POLL_INTERVAL', 2))
+    # Threads making Stripe calls for ?async=true requests in each worker, and how many more may wait before requests get 503
+    STRIPE_JOB_WORKERS = int(os.environ.get('STRIPE_JOB_WORKERS', 4))
+    STRIPE_JOB_QUEUE_SIZE = int(os.environ.get('STRIPE_JOB_QUEUE_SIZE', 100))
+    # A running Stripe job whose claim is older than this many seconds lost its worker; polling its status runs it again
+    STRIPE_JOB_STALE_SECONDS = int(os.environ.get('STRIPE_JOB_STALE_SECONDS', 120))
+    # Renew the cached Daraja OAuth token this many seconds before it expires
+    MPESA_TOKEN_REFRESH_MARGIN = int(os.environ.get('MPESA_TOKEN_REFRESH_MARGIN', 300))
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key'
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""Pooled outbound HTTP client for payment gateways."""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = frozenset({429, 502, 503, 504})
+
+
+def never_sent(error):
+    """True if ``error`` happened before the request reached the server, so resending is safe."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class LatencyStats:
+    """Call count, failures and latency percentiles over the most recent calls."""
+
+    def __init__(self, window=500):
+        self.calls = 0
+        self.failures = 0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, failed=False):
+        with self._lock:
+            self.calls += 1
+            if failed:
+                self.failures += 1
+            self._samples.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(samples[-1] * 1000, 1) if samples else None,
+        }
+
+
+class GatewayClient:
+    """A keep-alive ``requests.Session`` with deadlines, bounded retries and latency metrics.
+
+    Every call gets ``(connect_timeout, read_timeout)`` unless it passes its
+    own ``timeout``. Failures to connect are retried up to ``retries`` times
+    with jittered exponential backoff, since the request never reached the
+    gateway. Read timeouts and 429/5xx answers are only retried for calls
+    marked ``idempotent=True``, so a payment prompt is never sent twice.
+    Latency is recorded per ``METHOD /path`` for every attempt, including
+    calls third-party SDKs make through :attr:`session`.
+    """
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=15, retries=2, backoff=0.5, pool_size=10):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(self._observe_response)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, idempotent=False, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self._record(method, url, time.monotonic() - started, failed=True)
+                if attempt >= self.retries or not (idempotent or never_sent(e)):
+                    raise
+                logger.warning(f"{self.name} {method} {url} failed ({e}); retrying")
+            else:
+                if not (idempotent and response.status_code in RETRYABLE_STATUSES and attempt < self.retries):
+                    return response
+                logger.warning(f"{self.name} {method} {url} returned {response.status_code}; retrying")
+            attempt += 1
+            time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, idempotent=True, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def metrics(self):
+        with self._lock:
+            return {key: stats.snapshot() for key, stats in sorted(self._stats.items())}
+
+    def _observe_response(self, response, *args, **kwargs):
+        self._record(response.request.method, response.url, response.elapsed.total_seconds(),
+                     failed=response.status_code >= 500)
+
+    def _record(self, method, url, seconds, failed=False):
+        key = f'{method} {urlsplit(url).path}'
+        with self._lock:
+            self._stats.setdefault(key, LatencyStats()).observe(seconds, failed)
+
+
+class AccessTokenManager:
+    """Cache an OAuth access token and fetch a new one shortly before it expires.
+
+    ``fetch()`` returns ``(token, expires_in_seconds)``. ``load()`` and
+    ``save(token, expires_at)`` optionally share the token through a store
+    every worker process can see, with ``expires_at`` in epoch seconds, so a
+    refresh in one worker is picked up by the rest instead of each fetching
+    its own. The store is not locked, so processes that reach the refresh
+    margin together may each fetch; the last ``save`` wins. Within a process
+    only one thread refreshes at a time: once a token is within
+    ``refresh_margin`` seconds of expiry one caller renews it while the
+    others keep using the still-valid token, and callers only wait when
+    there is no valid token at all.
+    """
+
+    def __init__(self, fetch, load=None, save=None, refresh_margin=300, name='access-token'):
+        self._fetch = fetch
+        self._load = load
+        self._save = save
+        self.refresh_margin = refresh_margin
+        self.name = name
+        self.fetches = 0
+        self._token = None
+        self._expires_at = 0.0
+        self._rejected = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        token, expires_at = self._token, self._expires_at
+        now = time.time()
+        if token and now < expires_at - self.refresh_margin:
+            return token
+        if token and now < expires_at:
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._refresh()
+                except Exception:
+                    logger.exception('%s refresh failed; using the current token until it expires', self.name)
+                finally:
+                    self._lock.release()
+            return self._token
+        with self._lock:
+            if not (self._token and time.time() < self._expires_at - self.refresh_margin):
+                self._refresh()
+            return self._token
+
+    def invalidate(self, token):
+        """Forget ``token`` after the gateway rejected it, so the next :meth:`get` fetches a new one."""
+        with self._lock:
+            self._rejected = token
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def _refresh(self):
+        if self._load is not None:
+            try:
+                shared = self._load()
+            except Exception:
+                logger.exception('%s could not read the shared token', self.name)
+                shared = None
+            if shared and shared[0] != self._rejected and time.time() < shared[1] - self.refresh_margin:
+                self._token, self._expires_at = shared
+                return
+        token, expires_in = self._fetch()
+        self.fetches += 1
+        self._token, self._expires_at = token, time.time() + float(expires_in)
+        if self._save is not None:
+            try:
+                self._save(self._token, self._expires_at)
+            except Exception:
+                logger.exception('%s could not share the new token', self.name)
@@ -0,0 +1,26 @@
+"""add payroll period_start index
+
+Revision ID: 2c8f5a1e7d49
+Revises: 9b4e2d6a1c73
+Create Date: 2026-10-17 22:41:52.904117
+
+GET /api/finance/summary sums payroll over ranges of period_start.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8f5a1e7d49'
+down_revision = '9b4e2d6a1c73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'payroll' in sa.inspect(op.get_bind()).get_table_names():
+        op.create_index('ix_payroll_period_start', 'payroll', ['period_start'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_payroll_period_start', table_name='payroll', if_exists=True)
@@ -0,0 +1,30 @@
+"""add user.token_version
+
+Revision ID: 3f1c2a7b9d10
+Revises:
+Create Date: 2026-10-17 09:12:41.118203
+
+Tables are created by ``db.create_all()`` (see init_db.py), so revisions only
+carry incremental changes and skip work the current models already created.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7b9d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('user')}
+    if 'token_version' not in columns:
+        with op.batch_alter_table('user') as batch_op:
+            batch_op.add_column(sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('token_version')
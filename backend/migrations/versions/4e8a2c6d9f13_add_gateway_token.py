@@ -0,0 +1,35 @@
+"""add gateway_token
+
+Revision ID: 4e8a2c6d9f13
+Revises: b6d0e8f3a215
+Create Date: 2026-10-17 19:41:08.227913
+
+Holds the current Daraja OAuth token so every worker reuses one token
+instead of fetching its own. There is no cross-process lock: workers that
+reach the refresh margin at the same moment may each renew it, and the last
+one saved wins.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8a2c6d9f13'
+down_revision = 'b6d0e8f3a215'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'gateway_token' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'gateway_token',
+            sa.Column('name', sa.String(length=50), nullable=False),
+            sa.Column('access_token', sa.Text(), nullable=False),
+            sa.Column('expires_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('name'),
+        )
+
+
+def downgrade():
+    op.drop_table('gateway_token')
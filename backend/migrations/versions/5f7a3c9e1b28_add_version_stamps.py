@@ -0,0 +1,47 @@
+"""add version stamps for conditional GET
+
+Revision ID: 5f7a3c9e1b28
+Revises: 2c8f5a1e7d49
+Create Date: 2026-10-17 23:05:11.672390
+
+Adds a version counter to patient, medical_record, patient_visit, invoice
+and communication_settings, bumped by every ORM update, and the
+collection_version table of per-table write counters. Read endpoints build
+their ETags from these.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f7a3c9e1b28'
+down_revision = '2c8f5a1e7d49'
+branch_labels = None
+depends_on = None
+
+TABLES = ['patient', 'medical_record', 'patient_visit', 'invoice', 'communication_settings']
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing = inspector.get_table_names()
+    for table in TABLES:
+        if table in existing and 'version' not in {c['name'] for c in inspector.get_columns(table)}:
+            # A plain ADD/DROP COLUMN, since rebuilding patient on SQLite would drop its search triggers
+            op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    if 'collection_version' not in existing:
+        op.create_table(
+            'collection_version',
+            sa.Column('name', sa.String(length=50), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('name'),
+        )
+
+
+def downgrade():
+    op.drop_table('collection_version')
+    inspector = sa.inspect(op.get_bind())
+    existing = inspector.get_table_names()
+    for table in TABLES:
+        if table in existing and 'version' in {c['name'] for c in inspector.get_columns(table)}:
+            op.drop_column(table, 'version')
@@ -0,0 +1,26 @@
+"""add queue_entry checked_in index
+
+Revision ID: 6d2b8f4a3e91
+Revises: 5f7a3c9e1b28
+Create Date: 2026-10-17 23:12:37.518204
+
+POST /api/queue/next?checked_in=true takes the oldest checked-in entry.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d2b8f4a3e91'
+down_revision = '5f7a3c9e1b28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'queue_entry' in sa.inspect(op.get_bind()).get_table_names():
+        op.create_index('ix_queue_entry_checked_in_id', 'queue_entry', ['checked_in', 'id'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_queue_entry_checked_in_id', table_name='queue_entry', if_exists=True)
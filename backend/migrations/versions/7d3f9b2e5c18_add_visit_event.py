@@ -0,0 +1,40 @@
+"""add visit_event
+
+Revision ID: 7d3f9b2e5c18
+Revises: e2b7c41d9a56
+Create Date: 2026-10-17 16:05:47.219836
+
+Append-only log of PatientVisit stage changes tailed by
+/api/patient-visits/stream. Old rows are removed with
+``flask prune-visit-events``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3f9b2e5c18'
+down_revision = 'e2b7c41d9a56'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'visit_event' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'visit_event',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('visit_id', sa.Integer(), nullable=False),
+            sa.Column('stage', sa.String(length=20), nullable=False),
+            sa.Column('previous_stage', sa.String(length=20), nullable=True),
+            sa.Column('payload', sa.JSON(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['visit_id'], ['patient_visit.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    op.create_index('ix_visit_event_created_at', 'visit_event', ['created_at'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_visit_event_created_at', table_name='visit_event', if_exists=True)
+    op.drop_table('visit_event')
@@ -0,0 +1,40 @@
+"""add daily operational rollups
+
+Revision ID: 9b4e2d6a1c73
+Revises: f1c9b3d7e482
+Create Date: 2026-10-17 22:14:05.318462
+
+Adds daily_rollup, the per facility, day, metric and dimension counters and
+sums behind GET /api/dashboard/summary. Run `flask rebuild-daily-rollups`
+once after upgrading to fill it from existing invoices, visits and lab orders.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e2d6a1c73'
+down_revision = 'f1c9b3d7e482'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'daily_rollup' not in inspector.get_table_names():
+        op.create_table(
+            'daily_rollup',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('facility', sa.String(length=50), nullable=False),
+            sa.Column('day', sa.Date(), nullable=False),
+            sa.Column('metric', sa.String(length=20), nullable=False),
+            sa.Column('dimension', sa.String(length=50), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.Column('amount', sa.Numeric(precision=14, scale=2), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('facility', 'day', 'metric', 'dimension', name='uq_daily_rollup_bucket'),
+        )
+
+
+def downgrade():
+    op.drop_table('daily_rollup')
@@ -0,0 +1,40 @@
+"""add queue_entry
+
+Revision ID: a91c5e3b7f24
+Revises: 7d3f9b2e5c18
+Create Date: 2026-10-17 17:48:03.662154
+
+Replaces the per-process list behind /api/queue with a table every worker
+shares; queue_key is unique so check-in and position lookups are one index
+probe.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91c5e3b7f24'
+down_revision = '7d3f9b2e5c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'queue_entry' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'queue_entry',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('queue_key', sa.String(length=50), nullable=False),
+            sa.Column('patient_id', sa.Integer(), nullable=True),
+            sa.Column('name', sa.String(length=100), nullable=False),
+            sa.Column('checked_in', sa.Boolean(), nullable=False),
+            sa.Column('enqueued_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['patient_id'], ['patient.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    op.create_index('ix_queue_entry_queue_key', 'queue_entry', ['queue_key'], unique=True, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_queue_entry_queue_key', table_name='queue_entry', if_exists=True)
+    op.drop_table('queue_entry')
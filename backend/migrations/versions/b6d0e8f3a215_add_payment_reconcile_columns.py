@@ -0,0 +1,33 @@
+"""add payment_transaction reconcile columns
+
+Revision ID: b6d0e8f3a215
+Revises: a91c5e3b7f24
+Create Date: 2026-10-17 19:02:41.318540
+
+The M-Pesa reconciler stamps last_checked_at when it queries a pending
+transaction, and finds overdue ones through the (status, created_at) index.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d0e8f3a215'
+down_revision = 'a91c5e3b7f24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('payment_transaction')}
+    if 'last_checked_at' not in columns:
+        with op.batch_alter_table('payment_transaction') as batch_op:
+            batch_op.add_column(sa.Column('last_checked_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_payment_transaction_status_created_at', 'payment_transaction', ['status', 'created_at'],
+                    if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_payment_transaction_status_created_at', table_name='payment_transaction', if_exists=True)
+    with op.batch_alter_table('payment_transaction') as batch_op:
+        batch_op.drop_column('last_checked_at')
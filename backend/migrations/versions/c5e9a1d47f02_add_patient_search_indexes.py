@@ -0,0 +1,66 @@
+"""add patient search indexes
+
+Revision ID: c5e9a1d47f02
+Revises: 8a4d6e2f1b37
+Create Date: 2026-10-17 11:20:54.301772
+
+SQLite gets an external-content FTS5 table kept in sync by triggers and is
+backfilled with a 'rebuild'. PostgreSQL gets pg_trgm GIN indexes on
+patient.name and patient.contact.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e9a1d47f02'
+down_revision = '8a4d6e2f1b37'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS patient_fts USING fts5("
+    "name, contact, content='patient', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ai AFTER INSERT ON patient BEGIN "
+    "INSERT INTO patient_fts(rowid, name, contact) VALUES (new.id, new.name, new.contact); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ad AFTER DELETE ON patient BEGIN "
+    "INSERT INTO patient_fts(patient_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_au AFTER UPDATE OF name, contact ON patient BEGIN "
+    "INSERT INTO patient_fts(patient_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact); "
+    "INSERT INTO patient_fts(rowid, name, contact) VALUES (new.id, new.name, new.contact); END",
+    "INSERT INTO patient_fts(patient_fts) VALUES ('rebuild')",
+]
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS patient_fts_au",
+    "DROP TRIGGER IF EXISTS patient_fts_ad",
+    "DROP TRIGGER IF EXISTS patient_fts_ai",
+    "DROP TABLE IF EXISTS patient_fts",
+]
+POSTGRESQL_UPGRADE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patient_name_trgm ON patient USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patient_contact_trgm ON patient USING gin (contact gin_trgm_ops)",
+]
+POSTGRESQL_DOWNGRADE = [
+    "DROP INDEX IF EXISTS ix_patient_contact_trgm",
+    "DROP INDEX IF EXISTS ix_patient_name_trgm",
+]
+
+
+def _statements(upgrade):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return SQLITE_UPGRADE if upgrade else SQLITE_DOWNGRADE
+    if dialect == 'postgresql':
+        return POSTGRESQL_UPGRADE if upgrade else POSTGRESQL_DOWNGRADE
+    return []
+
+
+def upgrade():
+    for statement in _statements(upgrade=True):
+        op.execute(statement)
+
+
+def downgrade():
+    for statement in _statements(upgrade=False):
+        op.execute(statement)
@@ -0,0 +1,44 @@
+"""add mpesa_callback_inbox
+
+Revision ID: d3a7f1e5b920
+Revises: 4e8a2c6d9f13
+Create Date: 2026-10-17 20:15:52.904117
+
+M-Pesa callbacks are stored here and acknowledged straight away; a worker
+settles them afterwards, picking unprocessed rows off (processed_at, id).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7f1e5b920'
+down_revision = '4e8a2c6d9f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'mpesa_callback_inbox' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'mpesa_callback_inbox',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('checkout_request_id', sa.String(length=100), nullable=True),
+            sa.Column('payload', sa.JSON(), nullable=False),
+            sa.Column('received_at', sa.DateTime(), nullable=False),
+            sa.Column('processed_at', sa.DateTime(), nullable=True),
+            sa.Column('outcome', sa.String(length=20), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('last_error', sa.Text(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    op.create_index('ix_mpesa_callback_inbox_processed_at_id', 'mpesa_callback_inbox', ['processed_at', 'id'],
+                    if_not_exists=True)
+    op.create_index('ix_mpesa_callback_inbox_checkout_request_id', 'mpesa_callback_inbox', ['checkout_request_id'],
+                    if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_mpesa_callback_inbox_checkout_request_id', table_name='mpesa_callback_inbox', if_exists=True)
+    op.drop_index('ix_mpesa_callback_inbox_processed_at_id', table_name='mpesa_callback_inbox', if_exists=True)
+    op.drop_table('mpesa_callback_inbox')
@@ -0,0 +1,38 @@
+"""add error_log dedup columns
+
+Revision ID: e2b7c41d9a56
+Revises: c5e9a1d47f02
+Create Date: 2026-10-17 14:36:12.804519
+
+Repeats of one error within the dedup window are counted on a single row
+keyed by fingerprint instead of being inserted again.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c41d9a56'
+down_revision = 'c5e9a1d47f02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('error_log')}
+    with op.batch_alter_table('error_log') as batch_op:
+        if 'fingerprint' not in columns:
+            batch_op.add_column(sa.Column('fingerprint', sa.String(length=40), nullable=True))
+        if 'count' not in columns:
+            batch_op.add_column(sa.Column('count', sa.Integer(), nullable=False, server_default='1'))
+        if 'last_seen' not in columns:
+            batch_op.add_column(sa.Column('last_seen', sa.DateTime(), nullable=True))
+    op.create_index('ix_error_log_fingerprint_timestamp', 'error_log', ['fingerprint', 'timestamp'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_error_log_fingerprint_timestamp', table_name='error_log', if_exists=True)
+    with op.batch_alter_table('error_log') as batch_op:
+        batch_op.drop_column('last_seen')
+        batch_op.drop_column('count')
+        batch_op.drop_column('fingerprint')
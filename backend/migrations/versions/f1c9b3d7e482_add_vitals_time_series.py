@@ -0,0 +1,82 @@
+"""add vitals time series columns and rollups
+
+Revision ID: f1c9b3d7e482
+Revises: d3a7f1e5b920
+Create Date: 2026-10-17 21:06:37.551208
+
+Splits blood_pressure into systolic/diastolic (backfilled from existing
+rows), indexes vitals by (patient_id, recorded_at) and adds the hourly and
+daily vitals_rollup table. Run `flask rebuild-vitals-rollups` once after
+upgrading to roll up readings recorded before this revision.
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c9b3d7e482'
+down_revision = 'd3a7f1e5b920'
+branch_labels = None
+depends_on = None
+
+BLOOD_PRESSURE = re.compile(r'^\s*(\d{2,3})\s*/\s*(\d{2,3})\s*$')
+METRICS = [
+    ('systolic', sa.Integer), ('diastolic', sa.Integer), ('temperature', sa.Float),
+    ('pulse', sa.Integer), ('respiration', sa.Integer),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'vitals' in inspector.get_table_names():
+        columns = {c['name'] for c in inspector.get_columns('vitals')}
+        with op.batch_alter_table('vitals') as batch_op:
+            if 'systolic' not in columns:
+                batch_op.add_column(sa.Column('systolic', sa.Integer(), nullable=True))
+            if 'diastolic' not in columns:
+                batch_op.add_column(sa.Column('diastolic', sa.Integer(), nullable=True))
+        op.create_index('ix_vitals_patient_id_recorded_at', 'vitals', ['patient_id', 'recorded_at'], if_not_exists=True)
+
+        vitals = sa.table('vitals', sa.column('id', sa.Integer), sa.column('blood_pressure', sa.String),
+                          sa.column('systolic', sa.Integer), sa.column('diastolic', sa.Integer))
+        updates = []
+        for row in bind.execute(sa.select(vitals.c.id, vitals.c.blood_pressure).where(vitals.c.systolic.is_(None))):
+            match = BLOOD_PRESSURE.match(row.blood_pressure or '')
+            if match:
+                updates.append({'row_id': row.id, 'sys': int(match.group(1)), 'dia': int(match.group(2))})
+        if updates:
+            bind.execute(
+                vitals.update().where(vitals.c.id == sa.bindparam('row_id'))
+                .values(systolic=sa.bindparam('sys'), diastolic=sa.bindparam('dia')),
+                updates,
+            )
+
+    if 'vitals_rollup' not in inspector.get_table_names():
+        metric_columns = []
+        for name, type_ in METRICS:
+            for suffix in ('sum', 'min', 'max'):
+                metric_columns.append(sa.Column(f'{name}_{suffix}', type_(), nullable=True))
+        op.create_table(
+            'vitals_rollup',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('patient_id', sa.Integer(), nullable=False),
+            sa.Column('resolution', sa.String(length=4), nullable=False),
+            sa.Column('bucket_start', sa.DateTime(), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.Column('bp_count', sa.Integer(), nullable=False),
+            *metric_columns,
+            sa.ForeignKeyConstraint(['patient_id'], ['patient.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('patient_id', 'resolution', 'bucket_start', name='uq_vitals_rollup_bucket'),
+        )
+
+
+def downgrade():
+    op.drop_table('vitals_rollup')
+    op.drop_index('ix_vitals_patient_id_recorded_at', table_name='vitals', if_exists=True)
+    with op.batch_alter_table('vitals') as batch_op:
+        batch_op.drop_column('diastolic')
+        batch_op.drop_column('systolic')
@@ -0,0 +1,137 @@
+"""Pagination helpers shared by the list endpoints in app.py."""
+import base64
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+TOTAL_MODES = ('exact', 'estimate', 'none')
+
+# Keyed per filtered statement, so bounded: least recently used entries go first
+COUNT_CACHE_SIZE = 256
+_count_cache = OrderedDict()
+_count_cache_lock = threading.Lock()
+
+
+def encode_cursor(timestamp, row_id):
+    """Pack a (timestamp, id) position into an opaque, URL-safe cursor. ``timestamp`` may be None."""
+    payload = json.dumps([timestamp and timestamp.isoformat(), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Unpack a cursor produced by encode_cursor. Raises ValueError if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (None if timestamp is None else datetime.fromisoformat(timestamp)), int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def keyset_page(query, timestamp_col, id_col, cursor, per_page):
+    """Return ``(items, next_cursor)`` for one page ordered newest first.
+
+    Instead of ``OFFSET n`` plus ``COUNT(*)``, the page seeks past the last
+    ``(timestamp, id)`` seen, so deep pages cost the same as the first one.
+    ``cursor`` may be empty to start from the newest row; ``next_cursor`` is
+    ``None`` on the last page. If ``timestamp_col`` is nullable, rows without
+    a timestamp come last, newest id first.
+    """
+    nullable = getattr(timestamp_col.expression, 'nullable', True)
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        if timestamp is None:
+            seek = and_(timestamp_col.is_(None), id_col < row_id)
+        else:
+            seek = or_(
+                timestamp_col < timestamp,
+                and_(timestamp_col == timestamp, id_col < row_id),
+            )
+            if nullable:
+                seek = or_(seek, timestamp_col.is_(None))
+        query = query.filter(seek)
+    order = timestamp_col.desc().nulls_last() if nullable else timestamp_col.desc()
+    rows = query.order_by(order, id_col.desc()).limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, timestamp_col.key), getattr(last, id_col.key))
+
+
+class Page:
+    """One page of rows. ``total`` and ``pages`` are None when the total was not counted."""
+
+    def __init__(self, items, page, per_page, total, has_next):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.has_next = has_next
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return math.ceil(self.total / self.per_page) if self.total else 0
+
+
+def estimate_count(query, cache_seconds=60):
+    """Approximate ``query.count()`` without scanning the filtered set on every call.
+
+    PostgreSQL answers from the planner's row estimate. Other databases get an
+    exact count that is cached per statement for ``cache_seconds``; at most
+    ``COUNT_CACHE_SIZE`` statements are kept.
+    """
+    statement = query.order_by(None).statement
+    bind = query.session.get_bind()
+    if bind.dialect.name == 'postgresql':
+        compiled = statement.compile(dialect=bind.dialect)
+        plan = query.session.connection().exec_driver_sql(
+            f'EXPLAIN (FORMAT JSON) {compiled.string}', compiled.params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    compiled = statement.compile(dialect=bind.dialect)
+    key = (str(bind.url), compiled.string, repr(sorted(compiled.params.items())))
+    now = time.monotonic()
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+        if cached and now - cached[1] < cache_seconds:
+            _count_cache.move_to_end(key)
+            return cached[0]
+        _count_cache.pop(key, None)
+    total = query.order_by(None).count()
+    with _count_cache_lock:
+        _count_cache[key] = (total, now)
+        while len(_count_cache) > COUNT_CACHE_SIZE:
+            _count_cache.popitem(last=False)
+    return total
+
+
+def paginate(query, page, per_page, total='exact', cache_seconds=60):
+    """OFFSET pagination whose ``total`` costs what the caller asks for.
+
+    ``exact`` runs ``COUNT(*)`` like Flask-SQLAlchemy's ``paginate()``;
+    ``estimate`` uses :func:`estimate_count`; ``none`` skips counting.
+    Every mode fetches ``per_page + 1`` rows to tell whether another page
+    exists, so a stale or low estimate never hides the next page.
+    """
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    rows = query.limit(per_page + 1).offset(offset).all()
+    items, has_next = rows[:per_page], len(rows) > per_page
+    if total == 'none':
+        return Page(items, page, per_page, None, has_next)
+    if total == 'estimate':
+        # An estimate is never below the rows this page has already seen
+        count = max(estimate_count(query, cache_seconds), offset + len(rows))
+    else:
+        count = query.order_by(None).count()
+    return Page(items, page, per_page, count, has_next)
@@ -0,0 +1,138 @@
+"""Background batch writers for append-only log tables."""
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Collect records on a bounded queue and write them in batches off the request thread.
+
+    ``write`` receives a list of at most ``batch_size`` records and should
+    store them in one statement. A daemon thread calls it whenever
+    ``batch_size`` records are waiting or ``flush_interval`` seconds have
+    passed, whichever comes first. When the queue is full the record is
+    written on the caller's thread, or discarded if ``drop_when_full`` is set.
+    """
+
+    def __init__(self, write, max_queue=10000, batch_size=200, flush_interval=1.0, name='batch-writer',
+                 drop_when_full=False):
+        self._write = write
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def submit(self, record):
+        """Queue ``record``. Returns False if the queue was full and it was written inline or dropped."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.drop_when_full:
+                self.dropped += 1
+                return False
+            logger.warning('%s queue is full; writing inline', self.name)
+            with self._lock:
+                self._write_batch([record])
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Write everything queued so far on the calling thread and wait for any batch in flight."""
+        while True:
+            with self._lock:
+                batch = self._take()
+                if not batch:
+                    return
+                self._write_batch(batch)
+
+    def close(self):
+        """Stop the worker thread and write whatever is still queued."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each (gunicorn) worker starts its own.
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _take(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        try:
+            self._write(batch)
+        except Exception:
+            logger.exception('%s failed to write %d records', self.name, len(batch))
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` events per second with bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_VOLATILE = re.compile(r"0x[0-9a-f]+|\b\d+\b|'[^']*'|\"[^\"]*\"", re.IGNORECASE)
+
+
+def error_fingerprint(message):
+    """Hash ``message`` with ids, numbers and quoted values masked, so repeats of one failure match."""
+    normalized = _VOLATILE.sub('?', message or '').strip()
+    return hashlib.sha1(normalized.encode()).hexdigest()
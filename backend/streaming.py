@@ -0,0 +1,77 @@
+"""Streaming request bodies and responses: CSV/NDJSON uploads, NDJSON lists and server-sent events."""
+import csv
+import io
+import json
+
+from flask import Response, current_app, request, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+CSV_MIMETYPE = 'text/csv'
+SSE_MIMETYPE = 'text/event-stream'
+
+
+def wants_ndjson():
+    """True when the client prefers ``application/x-ndjson`` over plain JSON."""
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_response(query, serialize, yield_per=None):
+    """Stream ``query`` as one JSON object per line.
+
+    Rows are fetched ``yield_per`` at a time over a server-side cursor
+    (``stream_results``) and serialized as they arrive, so memory stays flat
+    however many rows match. The request context is kept alive until the
+    last line is sent, so ``serialize`` may use the session and ``g``.
+    """
+    if yield_per is None:
+        yield_per = current_app.config.get('NDJSON_YIELD_PER', 500)
+
+    def generate():
+        dumps = current_app.json.dumps
+        for row in query.yield_per(yield_per):
+            yield dumps(serialize(row)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def iter_uploaded_records():
+    """Yield ``(row, record)`` for each record of a text/csv or NDJSON request body as it arrives.
+
+    ``row`` counts CSV records after the header, or NDJSON lines. ``record``
+    is a dict, or None for an NDJSON line that is not a JSON object. The body
+    is read incrementally, so uploads of any size use constant memory.
+    """
+    text = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    if request.mimetype == CSV_MIMETYPE:
+        for row, record in enumerate(csv.DictReader(text), 1):
+            yield row, record
+        return
+    for row, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield row, record if isinstance(record, dict) else None
+
+
+def sse_message(data, event=None, event_id=None):
+    """Format one server-sent event whose ``data`` is JSON-encoded."""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {current_app.json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def sse_response(generator):
+    """Stream ``generator`` as text/event-stream without proxy buffering."""
+    return Response(
+        stream_with_context(generator),
+        mimetype=SSE_MIMETYPE,
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
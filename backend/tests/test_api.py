@@ -1,16 +1,32 @@
 import pytest
 import sys
 import os
+import json
+import threading
+import time
+import stripe
+from contextlib import contextmanager
+from sqlalchemy import event, update
 
 # Add project root to Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from app import app, db, User, Patient, Appointment, MedicalRecord, Bill, AuditLog, SecurityLog, Role, UserRole
-from datetime import datetime, timezone
+from sinks import BatchWriter
+from changefeed import ChangeFeed
+import pagination
+from gateways import AccessTokenManager, GatewayClient
+from app import app, db, audit_sink, error_sink, record_audit, record_error, bump_daily_rollup, DailyRollup, reconcile_mpesa_payments, process_mpesa_inbox, load_gateway_token, MpesaCallback, save_gateway_token, ErrorLog, Invoice, PatientVisit, Payroll, Vitals, PaymentTransaction, User, Patient, Appointment, MedicalRecord, Bill, AuditLog, SecurityLog, Role, UserRole, Ward, Bed, BedAllocation
+from datetime import datetime, timezone, timedelta
 from flask_jwt_extended import create_access_token
 
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
+    app.config['TOKEN_VERSION_CACHE_SECONDS'] = 0
+    # Write audit entries synchronously so tests can read them back straight away
+    app.config['AUDIT_STRICT'] = True
+    # Tests run the M-Pesa reconciler by hand instead of on a background thread
+    app.config['MPESA_RECONCILER_ENABLED'] = False
+    app.config['MPESA_INBOX_WORKER_ENABLED'] = False
     database_url = os.getenv('DATABASE_URL')
     if database_url:
         app.config['SQLALCHEMY_DATABASE_URI'] = database_url.replace('hmis_db', 'hmis_test')
@@ -24,6 +40,26 @@ def client():
             db.session.remove()
             db.drop_all()
 
+def auth_headers(client, username, role, password='secret'):
+    client.post('/api/register', json={'username': username, 'password': password, 'role': role})
+    response = client.post('/api/login', json={'username': username, 'password': password})
+    return {'Authorization': f"Bearer {response.json['access_token']}"}
+
+@contextmanager
+def captured_queries():
+    statements = []
+    thread = threading.get_ident()
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement.lower())
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
 def test_register(client):
     response = client.post('/api/register', json={
         'username': 'testuser',
@@ -395,4 +431,898 @@ def test_update_bill(client):
         bill = db.session.get(Bill, 1)
         assert bill.payment_status == 'Paid'
         audit_log = db.session.get(AuditLog, AuditLog.query.filter_by(action='Bill updated', user='adminuser').first().id)
-        assert audit_log is not None
\ No newline at end of file
+        assert audit_log is not None
+
+def test_role_checks_use_loaded_principal(client):
+    app.config['JWT_AUTHZ_CLAIMS'] = False
+    try:
+        headers = auth_headers(client, 'doctor', 'Doctor')
+        with captured_queries() as statements:
+            response = client.get('/api/records', headers=headers)
+    finally:
+        app.config['JWT_AUTHZ_CLAIMS'] = True
+    assert response.status_code == 200
+    # The only statement touching roles is the one that loads the principal.
+    assert sum('user_role' in s for s in statements) == 1
+
+def test_authz_claims_skip_role_tables(client):
+    headers = auth_headers(client, 'doctor', 'Doctor')
+    with captured_queries() as statements:
+        response = client.get('/api/records', headers=headers)
+    assert response.status_code == 200
+    assert not any('user_role' in s or 'from role' in s for s in statements)
+
+def test_role_change_revokes_issued_tokens(client):
+    admin_headers = auth_headers(client, 'adminuser', 'Admin')
+    doctor_headers = auth_headers(client, 'doctor', 'Doctor')
+    with app.app_context():
+        doctor_id = User.query.filter_by(username='doctor').first().id
+    response = client.put('/api/users/roles', json={'user_id': doctor_id, 'role': 'Nurse'}, headers=admin_headers)
+    assert response.status_code == 200
+    response = client.get('/api/records', headers=doctor_headers)
+    assert response.status_code == 401
+    response = client.post('/api/login', json={'username': 'doctor', 'password': 'secret'})
+    assert response.json['user']['role'] == 'Nurse'
+
+def test_audit_logs_cursor_pagination(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    with app.app_context():
+        # Pairs of rows share a timestamp so the id tie-breaker is exercised.
+        for i in range(25):
+            db.session.add(AuditLog(action=f'Action {i}', user='adminuser', timestamp=base.replace(minute=i // 2)))
+        db.session.commit()
+        expected = [log.id for log in AuditLog.query.order_by(AuditLog.timestamp.desc(), AuditLog.id.desc())]
+    seen, cursor = [], ''
+    while cursor is not None:
+        response = client.get(f'/api/audit-logs?cursor={cursor}', headers=headers)
+        assert response.status_code == 200
+        assert 'total' not in response.json
+        seen.extend(log['id'] for log in response.json['logs'])
+        cursor = response.json['next_cursor']
+    assert seen == expected
+    response = client.get('/api/audit-logs?cursor=not-a-cursor', headers=headers)
+    assert response.status_code == 422
+
+def test_transaction_cursor_pages_reach_rows_without_created_at(client):
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments([f'ws_CO_page_{i}' for i in range(25)])
+    with app.app_context():
+        # Legacy rows imported without a timestamp sort after every dated row
+        undated = [t.id for t in PaymentTransaction.query.order_by(PaymentTransaction.id).limit(7)]
+        db.session.execute(update(PaymentTransaction).where(PaymentTransaction.id.in_(undated)).values(created_at=None))
+        db.session.commit()
+        dated = PaymentTransaction.query.filter(PaymentTransaction.created_at.isnot(None))
+        expected = [t.id for t in dated.order_by(PaymentTransaction.created_at.desc(), PaymentTransaction.id.desc())]
+    expected += sorted(undated, reverse=True)
+    seen, cursor = [], ''
+    while cursor is not None:
+        response = client.get(f'/api/payments/transactions?cursor={cursor}', headers=headers)
+        assert response.status_code == 200
+        seen.extend(t['id'] for t in response.json['transactions'])
+        cursor = response.json['next_cursor']
+    assert seen == expected
+
+def test_patients_total_modes(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    with app.app_context():
+        for i in range(12):
+            db.session.add(Patient(name=f'Patient {i}', dob=datetime(1990, 1, 1).date()))
+        db.session.commit()
+    exact = client.get('/api/patients?page=1', headers=headers).json
+    assert exact['total'] == 12 and exact['pages'] == 2 and exact['has_next'] is True
+    with captured_queries() as statements:
+        response = client.get('/api/patients?page=2&total=none', headers=headers)
+    assert not any('count(' in s for s in statements)
+    assert response.json['total'] is None
+    assert response.json['has_next'] is False
+    assert len(response.json['patients']) == 2
+    estimate = client.get('/api/patients?page=1&total=estimate', headers=headers).json
+    assert estimate['total'] == 12
+
+def test_patients_estimate_never_hides_the_next_page(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    with app.app_context():
+        for i in range(12):
+            db.session.add(Patient(name=f'Patient {i}', dob=datetime(1990, 1, 1).date()))
+        db.session.commit()
+    assert client.get('/api/patients?page=1&total=estimate', headers=headers).json['total'] == 12
+    with app.app_context():
+        for i in range(15):
+            db.session.add(Patient(name=f'Late {i}', dob=datetime(1990, 1, 1).date()))
+        db.session.commit()
+    # The cached estimate (12) is now low; page 2 still links to page 3
+    page = client.get('/api/patients?page=2&total=estimate', headers=headers).json
+    assert page['has_next'] is True
+    assert page['total'] > 20
+    page = client.get('/api/patients?page=3&total=estimate', headers=headers).json
+    assert page['has_next'] is False
+    assert len(page['patients']) == 7
+
+def test_count_cache_is_bounded(client, monkeypatch):
+    monkeypatch.setattr(pagination, 'COUNT_CACHE_SIZE', 3)
+    with app.app_context():
+        for i in range(5):
+            pagination.estimate_count(Patient.query.filter(Patient.name == f'Patient {i}'))
+    assert len(pagination._count_cache) == 3
+
+def test_patient_search_is_indexed_and_ranked(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    for name, contact in [('Jane Doe', '0712345678'), ('Janet Smith', '0799000111'), ('John Roe', '0700111222')]:
+        client.post('/api/patients', json={'name': name, 'dob': '1990-01-01', 'contact': contact}, headers=headers)
+    response = client.get('/api/patients?q=jan', headers=headers)
+    assert sorted(p['name'] for p in response.json['patients']) == ['Jane Doe', 'Janet Smith']
+    response = client.get('/api/patients?q=0799', headers=headers)
+    assert [p['name'] for p in response.json['patients']] == ['Janet Smith']
+    response = client.get('/api/patients?q=3', headers=headers)
+    assert [p['id'] for p in response.json['patients']] == [3]
+    client.put('/api/patients/3', json={'name': 'Johnny Walker'}, headers=headers)
+    response = client.get('/api/patients?q=walker', headers=headers)
+    assert [p['name'] for p in response.json['patients']] == ['Johnny Walker']
+    assert client.get('/api/patients?q=roe', headers=headers).json['patients'] == []
+
+def test_bed_board_is_one_query(client):
+    headers = auth_headers(client, 'nurse', 'Nurse')
+    with app.app_context():
+        ward = Ward(name='General')
+        db.session.add(ward)
+        db.session.flush()
+        patient = Patient(name='John Doe', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        beds = [Bed(ward_id=ward.id, bed_number=f'G{i}', status='Available') for i in range(5)]
+        db.session.add_all(beds)
+        db.session.flush()
+        beds[2].status = 'Occupied'
+        db.session.add(BedAllocation(bed_id=beds[2].id, patient_id=patient.id))
+        db.session.commit()
+    with captured_queries() as statements:
+        response = client.get('/api/beds', headers=headers)
+    assert response.status_code == 200
+    assert sum(s.lstrip().startswith('select') and 'from bed' in s for s in statements) == 1
+    assert len(response.json['beds']) == 5
+    response = client.get('/api/beds?status=Occupied&ward=General', headers=headers)
+    assert [(b['bed_number'], b['ward_name'], b['patient_id']) for b in response.json['beds']] == [('G2', 'General', 1)]
+
+def test_employee_and_role_lists_avoid_per_row_queries(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    for i in range(6):
+        auth_headers(client, f'staff{i}', 'Doctor' if i % 2 else 'Nurse')
+    with app.app_context():
+        lab_tech = Role(name='Lab Tech')
+        db.session.add(lab_tech)
+        db.session.flush()
+        staff0 = User.query.filter_by(username='staff0').first()
+        db.session.add(UserRole(user_id=staff0.id, role_id=lab_tech.id))
+        db.session.commit()
+    with captured_queries() as statements:
+        response = client.get('/api/employees', headers=headers)
+    assert response.status_code == 200
+    # page + roles for the page + count, independent of the number of employees
+    assert sum('role' in s for s in statements) == 3
+    staff0 = next(e for e in response.json['employees'] if e['username'] == 'staff0')
+    assert sorted(staff0['roles']) == ['Lab Tech', 'Nurse']
+    with captured_queries() as statements:
+        response = client.get('/api/users/roles', headers=headers)
+    assert response.status_code == 200
+    assert sum('role' in s for s in statements) == 2
+    assert len(response.json['roles']) == 8
+
+def test_bills_by_patient_streams_ndjson(client):
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    with app.app_context():
+        patient = Patient(name='Stream Patient', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        db.session.flush()
+        db.session.add_all([Bill(patient_id=patient.id, amount=10 + i, description=f'Item {i}') for i in range(5)])
+        db.session.commit()
+        patient_id = patient.id
+    response = client.get(f'/api/bills/patient/{patient_id}', headers={**headers, 'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(line['amount'] for line in lines) == [10.0, 11.0, 12.0, 13.0, 14.0]
+    response = client.get(f'/api/bills/patient/{patient_id}', headers=headers)
+    assert response.mimetype == 'application/json'
+    assert len(response.json['bills']) == 5
+
+def test_audit_entries_leave_the_request_path(client):
+    headers = auth_headers(client, 'receptionuser', 'Receptionist')
+    app.config['AUDIT_STRICT'] = False
+    try:
+        with captured_queries() as statements:
+            for i in range(3):
+                response = client.post('/api/patients', json={'name': f'Audit {i}', 'dob': '1990-01-01'}, headers=headers)
+                assert response.status_code == 201
+        assert not any('audit_log' in s for s in statements)
+        audit_sink.flush()
+    finally:
+        app.config['AUDIT_STRICT'] = True
+    with app.app_context():
+        assert AuditLog.query.filter_by(action='Patient added').count() == 3
+
+def test_savepoint_rollback_keeps_work_queued_by_the_outer_transaction(client):
+    app.config['AUDIT_STRICT'] = False
+    try:
+        with app.app_context():
+            when = datetime(2024, 3, 1, 9, tzinfo=timezone.utc)
+            record_audit('Before savepoint', 'tester')
+            bump_daily_rollup('visits', 'triage', when)
+            try:
+                with db.session.begin_nested():
+                    record_audit('Inside savepoint', 'tester')
+                    bump_daily_rollup('visits', 'triage', when, count=5)
+                    raise ValueError('roll back the savepoint')
+            except ValueError:
+                pass
+            with db.session.begin_nested():
+                record_audit('Released savepoint', 'tester')
+            # Releasing a savepoint is not the commit; nothing leaves yet
+            assert db.session.info['pending_audit']
+            db.session.commit()
+        audit_sink.flush()
+    finally:
+        app.config['AUDIT_STRICT'] = True
+    with app.app_context():
+        actions = {row.action for row in AuditLog.query.filter(AuditLog.user == 'tester')}
+        assert actions == {'Before savepoint', 'Released savepoint'}
+        assert DailyRollup.query.filter_by(metric='visits', dimension='triage').one().count == 1
+
+def test_batch_writer_writes_in_bounded_batches():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=2, flush_interval=60)
+    for i in range(5):
+        assert writer.submit(i)
+    writer.close()
+    assert sorted(i for batch in batches for i in batch) == [0, 1, 2, 3, 4]
+    assert all(1 <= len(batch) <= 2 for batch in batches)
+
+def test_register_is_one_transaction(client):
+    commits = []
+    with app.app_context():
+        engine = db.engine
+    def on_commit(conn):
+        commits.append(conn)
+    event.listen(engine, 'commit', on_commit)
+    try:
+        response = client.post('/api/register', json={'username': 'newpatient', 'password': 'secret', 'role': 'Patient'})
+    finally:
+        event.remove(engine, 'commit', on_commit)
+    assert response.status_code == 201
+    assert len(commits) == 1
+    with app.app_context():
+        user = User.query.filter_by(username='newpatient').one()
+        assert user.role == 'Patient'
+        assert AuditLog.query.filter_by(action='User registered', user='newpatient').count() == 1
+
+def test_repeated_errors_collapse_into_one_row(client):
+    with app.app_context():
+        for i in range(3):
+            record_error(f'(sqlite3.OperationalError) database is locked [parameters: ({i},)]', None)
+        record_error('Something else broke', None)
+        error_sink.flush()
+        record_error('(sqlite3.OperationalError) database is locked [parameters: (9,)]', None)
+        error_sink.flush()
+        rows = ErrorLog.query.order_by(ErrorLog.id).all()
+    assert [row.count for row in rows] == [4, 1]
+
+def test_visit_stream_sends_snapshot_then_stage_changes(client):
+    nurse = auth_headers(client, 'nurseuser', 'Nurse')
+    reception = auth_headers(client, 'receptionuser', 'Receptionist')
+    with app.app_context():
+        patient = Patient(name='Stream Visit', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        db.session.commit()
+        patient_id = patient.id
+    response = client.get('/api/patient-visits/stream', headers=nurse, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    snapshot = next(chunks).decode()
+    assert snapshot.startswith('event: snapshot')
+    assert json.loads(snapshot.split('data: ', 1)[1])['visits'] == []
+    # Writers run on their own threads, as they would in separate requests; the
+    # open stream keeps its request context pushed on this one.
+    def in_thread(call):
+        result = []
+        worker = threading.Thread(target=lambda: result.append(call(app.test_client())))
+        worker.start()
+        worker.join()
+        return result[0]
+    created = in_thread(lambda c: c.post('/api/patient-visits', json={'patient_id': patient_id}, headers=reception))
+    assert created.status_code == 201
+    event_text = next(chunks).decode()
+    assert 'event: visit' in event_text
+    assert json.loads(event_text.split('data: ', 1)[1])['id'] == created.json['id']
+    moved = in_thread(lambda c: c.put(f"/api/patient-visits/{created.json['id']}", json={'triage_notes': 'ok'}, headers=nurse))
+    assert moved.status_code == 200
+    assert 'event: remove' in next(chunks).decode()
+    response.close()
+
+def test_visit_streams_are_capped_per_worker(client, monkeypatch):
+    monkeypatch.setattr(sys.modules['app'], 'stream_slots', threading.BoundedSemaphore(1))
+    headers = auth_headers(client, 'nurseuser', 'Nurse')
+    def in_thread(url):
+        # The open stream keeps its request context pushed on this thread
+        result = []
+        worker = threading.Thread(target=lambda: result.append(app.test_client().get(url, headers=headers)))
+        worker.start()
+        worker.join()
+        return result[0]
+    first = client.get('/api/patient-visits/stream', headers=headers, buffered=False)
+    assert first.status_code == 200
+    refused = in_thread('/api/patient-visits/stream')
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == str(app.config['SSE_RETRY_AFTER_SECONDS'])
+    # Ordinary requests are unaffected
+    assert in_thread('/api/patient-visits').status_code == 200
+    first.close()
+    again = client.get('/api/patient-visits/stream', headers=headers, buffered=False)
+    assert again.status_code == 200
+    again.close()
+
+def test_change_feed_delivers_events_that_commit_late():
+    committed = {}
+    def fetch(after_id, limit):
+        return [committed[i] for i in sorted(committed) if i > after_id][:limit]
+    feed = ChangeFeed(fetch, lambda: max(committed, default=0),
+                      fetch_ids=lambda ids: [committed[i] for i in ids if i in committed], poll_interval=0.05)
+    subscription = feed.subscribe()
+    try:
+        # Id 2 was handed out first but its transaction commits after 3 is read
+        committed.update({1: {'id': 1}, 3: {'id': 3}})
+        feed.notify()
+        assert [subscription.get(1)['id'], subscription.get(1)['id']] == [1, 3]
+        committed[2] = {'id': 2}
+        feed.notify()
+        assert subscription.get(1)['id'] == 2
+        assert subscription.get(0.3) is None
+    finally:
+        feed.unsubscribe(subscription)
+
+def test_queue_is_shared_and_ordered(client):
+    headers = auth_headers(client, 'receptionuser', 'Receptionist')
+    with app.app_context():
+        patients = [Patient(name=name, dob=datetime(1990, 1, 1).date()) for name in ('First', 'Second', 'Third')]
+        db.session.add_all(patients)
+        db.session.commit()
+        first, second, third = [p.id for p in patients]
+    for patient_id, name in [(first, 'First'), (second, 'Second'), (third, 'Third')]:
+        response = client.post('/api/queue', json={'patient_id': patient_id, 'name': name}, headers=headers)
+        assert response.status_code == 201
+    assert client.post('/api/queue', json={'patient_id': second, 'name': 'Second'}, headers=headers).status_code == 200
+    assert client.post('/api/checkin', json={'patient_id': third}, headers=headers).status_code == 200
+    assert client.post('/api/checkin', json={'patient_id': 999}, headers=headers).status_code == 404
+    response = client.get(f'/api/queue/{third}', headers=headers)
+    assert response.json['position'] == 3
+    assert response.json['checked_in'] is True
+    assert response.json['eta_minutes'] == 2 * app.config['QUEUE_MINUTES_PER_PATIENT']
+    with captured_queries() as statements:
+        queue = client.get('/api/queue', headers=headers).json['queue']
+    assert [(entry['id'], entry['position']) for entry in queue] == [(first, 1), (second, 2), (third, 3)]
+    # Positions come from one window query, not a count per entry
+    assert [s for s in statements if 'queue_entry' in s] == [s for s in statements if 'row_number()' in s]
+    assert len([s for s in statements if 'queue_entry' in s]) == 1
+    assert client.post('/api/queue/next?checked_in=true', headers=headers).json['id'] == third
+    assert client.post('/api/queue/next', headers=headers).json['id'] == first
+    queue = client.get('/api/queue', headers=headers).json['queue']
+    assert [(entry['id'], entry['position']) for entry in queue] == [(second, 1)]
+
+def test_queue_rejects_unknown_patient(client):
+    headers = auth_headers(client, 'receptionuser', 'Receptionist')
+    response = client.post('/api/queue', json={'patient_id': 999, 'name': 'Nobody'}, headers=headers)
+    assert response.status_code == 404
+    assert client.get('/api/queue', headers=headers).json['queue'] == []
+    # Walk-ins without a patient record are still queued
+    assert client.post('/api/queue', json={'name': 'Walk-in'}, headers=headers).status_code == 201
+
+def test_gateway_client_retries_only_safe_calls():
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    hits = []
+    class Flaky(BaseHTTPRequestHandler):
+        def do_POST(self):
+            hits.append(self.path)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(503 if len(hits) == 1 else 200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Flaky)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/query'
+    try:
+        client = GatewayClient('stub', retries=2, backoff=0)
+        assert client.post(url, json={}, idempotent=True).status_code == 200
+        assert len(hits) == 2
+        hits.clear()
+        assert client.post(url, json={}).status_code == 503
+        assert len(hits) == 1
+        assert client.metrics()['POST /query']['calls'] == 3
+    finally:
+        server.shutdown()
+
+def pending_mpesa_payments(references, created_at=None):
+    """An invoice with a pending M-Pesa transaction for each checkout request id."""
+    with app.app_context():
+        patient = Patient(name='Payer', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        db.session.flush()
+        visit = PatientVisit(patient_id=patient.id)
+        db.session.add(visit)
+        db.session.flush()
+        for reference in references:
+            invoice = Invoice(invoice_number=f'INV-{reference}', patient_id=patient.id, visit_id=visit.id,
+                              total_amount=100, generated_by=1)
+            db.session.add(invoice)
+            db.session.flush()
+            db.session.add(PaymentTransaction(invoice_id=invoice.id, patient_id=patient.id, amount=100,
+                                              payment_method='mpesa', gateway_reference=reference,
+                                              status='pending', created_at=created_at or datetime.now(timezone.utc)))
+        db.session.commit()
+
+def test_mpesa_payments_without_credentials_say_so(client, monkeypatch, caplog):
+    app_module = sys.modules['app']
+    monkeypatch.delenv('MPESA_PASSKEY', raising=False)
+    monkeypatch.setattr(app_module, 'mpesa_reconcile_disabled_logged', threading.Event())
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments(['ws_CO_nocreds'], created_at=datetime.now(timezone.utc) - timedelta(minutes=5))
+    with caplog.at_level('WARNING', logger=app_module.logger.name):
+        reconcile_mpesa_payments()
+        reconcile_mpesa_payments()
+    assert len([r for r in caplog.records if 'credentials not configured' in r.getMessage()]) == 1
+    body = client.get('/api/payments/mpesa/status/ws_CO_nocreds', headers=headers).json
+    assert body['status'] == 'pending'
+    assert body['reconcile_disabled'] is True
+    assert body['error'] == 'Missing credentials'
+
+def test_mpesa_reconciler_settles_overdue_payments(client, monkeypatch):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    queried = []
+    class Daraja(BaseHTTPRequestHandler):
+        def do_POST(self):
+            checkout_request_id = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['CheckoutRequestID']
+            queried.append(checkout_request_id)
+            result_code = {'ws_CO_paid': '0', 'ws_CO_waiting': '1'}.get(checkout_request_id, '1032')
+            body = json.dumps({'ResultCode': result_code, 'ResultDesc': f'result {result_code}'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Daraja)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('MPESA_STATUS_URL', f'http://127.0.0.1:{server.server_port}/query')
+    monkeypatch.setenv('MPESA_PASSKEY', 'passkey')
+    monkeypatch.setenv('MPESA_ACCESS_TOKEN', 'token')
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    overdue = datetime.now(timezone.utc) - timedelta(minutes=5)
+    try:
+        pending_mpesa_payments(['ws_CO_paid', 'ws_CO_cancelled', 'ws_CO_waiting'], created_at=overdue)
+        pending_mpesa_payments(['ws_CO_recent'])
+        reconcile_mpesa_payments()
+        assert sorted(queried) == ['ws_CO_cancelled', 'ws_CO_paid', 'ws_CO_waiting']
+        # Rows just queried are not asked about again until the recheck interval passes
+        reconcile_mpesa_payments()
+        assert len(queried) == 3
+    finally:
+        server.shutdown()
+    response = client.get('/api/payments/mpesa/status/ws_CO_paid', headers=headers)
+    assert response.json['status'] == 'completed'
+    assert response.json['transaction']['status'] == 'completed'
+    assert client.get('/api/payments/mpesa/status/ws_CO_cancelled', headers=headers).json['error'] == 'result 1032'
+    assert client.get('/api/payments/mpesa/status/ws_CO_waiting', headers=headers).json['status'] == 'pending'
+    assert len(queried) == 3
+    with app.app_context():
+        assert Invoice.query.filter_by(invoice_number='INV-ws_CO_paid').one().status == 'Paid'
+        assert Invoice.query.filter_by(invoice_number='INV-ws_CO_cancelled').one().status != 'Paid'
+    # A late callback for a settled payment changes nothing
+    client.post('/api/payments/mpesa/callback', json={'ResultCode': '1032', 'CheckoutRequestID': 'ws_CO_paid'})
+    process_mpesa_inbox()
+    assert client.get('/api/payments/mpesa/status/ws_CO_paid', headers=headers).json['status'] == 'completed'
+
+def test_access_tokens_are_cached_shared_and_renewed(client):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    issued = []
+    class OAuth(BaseHTTPRequestHandler):
+        def do_GET(self):
+            issued.append(f'token-{len(issued) + 1}')
+            # The first token is already inside the 60 second refresh margin a second later
+            body = json.dumps({'access_token': issued[-1], 'expires_in': '61' if len(issued) == 1 else '3599'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), OAuth)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    gateway = GatewayClient('stub', retries=0)
+    def fetch():
+        data = gateway.get(f'http://127.0.0.1:{server.server_port}/oauth', auth=('key', 'secret')).json()
+        return data['access_token'], int(data['expires_in'])
+    def worker():
+        return AccessTokenManager(fetch, load=lambda: load_gateway_token('stub'),
+                                  save=lambda token, expires_at: save_gateway_token('stub', token, expires_at),
+                                  refresh_margin=60)
+    try:
+        first, second = worker(), worker()
+        tokens = []
+        callers = [threading.Thread(target=lambda: tokens.append(first.get())) for _ in range(8)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        assert tokens == ['token-1'] * 8
+        assert second.get() == 'token-1'
+        assert issued == ['token-1']
+        time.sleep(1.1)
+        assert first.get() == 'token-2'
+        assert second.get() == 'token-2'
+        assert issued == ['token-1', 'token-2']
+        second.invalidate('token-2')
+        assert second.get() == 'token-3'
+        assert first.get() == 'token-2'
+    finally:
+        server.shutdown()
+
+def test_mpesa_callbacks_are_acknowledged_then_settled_once(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    pending_mpesa_payments(['ws_CO_inbox'])
+    callback = {'ResultCode': '0', 'CheckoutRequestID': 'ws_CO_inbox'}
+    for payload in (callback, callback, {'ResultCode': '0', 'CheckoutRequestID': 'ws_CO_unknown'}):
+        assert client.post('/api/payments/mpesa/callback', json=payload).status_code == 200
+    assert client.post('/api/payments/mpesa/callback', data='not json').status_code == 400
+    assert client.get('/api/payments/mpesa/status/ws_CO_inbox', headers=headers).json['status'] == 'pending'
+    assert client.get('/api/payments/gateway-metrics', headers=headers).json['mpesa_callbacks']['pending'] == 3
+    process_mpesa_inbox()
+    assert client.get('/api/payments/mpesa/status/ws_CO_inbox', headers=headers).json['status'] == 'completed'
+    with app.app_context():
+        outcomes = [row.outcome for row in MpesaCallback.query.order_by(MpesaCallback.id)]
+        assert outcomes == ['completed', 'duplicate', 'unknown']
+        assert Invoice.query.filter_by(invoice_number='INV-ws_CO_inbox').one().status == 'Paid'
+    callbacks = client.get('/api/payments/gateway-metrics', headers=headers).json['mpesa_callbacks']
+    assert callbacks['pending'] == 0
+    assert callbacks['settlement_lag']['calls'] >= 3
+
+def test_mpesa_settlement_is_applied_once_across_sessions(client):
+    pending_mpesa_payments(['ws_CO_race'])
+    settle = sys.modules['app'].settle_mpesa_transaction
+    result = {'ResultCode': '0', 'CheckoutRequestID': 'ws_CO_race'}
+    with app.app_context():
+        # Both sides read the row while it is still pending, as two workers would
+        first = PaymentTransaction.query.filter_by(gateway_reference='ws_CO_race').one()
+        assert first.status == 'pending'
+        with app.app_context():
+            second = PaymentTransaction.query.filter_by(gateway_reference='ws_CO_race').one()
+            assert settle(second, True, result, 'mpesa-callback') is True
+            db.session.commit()
+        assert settle(first, True, result, 'mpesa-reconciler') is False
+        assert first.status == 'completed'
+        db.session.commit()
+    with app.app_context():
+        assert PaymentTransaction.query.filter_by(gateway_reference='ws_CO_race', status='completed').count() == 1
+        assert AuditLog.query.filter(AuditLog.action.like('M-Pesa payment completed%')).count() == 1
+        assert DailyRollup.query.filter_by(metric='revenue').one().count == 1
+
+def test_stripe_jobs_are_rerun_only_when_their_claim_is_stale(client, monkeypatch):
+    app_module = sys.modules['app']
+    submitted = []
+    monkeypatch.setattr(app_module.stripe_jobs, 'submit', lambda fn, job_id, username: submitted.append(job_id) or True)
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments(['ws_CO_stale'])
+    now = datetime.now(timezone.utc)
+    old = now - timedelta(hours=1)
+    with app.app_context():
+        invoice = Invoice.query.filter_by(invoice_number='INV-ws_CO_stale').one()
+        jobs = {}
+        for name, status, last_checked_at in [('queued', 'queued', None), ('running', 'processing', now),
+                                              ('stale', 'processing', old)]:
+            transaction = PaymentTransaction(invoice_id=invoice.id, patient_id=invoice.patient_id, amount=100,
+                                             payment_method='stripe', status=status, created_at=old,
+                                             last_checked_at=last_checked_at)
+            db.session.add(transaction)
+            db.session.flush()
+            jobs[name] = transaction.id
+        db.session.commit()
+
+    # A queued job is still waiting in a pool, and a live run is still making its call
+    for name in ('queued', 'running'):
+        assert client.get(f'/api/payments/jobs/{jobs[name]}', headers=headers).status_code == 200
+    assert submitted == []
+    assert client.get(f'/api/payments/jobs/{jobs["stale"]}', headers=headers).json['state'] == 'running'
+    assert submitted == [jobs['stale']]
+
+    # A second run cannot claim a row whose claim is fresh
+    monkeypatch.setattr(stripe.PaymentIntent, 'create', lambda **kwargs: pytest.fail('claimed a live job'))
+    app_module.run_stripe_job(jobs['running'], 'billinguser')
+    with app.app_context():
+        assert db.session.get(PaymentTransaction, jobs['running']).status == 'processing'
+
+def test_stripe_calls_run_as_background_jobs(client, monkeypatch):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    calls = []
+    class FakeStripe(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            calls.append((self.path, self.headers.get('Idempotency-Key')))
+            if self.path == '/v1/payment_intents':
+                body = {'id': 'pi_123', 'object': 'payment_intent', 'client_secret': 'pi_123_secret'}
+            else:
+                body = {'id': 're_123', 'object': 'refund'}
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), FakeStripe)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(stripe, 'api_base', f'http://127.0.0.1:{server.server_port}')
+    headers = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments(['ws_CO_card'])
+    with app.app_context():
+        invoice_id = Invoice.query.filter_by(invoice_number='INV-ws_CO_card').one().id
+
+    def finished(job_id):
+        for _ in range(50):
+            job = client.get(f'/api/payments/jobs/{job_id}', headers=headers).json
+            if job['state'] not in ('queued', 'running'):
+                return job
+            time.sleep(0.1)
+        raise AssertionError(f'job {job_id} did not finish')
+
+    try:
+        response = client.post('/api/payments/create-intent?async=true',
+                               json={'invoice_id': invoice_id, 'amount': 250}, headers=headers)
+        assert response.status_code == 202
+        job = finished(response.json['job_id'])
+        assert job['state'] == 'succeeded'
+        assert job['client_secret'] == 'pi_123_secret'
+        assert job['transaction']['gateway_reference'] == 'pi_123'
+        with app.app_context():
+            db.session.get(PaymentTransaction, job['job_id']).status = 'completed'
+            db.session.commit()
+        response = client.post('/api/payments/refund?async=true',
+                               json={'transaction_id': job['job_id'], 'refund_amount': 100}, headers=headers)
+        assert response.status_code == 202
+        refund = finished(response.json['job_id'])
+        assert refund['state'] == 'succeeded'
+        assert refund['transaction']['gateway_reference'] == 're_123'
+        assert refund['transaction']['status'] == 'completed'
+    finally:
+        server.shutdown()
+    assert [path for path, _ in calls] == ['/v1/payment_intents', '/v1/refunds']
+    assert all(key.startswith('hmis-') for _, key in calls)
+
+def test_bulk_patient_import_inserts_in_chunks(client):
+    headers = auth_headers(client, 'receptionuser', 'Receptionist')
+    app.config['PATIENT_IMPORT_CHUNK_SIZE'] = 2
+    csv_body = (
+        'name,dob,contact,address,medical_history,allergies\n'
+        'Ann,1980-02-03,0700000001,Nairobi,Asthma,Penicillin\n'
+        'Ben,1975-13-01,,,,\n'
+        'Cat,1990-06-07,,,,\n'
+        ',1991-01-01,,,,\n'
+        'Dan,2001-09-10,,,,\n'
+    )
+    try:
+        with captured_queries() as statements:
+            response = client.post('/api/patients/bulk', data=csv_body, headers=headers, content_type='text/csv')
+        assert response.status_code == 200
+        assert response.json['imported'] == 3
+        assert [(error['row'], error['errors']) for error in response.json['errors']] == [
+            (2, ['dob must be YYYY-MM-DD']), (4, ['name is required'])]
+        # Patient ids come back in order via RETURNING, which SQLite can only do a row at a time
+        assert sum(s.startswith('insert into medical_record ') for s in statements) == 2
+        ndjson_body = '{"name": "Eve", "dob": "1999-12-31"}\nnot json\n\n{"name": "Fay"}\n'
+        response = client.post('/api/patients/bulk', data=ndjson_body, headers=headers,
+                               content_type='application/x-ndjson')
+        assert response.json['imported'] == 1
+        assert [error['row'] for error in response.json['errors']] == [2, 4]
+    finally:
+        app.config['PATIENT_IMPORT_CHUNK_SIZE'] = 1000
+    assert client.post('/api/patients/bulk', json=[], headers=headers).status_code == 415
+    with app.app_context():
+        ann = Patient.query.filter_by(name='Ann').one()
+        assert ann.dob.isoformat() == '1980-02-03'
+        assert MedicalRecord.query.filter_by(patient_id=ann.id).one().allergies == 'Penicillin'
+        assert Patient.query.count() == 4
+        assert MedicalRecord.query.count() == 4
+        assert AuditLog.query.filter(AuditLog.action.like('Imported % patients%')).count() == 2
+
+def test_vitals_batch_is_one_insert_and_one_audit_entry(client):
+    headers = auth_headers(client, 'nurseuser', 'Nurse')
+    with app.app_context():
+        patients = [Patient(name=name, dob=datetime(1990, 1, 1).date()) for name in ('Bed 1', 'Bed 2')]
+        db.session.add_all(patients)
+        db.session.commit()
+        first, second = [p.id for p in patients]
+    reading = {'blood_pressure': '120/80', 'temperature': 37.2, 'pulse': 72, 'respiration': 16}
+    readings = [dict(reading, patient_id=first, recorded_at='2026-01-01T08:00:00Z')] * 50
+    readings += [dict(reading, patient_id=second), dict(reading, patient_id=999),
+                 dict(reading, patient_id=first, pulse='fast', blood_pressure='high')]
+    with captured_queries() as statements:
+        response = client.post('/api/vitals/batch', json=readings, headers=headers)
+    assert response.status_code == 201
+    assert response.json['accepted'] == 51
+    assert response.json['errors'] == [
+        {'index': 51, 'errors': ['Patient not found']},
+        {'index': 52, 'errors': ['pulse is required and must be a number']},
+    ]
+    assert sum(s.startswith('insert into vitals ') for s in statements) == 1
+    assert sum(s.startswith('select patient.id') for s in statements) == 1
+    ndjson = '\n'.join(json.dumps(dict(reading, patient_id=second)) for _ in range(3))
+    response = client.post('/api/vitals/batch', data=ndjson, headers=headers, content_type='application/x-ndjson')
+    assert response.json['accepted'] == 3
+    assert client.post('/api/vitals/batch', json=[{'patient_id': 999}], headers=headers).status_code == 422
+    with app.app_context():
+        assert Vitals.query.filter_by(patient_id=first).count() == 50
+        assert Vitals.query.filter_by(patient_id=first).first().recorded_at.hour == 8
+        assert AuditLog.query.filter(AuditLog.action.like('Vitals batch recorded%')).count() == 2
+
+def test_vitals_batch_checks_celsius_and_accepts_what_the_single_route_does(client):
+    headers = auth_headers(client, 'nurseuser', 'Nurse')
+    with app.app_context():
+        patient = Patient(name='Units', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        db.session.commit()
+        patient_id = patient.id
+    reading = {'patient_id': patient_id, 'temperature': 37.0, 'pulse': 72, 'respiration': 16}
+    readings = [dict(reading, temperature=98.6), dict(reading), dict(reading, blood_pressure='not taken')]
+    response = client.post('/api/vitals/batch', json=readings, headers=headers)
+    assert response.json['errors'] == [{'index': 0, 'errors': ['temperature must be between 25 and 45']}]
+    assert response.json['accepted'] == 2
+    with app.app_context():
+        stored = {v.blood_pressure: v.systolic for v in Vitals.query.filter_by(patient_id=patient_id)}
+    assert stored == {'120/80': 120, 'not taken': None}
+
+def test_vitals_trends_come_from_incremental_rollups(client):
+    headers = auth_headers(client, 'nurseuser', 'Nurse')
+    with app.app_context():
+        patient = Patient(name='Trend', dob=datetime(1990, 1, 1).date())
+        db.session.add(patient)
+        db.session.commit()
+        patient_id = patient.id
+    def reading(at, systolic, pulse):
+        return {'patient_id': patient_id, 'blood_pressure': f'{systolic}/80', 'temperature': 37.0,
+                'pulse': pulse, 'respiration': 16, 'recorded_at': at}
+    client.post('/api/vitals/batch', json=[reading('2026-03-01T08:05:00Z', 120, 70),
+                                           reading('2026-03-01T09:10:00Z', 140, 90)], headers=headers)
+    client.post('/api/vitals/batch', json=[reading('2026-03-01T08:50:00Z', 130, 60)], headers=headers)
+    url = f'/api/patients/{patient_id}/vitals?from=2026-03-01T08:30:00Z&to=2026-03-02'
+    with captured_queries() as statements:
+        hourly = client.get(url, headers=headers).json['points']
+    assert not any('from vitals ' in s for s in statements)
+    assert [(p['t'][:13], p['count'], p['systolic']['mean'], p['pulse']['min'], p['pulse']['max']) for p in hourly] == [
+        ('2026-03-01T08', 2, 125.0, 60, 70), ('2026-03-01T09', 1, 140.0, 90, 90)]
+    daily = client.get(url + '&resolution=day', headers=headers).json['points']
+    assert [(p['count'], p['systolic']['min'], p['systolic']['max'], p['pulse']['mean']) for p in daily] == [(3, 120, 140, 73.3)]
+    raw = client.get(url + '&resolution=raw', headers=headers).json['points']
+    assert [(p['systolic'], p['diastolic']) for p in raw] == [(130, 80), (140, 80)]
+    assert client.get(url + '&resolution=week', headers=headers).status_code == 422
+
+def test_dashboard_summary_reads_daily_rollups(client):
+    admin = auth_headers(client, 'adminuser', 'Admin')
+    reception = auth_headers(client, 'receptionuser', 'Receptionist')
+    nurse = auth_headers(client, 'nurseuser', 'Nurse')
+    doctor = auth_headers(client, 'doctoruser', 'Doctor')
+    billing = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments(['ws_CO_dash_mpesa', 'ws_CO_dash_cash'])
+    with app.app_context():
+        patient_id = Patient.query.filter_by(name='Payer').first().id
+        cash_invoice = Invoice.query.filter_by(invoice_number='INV-ws_CO_dash_cash').one().id
+    first = client.post('/api/patient-visits', json={'patient_id': patient_id}, headers=reception).json['id']
+    client.post('/api/patient-visits', json={'patient_id': patient_id}, headers=reception)
+    client.put(f'/api/patient-visits/{first}', json={'triage_notes': 'ok'}, headers=nurse)
+    client.post('/api/lab-orders', json={'patient_id': patient_id, 'test_type': 'CBC'}, headers=doctor)
+    client.put(f'/api/invoices/{cash_invoice}/pay', json={'payment_method': 'Cash'}, headers=billing)
+    client.post('/api/payments/mpesa/callback', json={'ResultCode': '0', 'CheckoutRequestID': 'ws_CO_dash_mpesa'})
+    process_mpesa_inbox()
+    # A rejected write leaves the rollups alone
+    client.put(f'/api/patient-visits/{first}', json={}, headers=nurse)
+
+    with captured_queries() as statements:
+        summary = client.get('/api/dashboard/summary', headers=admin).json
+    assert not any(f'from {table}' in s for s in statements for table in ('invoice', 'patient_visit', 'lab_order'))
+    assert summary['revenue'] == {'payments': 2, 'amount': 200.0, 'by_payment_method': {
+        'Cash': {'payments': 1, 'amount': 100.0}, 'M-Pesa': {'payments': 1, 'amount': 100.0}}}
+    assert summary['visits'] == {'total': 2, 'by_stage': {'doctor': 1, 'triage': 1}}
+    assert summary['lab_orders'] == {'total': 1, 'by_status': {'Pending': 1}, 'pending': 1}
+    assert client.get('/api/dashboard/summary?from=2020-01-01&to=2020-01-31', headers=admin).json['visits']['total'] == 0
+    assert client.get('/api/dashboard/summary?from=tomorrow', headers=admin).status_code == 422
+    assert client.get('/api/dashboard/summary', headers=billing).status_code == 403
+
+    # The rebuild also counts the visit the payment helper inserted without going through the API
+    result = app.test_cli_runner().invoke(args=['rebuild-daily-rollups'])
+    assert result.exit_code == 0, result.output
+    rebuilt = client.get('/api/dashboard/summary', headers=admin).json
+    assert rebuilt['revenue'] == summary['revenue']
+    assert rebuilt['lab_orders'] == summary['lab_orders']
+    assert rebuilt['visits'] == {'total': 3, 'by_stage': {'doctor': 1, 'triage': 1, 'reception': 1}}
+
+def test_finance_summary_sums_in_sql_and_caches_closed_periods(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    auth_headers(client, 'payrollnurse', 'Nurse')
+    with app.app_context():
+        admin_id = User.query.filter_by(username='adminuser').one().id
+        nurse_id = User.query.filter_by(username='payrollnurse').one().id
+        for user_id, month, salary, bonus, deductions in [(admin_id, 1, 1000, 100, 50), (nurse_id, 1, 800, 0, 20),
+                                                          (admin_id, 2, 1000, 0, 50), (nurse_id, 3, 800, 40, 0)]:
+            db.session.add(Payroll(user_id=user_id, salary=salary, bonus=bonus, deductions=deductions,
+                                   period_start=datetime(2025, month, 1).date(), period_end=datetime(2025, month, 28).date()))
+        db.session.commit()
+    url = '/api/finance/summary?from=2025-01&to=2025-03'
+    summary = client.get(url, headers=headers).json
+    assert [(g['period'], g['entries'], g['salary'], g['net']) for g in summary['groups']] == [
+        ('2025-01', 2, 1800.0, 1830.0), ('2025-02', 1, 1000.0, 950.0), ('2025-03', 1, 800.0, 840.0)]
+    assert summary['totals'] == {'entries': 4, 'salary': 3600.0, 'bonus': 140.0, 'deductions': 120.0, 'net': 3620.0}
+    # Closed periods come from the cache after the first request
+    with captured_queries() as statements:
+        assert client.get(url, headers=headers).json == summary
+    assert not any('from payroll' in s for s in statements)
+
+    by_type = client.get('/api/finance/summary?interval=year&from=2025&to=2025&group_by=employee,type', headers=headers).json
+    assert [(g['username'], g['type'], g['amount']) for g in by_type['groups'] if g['username'] == 'payrollnurse'] == [
+        ('payrollnurse', 'salary', 1600.0), ('payrollnurse', 'bonus', 40.0), ('payrollnurse', 'deductions', 20.0)]
+
+    # The current month stays open, so new entries show up straight away
+    client.post('/api/finance/expenses', json={'user_id': admin_id, 'amount': 25}, headers=headers)
+    current = client.get('/api/finance/summary?group_by=type', headers=headers).json
+    assert {g['type']: g['amount'] for g in current['groups']}['deductions'] == 25.0
+    client.post('/api/finance/expenses', json={'user_id': admin_id, 'amount': 5}, headers=headers)
+    assert client.get('/api/finance/summary', headers=headers).json['totals']['deductions'] == 30.0
+    assert client.get('/api/finance/summary?group_by=category', headers=headers).status_code == 422
+    assert client.get('/api/finance/summary?from=2025-13', headers=headers).status_code == 422
+
+def test_reads_answer_if_none_match_from_version_stamps(client):
+    headers = auth_headers(client, 'adminuser', 'Admin')
+    billing = auth_headers(client, 'billinguser', 'Billing')
+    pending_mpesa_payments(['ws_CO_etag'])
+    with app.app_context():
+        patient = Patient.query.filter_by(name='Payer').one()
+        db.session.add(MedicalRecord(patient_id=patient.id, doctor_id=1, diagnosis='Flu', history='None'))
+        db.session.commit()
+        patient_id = patient.id
+        invoice_id = Invoice.query.filter_by(invoice_number='INV-ws_CO_etag').one().id
+        visit_id = PatientVisit.query.filter_by(patient_id=patient_id).one().id
+
+    def revalidate(url, request_headers):
+        first = client.get(url, headers=request_headers)
+        assert first.status_code == 200 and first.headers['ETag']
+        with captured_queries() as statements:
+            again = client.get(url, headers={**request_headers, 'If-None-Match': first.headers['ETag']})
+        assert again.status_code == 304 and again.headers['ETag'] == first.headers['ETag']
+        return first.headers['ETag'], statements
+
+    patient_url = f'/api/patients/{patient_id}'
+    etag, statements = revalidate(patient_url, headers)
+    # Only the version stamps are read, never the patient or its record in full
+    assert not any('patient.name' in s or 'medical_record.history' in s for s in statements)
+    client.put(patient_url, json={'contact': '0700000000'}, headers=headers)
+    assert client.get(patient_url, headers={**headers, 'If-None-Match': etag}).status_code == 200
+    etag, _ = revalidate(patient_url, headers)
+    with app.app_context():
+        MedicalRecord.query.filter_by(patient_id=patient_id).one().allergies = 'Penicillin'
+        db.session.commit()
+    changed = client.get(patient_url, headers={**headers, 'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.json['allergies'] == 'Penicillin'
+
+    invoice_etag, _ = revalidate(f'/api/invoices/{invoice_id}', billing)
+    list_etag, _ = revalidate('/api/invoices?page=1', billing)
+    client.put(f'/api/invoices/{invoice_id}/pay', json={'payment_method': 'Cash'}, headers=billing)
+    assert client.get(f'/api/invoices/{invoice_id}', headers={**billing, 'If-None-Match': invoice_etag}).json['status'] == 'Paid'
+    assert client.get('/api/invoices?page=1', headers={**billing, 'If-None-Match': list_etag}).status_code == 200
+
+    revalidate(f'/api/patient-visits/{visit_id}', headers)
+    patients_etag, _ = revalidate('/api/patients', headers)
+    client.post('/api/patients/bulk', data='name,dob\nAda,1990-01-01\n', headers=headers, content_type='text/csv')
+    assert client.get('/api/patients', headers={**headers, 'If-None-Match': patients_etag}).status_code == 200
+
+    client.put('/api/communication-settings', json={'setting': 'sms'}, headers=headers)
+    settings_etag, _ = revalidate('/api/communication-settings', headers)
+    client.put('/api/communication-settings', json={'setting': 'sms'}, headers=headers)
+    assert client.get('/api/communication-settings', headers={**headers, 'If-None-Match': settings_etag}).status_code == 200
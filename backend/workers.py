@@ -0,0 +1,106 @@
+"""Background work run on threads in each worker process: periodic jobs and a bounded pool."""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """Call ``task()`` every ``interval`` seconds on a daemon thread.
+
+    The thread is started by the first :meth:`start` in each process, so
+    it is safe to call from request handlers. If ``task`` returns a truthy
+    value (e.g. it filled a whole batch) it runs again right away instead
+    of waiting out the interval. :meth:`wake` runs it early.
+    """
+
+    def __init__(self, task, interval=10.0, name='periodic-worker'):
+        self._task = task
+        self.interval = interval
+        self.name = name
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        # Threads do not survive a fork, so each (gunicorn) worker starts its own.
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    def run_once(self):
+        """Run the task on the calling thread. Returns what it returned, or None if it raised."""
+        try:
+            return self._task()
+        except Exception:
+            logger.exception('%s failed', self.name)
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            more = self.run_once()
+            if more and not self._stop.is_set():
+                continue
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+class BoundedExecutor:
+    """A thread pool that turns work away instead of queueing it without limit.
+
+    At most ``max_workers`` tasks run at once and ``max_pending`` more may
+    wait; beyond that :meth:`submit` returns False so the caller can answer
+    "busy" rather than pile up requests. The pool is created on first use in
+    each process.
+    """
+
+    def __init__(self, max_workers=4, max_pending=100, name='executor'):
+        self.max_workers = max_workers
+        self.name = name
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            future = self._get_pool().submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._finished)
+        return True
+
+    def _finished(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            logger.error('%s task failed', self.name, exc_info=future.exception())
+
+    def _get_pool(self):
+        # Threads do not survive a fork, so each (gunicorn) worker creates its own pool.
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+            return self._pool